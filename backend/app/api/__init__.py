@@ -1,6 +1,7 @@
 """API related functions and classes."""
 
 import json
+import logging
 from typing import Any, Callable, Coroutine, Optional
 
 from fastapi import FastAPI as OriginalFastAPI
@@ -17,16 +18,31 @@ from starlette.responses import HTMLResponse
 from app.config import settings
 from app.db.core import Database
 from app.http import HTTPClient
+from app.scheduler import SyncScheduler
 from app.state import State
 from app.sync import OWSync
+from app.utils.db import (
+    DB_MULTIPLE_CONNECTION_REQUESTS,
+    RequestConnection,
+    track_connection_usage,
+    use_session,
+)
 from app.utils.permissions import PermissionManager
 
+from .metrics import get_route_name
+
 __all__ = (
     "FastAPI",
     "Request",
     "APIRoute",
 )
 
+logger = logging.getLogger(__name__)
+
+
+# Requests with other methods may write, after which the session reads from
+# the primary for a while
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
 
 oidc = OpenIdConnect(
     openIdConnectUrl=f"{settings.auth0_issuer}/openid/.well-known/openid-configuration",
@@ -38,6 +54,7 @@ class FastAPI(OriginalFastAPI):
     http: HTTPClient
     app_state: State
     ow_sync: OWSync
+    sync_scheduler: SyncScheduler
     permission_manager: PermissionManager
     ow_permission_manager: PermissionManager
 
@@ -53,6 +70,9 @@ class FastAPI(OriginalFastAPI):
     def set_ow_sync(self, ow_sync: OWSync) -> None:
         self.ow_sync = ow_sync
 
+    def set_sync_scheduler(self, sync_scheduler: SyncScheduler) -> None:
+        self.sync_scheduler = sync_scheduler
+
     def set_permission_manager(self, permission_manager: PermissionManager) -> None:
         self.permission_manager = permission_manager
 
@@ -75,6 +95,20 @@ class Request(OriginalRequest):
             return str(token[7:])
         return None
 
+    @property
+    def connection(self) -> RequestConnection:
+        """The database connection of this request. Acquired on first use
+        and released when the response is ready. Repository methods marked
+        `read_only` read through it from the replica, if there is one."""
+        connection = getattr(self.state, "connection", None)
+        if connection is None:
+            db = self.app.db
+            connection = RequestConnection(
+                db.pool, db.get_replica_pool_for(self.access_token)
+            )
+            self.state.connection = connection
+        return connection
+
     def raise_if_missing_authorization(self) -> str:
         access_token = self.access_token
         if access_token is None:
@@ -94,7 +128,29 @@ class APIRoute(OriginalAPIRoute):
 
         async def custom_route_handler(request: OriginalRequest) -> Response:
             request = Request(request.scope, request.receive)
-            return await original_route_handler(request)
+            strict = settings.postgres_strict_request_connections
+            session = request.access_token
+            with track_connection_usage(strict) as usage, use_session(session):
+                try:
+                    return await original_route_handler(request)
+                finally:
+                    connection = getattr(request.state, "connection", None)
+                    if connection is not None:
+                        await connection.release()
+
+                    if request.method not in SAFE_METHODS:
+                        request.app.db.note_write(request.access_token)
+
+                    # Each connection a request holds is one less for others
+                    if usage.acquired > 1:
+                        path = get_route_name(request.scope)
+                        DB_MULTIPLE_CONNECTION_REQUESTS.inc(path)
+                        logger.info(
+                            "%s %s acquired %d database connections",
+                            request.method,
+                            path,
+                            usage.acquired,
+                        )
 
         return custom_route_handler
 
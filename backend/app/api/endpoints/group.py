@@ -69,15 +69,15 @@ async def get_my_groups(
         raise HTTPException(status_code=401, detail="Ugyldig access token") from exc
 
     if not optimistic:
-        await app.ow_sync.sync_for_user(
+        await app.sync_scheduler.request_user_sync(
             ow_user_id,
             user_id,
             access_token,
             wait_for_updates=wait_for_updates,
         )
 
-    groups = await app.db.users.get_groups(user_id)
-    return groups
+    async with request.connection as conn:
+        return await app.db.users.get_groups(user_id, conn=conn)
 
 
 @router.get(
@@ -100,9 +100,10 @@ async def search_groups(
     if len(query) < 1:
         return []
 
-    return await app.db.groups.search(
-        query, limit=limit, include_ow_groups=include_ow_groups
-    )
+    async with request.connection as conn:
+        return await app.db.groups.search(
+            query, limit=limit, include_ow_groups=include_ow_groups, conn=conn
+        )
 
 
 @router.get(
@@ -123,7 +124,7 @@ async def get_group_user(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         res = await app.db.groups.is_in_group(
             requester_user_id,
             group_id,
@@ -135,7 +136,7 @@ async def get_group_user(
             )
 
         try:
-            ret = await app.db.group_users.get(group_id, user_id)
+            ret = await app.db.group_users.get(group_id, user_id, conn=conn)
         except NotFound as exc:
             raise HTTPException(
                 status_code=404,
@@ -160,7 +161,7 @@ async def get_group_users(request: Request, group_id: GroupId) -> list[GroupUser
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         res = await app.db.groups.is_in_group(
             user_id,
             group_id,
@@ -188,24 +189,24 @@ async def get_group(request: Request, group_id: GroupId) -> Group:
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
-        res = await app.db.groups.is_in_group(
-            user_id,
-            group_id,
-            conn=conn,
+    conn = request.connection
+    res = await app.db.groups.is_in_group(
+        user_id,
+        group_id,
+        conn=conn,
+    )
+    # Allow viewing any group in debug mode (localhost development)
+    if not res and not settings.debug:
+        raise HTTPException(
+            status_code=403, detail="Du er ikke et medlem av gruppen"
         )
-        # Allow viewing any group in debug mode (localhost development)
-        if not res and not settings.debug:
-            raise HTTPException(
-                status_code=403, detail="Du er ikke et medlem av gruppen"
-            )
 
-        try:
-            return await app.db.groups.get(group_id, conn=conn)
-        except NotFound as exc:
-            raise HTTPException(
-                status_code=404, detail="Gruppen ble ikke funnet"
-            ) from exc
+    try:
+        return await app.db.groups.get(group_id, conn=conn)
+    except NotFound as exc:
+        raise HTTPException(
+            status_code=404, detail="Gruppen ble ikke funnet"
+        ) from exc
 
 
 @router.get(
@@ -224,7 +225,7 @@ async def get_public_group(request: Request, group_name_short: str) -> GroupPubl
     else:
         user_id = None
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             return await app.db.groups.get_public_group_profile(
                 group_name_short, user_id, conn=conn
@@ -248,7 +249,7 @@ async def post_group(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         async with conn.transaction():
             try:
                 data = await app.db.groups.insert(
@@ -297,7 +298,7 @@ async def patch_group(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=False, conn=conn)
         except NotFound as exc:
@@ -339,7 +340,7 @@ async def patch_invite_code(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=False, conn=conn)
         except NotFound as exc:
@@ -383,7 +384,7 @@ async def delete_group(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=False, conn=conn)
         except NotFound as exc:
@@ -421,7 +422,7 @@ async def delete_group_user(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=False, conn=conn)
         except NotFound as exc:
@@ -509,7 +510,7 @@ async def transfer_ownership(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=True, conn=conn)
         except NotFound as exc:
@@ -557,7 +558,7 @@ async def patch_group_user_permissions(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=True, conn=conn)
         except NotFound as exc:
@@ -651,7 +652,7 @@ async def add_punishment_type_to_group(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -707,7 +708,7 @@ async def patch_punishment_type_to_group(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -765,7 +766,7 @@ async def delete_punishment_type_to_group(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -817,7 +818,7 @@ async def add_punishment(
     app = request.app
     created_by, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=True, conn=conn)
         except NotFound as exc:
@@ -847,7 +848,9 @@ async def add_punishment(
                 detail="Du må være et medlem av gruppen for å utføre denne handlingen",
             )
 
-        group_punishment_types = await app.db.punishment_types.get_all(group_id)
+        group_punishment_types = await app.db.punishment_types.get_all(
+            group_id, conn=conn
+        )
         # Check that no punishment have too high amount or is not part of group
         for punishment in punishments:
             if punishment.amount > 9:
@@ -892,7 +895,7 @@ async def delete_punishment(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, include_members=True, conn=conn)
         except NotFound as exc:
@@ -937,7 +940,7 @@ async def post_mark_punishments_as_paid(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -988,7 +991,7 @@ async def post_mark_punishments_as_unpaid(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -1038,7 +1041,7 @@ async def post_mark_all_punishments_as_paid_for_user(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             group = await app.db.groups.get(group_id, conn=conn)
         except NotFound as exc:
@@ -1109,7 +1112,7 @@ async def get_group_events(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         res = await app.db.groups.is_in_group(
             user_id,
             group_id,
@@ -1121,14 +1124,14 @@ async def get_group_events(
                 detail="Du må være et medlem av gruppen for å se denne informasjonen",
             )
 
-    pagination = Pagination[GroupEvent](
-        request=request,
-        total_coro=partial(app.db.group_events.get_count, group_id),
-        results_coro=partial(app.db.group_events.get_all_with_offset, group_id),
-        page=page,
-        page_size=page_size,
-    )
-    return await pagination.paginate()
+        pagination = Pagination[GroupEvent](
+            request=request,
+            total_coro=partial(app.db.group_events.get_count, group_id),
+            results_coro=partial(app.db.group_events.get_all_with_offset, group_id),
+            page=page,
+            page_size=page_size,
+        )
+        return await pagination.paginate(conn=conn)
 
 
 @router.post(
@@ -1150,7 +1153,7 @@ async def post_group_event(
                 detail="Starttidsunktet må være før sluttidspunktet",
             )
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         res = await app.db.groups.is_in_group(
             user_id,
             group_id,
@@ -1194,7 +1197,7 @@ async def delete_group_event(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         res = await app.db.groups.is_in_group(
             user_id,
             group_id,
@@ -1226,7 +1229,7 @@ async def total_punishment_value(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         res = await app.db.groups.is_in_group(
             user_id,
             group_id,
@@ -1257,7 +1260,7 @@ async def get_group_join_requests(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -1300,7 +1303,7 @@ async def create_group_join_request(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_in_group = await app.db.groups.combined_group_check(
             group_id,
             user_id,
@@ -1365,7 +1368,7 @@ async def accept_group_join_request(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             requester_user_id,
@@ -1419,7 +1422,7 @@ async def join_group(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         group = await app.db.groups.get(
             group_id, invite_code=invite_code, include_members=False, conn=conn
         )
@@ -1468,7 +1471,7 @@ async def deny_group_join_request(
     app = request.app
     requester_user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         is_ow_group, is_group_member = await app.db.groups.combined_group_check(
             group_id,
             requester_user_id,
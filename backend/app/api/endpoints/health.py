@@ -3,8 +3,11 @@ Health check endpoints
 """
 
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
 
-from app.api import APIRoute
+from app.api import APIRoute, Request
+from app.utils.db import DB_POOL_CONNECTIONS
+from app.utils.metrics import REGISTRY
 
 router = APIRouter(
     tags=["Monitoring"],
@@ -17,3 +20,40 @@ router = APIRouter(
 )
 async def get_health() -> dict[str, str]:
     return {"status": "ok"}
+
+
+@router.get(
+    "/health/stats",
+    response_model=dict[str, dict[str, int]],
+)
+async def get_stats(request: Request) -> dict[str, dict[str, int]]:
+    app = request.app
+    return {
+        "access_tokens": app.app_state.get_stats(),
+        "db_pool": app.db.get_pool_stats(),
+        "db_replica_pool": app.db.get_replica_pool_stats(),
+        "group_sync": app.ow_sync.group_freshness.get_stats(),
+        "sync_queue": app.sync_scheduler.get_stats(),
+        "ow_http": app.http.pool_stats.get_stats(),
+        "ow_circuit_breaker": app.http.circuit_breaker.get_stats(),
+    }
+
+
+@router.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+)
+async def get_metrics(request: Request) -> PlainTextResponse:
+    """Metrics in the Prometheus text exposition format."""
+    db = request.app.db
+    pools = {"primary": db.get_pool_stats(), "replica": db.get_replica_pool_stats()}
+    for pool, pool_stats in pools.items():
+        if not pool_stats:
+            continue
+        for state in ("size", "idle", "waiting"):
+            DB_POOL_CONNECTIONS.set(pool_stats.get(state, 0), pool, state)
+
+    return PlainTextResponse(
+        REGISTRY.render(),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -10,6 +10,7 @@ from emoji import is_emoji
 from fastapi import APIRouter, Depends, HTTPException, Query
 
 from app.api import APIRoute, Request, oidc
+from app.config import settings
 from app.exceptions import NotFound
 from app.models.punishment import TopStreaker
 from app.models.punishment_reaction import (
@@ -17,7 +18,13 @@ from app.models.punishment_reaction import (
     PunishmentReactionRead,
 )
 from app.models.user import LogPunishmentOut
-from app.utils.pagination import Page, Pagination
+from app.utils.pagination import (
+    CountStrategy,
+    CursorKey,
+    Page,
+    Pagination,
+    PaginationQueries,
+)
 from app.types import GroupId, PunishmentId
 
 router = APIRouter(
@@ -42,14 +49,14 @@ async def get_top_streakers(request: Request) -> list[TopStreaker]:
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
-        is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
-        if not is_in_any_ow_group:
-            raise HTTPException(
-                status_code=403, detail="Du har ikke tilgang til denne ressursen"
-            )
+    conn = request.connection
+    is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
+    if not is_in_any_ow_group:
+        raise HTTPException(
+            status_code=403, detail="Du har ikke tilgang til denne ressursen"
+        )
 
-        return await app.db.punishments.get_top_streakers(conn=conn)
+    return await app.db.punishments.get_top_streakers(conn=conn)
 
 
 @router.get(
@@ -61,6 +68,7 @@ async def get_punishments_log(
     request: Request,
     page: int = Query(title="Page number", default=0, ge=0),
     page_size: int = Query(title="Page size", default=30, ge=1, le=50),
+    cursor: Optional[str] = Query(title="Cursor from a previous page, empty for the first page", default=None),
     group_id: Optional[GroupId] = Query(title="Group ID", default=None),
     date_from: Optional[datetime.date] = Query(title="From date", default=None),
     date_to: Optional[datetime.date] = Query(title="To date", default=None),
@@ -74,21 +82,29 @@ async def get_punishments_log(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
-        is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
-        if not is_in_any_ow_group:
-            raise HTTPException(
-                status_code=403, detail="Du har ikke tilgang til denne ressursen"
-            )
-
-        pagination = Pagination[LogPunishmentOut](
-            request=request,
-            total_coro=partial(app.db.punishments.get_all_count, group_id=group_id, date_from=date_from, date_to=date_to, search=search),
-            results_coro=partial(app.db.punishments.get_all, group_id=group_id, date_from=date_from, date_to=date_to, search=search),
-            page=page,
-            page_size=page_size,
+    conn = request.connection
+    is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
+    if not is_in_any_ow_group:
+        raise HTTPException(
+            status_code=403, detail="Du har ikke tilgang til denne ressursen"
         )
-        return await pagination.paginate(conn=conn)
+
+    pagination = Pagination[LogPunishmentOut](
+        request=request,
+        total_coro=partial(app.db.punishments.get_all_count, group_id=group_id, date_from=date_from, date_to=date_to, search=search),
+        results_coro=partial(app.db.punishments.get_all, group_id=group_id, date_from=date_from, date_to=date_to, search=search),
+        page=page,
+        page_size=page_size,
+        cursor=cursor,
+        cursor_key=CursorKey(
+            get=lambda p: (p.created_at, p.punishment_id),
+            types=(datetime.datetime.fromisoformat, PunishmentId),
+        ),
+        count=CountStrategy(settings.punishment_log_count_strategy),
+        queries=PaginationQueries(settings.punishment_log_pagination_queries),
+        window_coro=partial(app.db.punishments.get_all_with_total, group_id=group_id, date_from=date_from, date_to=date_to, search=search),
+    )
+    return await pagination.paginate(conn=conn)
 
 
 @router.post(
@@ -106,7 +122,7 @@ async def post_punishment_reaction(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             await app.db.punishments.get(punishment_id, conn=conn)
         except NotFound as exc:
@@ -161,7 +177,7 @@ async def delete_punishment_reaction(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         try:
             punishment = await app.db.punishments.get(punishment_id, conn=conn)
         except NotFound as exc:
@@ -17,14 +17,14 @@ async def get_group_statistics(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
-        is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
-        if not is_in_any_ow_group:
-            raise HTTPException(
-                status_code=403, detail="Du har ikke tilgang til denne ressursen"
-            )
+    conn = request.connection
+    is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
+    if not is_in_any_ow_group:
+        raise HTTPException(
+            status_code=403, detail="Du har ikke tilgang til denne ressursen"
+        )
 
-        return await app.db.statistics.get_all_group_statistics(gambling_only=gambling_only, conn=conn)
+    return await app.db.statistics.get_all_group_statistics(gambling_only=gambling_only, conn=conn)
 
 @router.get("/groups/{group_id}")
 async def get_group_statistics(
@@ -32,8 +32,7 @@ async def get_group_statistics(
     group_id: str
 ):
     app = request.app
-    async with app.db.pool.acquire() as conn:
-        return await app.db.statistics.get_group_statistics(group_id, conn=conn)
+    return await app.db.statistics.get_group_statistics(group_id, conn=request.connection)
 
 @router.get("/users/{user_id}")
 async def get_user_statistics(
@@ -41,5 +40,4 @@ async def get_user_statistics(
     user_id: str
 ):
     app = request.app
-    async with app.db.pool.acquire() as conn:
-        return await app.db.statistics.get_user_statistics(user_id, conn=conn)
\ No newline at end of file
+    return await app.db.statistics.get_user_statistics(user_id, conn=request.connection)
\ No newline at end of file
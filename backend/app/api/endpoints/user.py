@@ -8,10 +8,17 @@ from app.models.punishment import LeaderboardPunishmentRead
 from fastapi import APIRouter, Depends, HTTPException, Query
 
 from app.api import APIRoute, Request, oidc
+from app.config import settings
 from app.exceptions import NotFound
 from app.models.group import UserWithGroups
 from app.models.user import MinifiedLeaderboardUser
-from app.utils.pagination import Page, Pagination
+from app.utils.pagination import (
+    CountStrategy,
+    CursorKey,
+    Page,
+    Pagination,
+    PaginationQueries,
+)
 from app.types import UserId
 
 router = APIRouter(
@@ -44,14 +51,14 @@ async def get_me(
         raise HTTPException(status_code=401, detail="Ugyldig access token") from exc
 
     if not optimistic:
-        await app.ow_sync.sync_for_user(
+        await app.sync_scheduler.request_user_sync(
             ow_user_id,
             user_id,
             access_token,
             wait_for_updates=wait_for_updates,
         )
 
-    async with app.db.pool.acquire() as conn:
+    async with request.connection as conn:
         groups = []
         if include_groups:
             groups = await app.db.users.get_groups(user_id, conn=conn)
@@ -73,6 +80,7 @@ async def get_leadeboard(
     request: Request,
     page: int = Query(title="Page number", default=0, ge=0),
     page_size: int = Query(title="Page size", default=30, ge=1, le=50),
+    cursor: Optional[str] = Query(title="Cursor from a previous page, empty for the first page", default=None),
     this_year: bool = Query(title="Only show users from this year", default=True),
     year: Optional[int] = Query(title="Specific year to filter by", default=None, ge=2000, le=2100),
     active_only: bool = Query(title="Only show users with active memberships", default=True),
@@ -83,21 +91,30 @@ async def get_leadeboard(
     app = request.app
     user_id, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
-        is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
-        if not is_in_any_ow_group:
-            raise HTTPException(
-                status_code=403, detail="Du har ikke tilgang til denne ressursen"
-            )
-
-        pagination = Pagination[MinifiedLeaderboardUser](
-            request=request,
-            total_coro=partial(app.db.users.get_leaderboard_count, active_only),
-            results_coro=partial(app.db.users.get_minified_leaderboard, this_year, year, active_only, sort_by),
-            page=page,
-            page_size=page_size,
+    conn = request.connection
+    is_in_any_ow_group = await app.db.groups.is_in_any_ow_group(user_id, conn=conn)
+    if not is_in_any_ow_group:
+        raise HTTPException(
+            status_code=403, detail="Du har ikke tilgang til denne ressursen"
         )
-        return await pagination.paginate(conn=conn)
+
+    sort_col = app.db.users.get_leaderboard_sort_column(this_year, year, sort_by)
+    pagination = Pagination[MinifiedLeaderboardUser](
+        request=request,
+        total_coro=partial(app.db.users.get_leaderboard_count, active_only),
+        results_coro=partial(app.db.users.get_minified_leaderboard, this_year, year, active_only, sort_by),
+        page=page,
+        page_size=page_size,
+        cursor=cursor,
+        cursor_key=CursorKey(
+            get=lambda u: (getattr(u, sort_col), u.first_name, u.user_id),
+            types=(int, str, UserId),
+        ),
+        count=CountStrategy(settings.leaderboard_count_strategy),
+        queries=PaginationQueries(settings.leaderboard_pagination_queries),
+        window_coro=partial(app.db.users.get_minified_leaderboard_with_total, this_year, year, active_only, sort_by),
+    )
+    return await pagination.paginate(conn=conn)
 
 
 @router.get(
@@ -114,7 +131,7 @@ async def get_user_punishments(
     app = request.app
     _, _ = await app.ow_sync.sync_for_access_token(access_token)
 
-    async with app.db.pool.acquire() as conn:
-        return await app.db.users.get_punishments_for_leaderboard_user(
-            user_id, conn=conn
-        )
+    conn = request.connection
+    return await app.db.users.get_punishments_for_leaderboard_user(
+        user_id, conn=conn
+    )
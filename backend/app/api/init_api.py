@@ -14,16 +14,20 @@ from typing import Any
 
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse
 
 from app.api.endpoints import group, punishment, user, statistics, health
 from app.config import OW_GROUP_PERMISSIONS, PERMISSIONS, settings
 from app.db.core import Database
+from app.exceptions import OWUnavailableException
 from app.http import HTTPClient
-from app.state import State
+from app.scheduler import SyncScheduler
+from app.state import State, create_token_cache_backend
 from app.sync import OWSync
 from app.utils.permissions import PermissionManager
 
 from . import APIRoute, FastAPI, Request
+from .metrics import MetricsMiddleware
 
 logging.basicConfig(level=logging.DEBUG if settings.debug else logging.INFO)
 
@@ -66,6 +70,20 @@ def init_middlewares(app: FastAPI) -> None:
     # Compress large responses
     app.add_middleware(GZipMiddleware)
 
+    # Outermost, so it measures everything including compression
+    app.add_middleware(MetricsMiddleware)
+
+
+def init_exception_handlers(app: FastAPI) -> None:
+    @app.exception_handler(OWUnavailableException)
+    async def ow_unavailable_handler(
+        request: Request, exc: OWUnavailableException
+    ) -> JSONResponse:
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Online is currently unavailable"},
+        )
+
 
 def init_routes(app: FastAPI) -> None:
     app.include_router(user.router)
@@ -81,11 +99,23 @@ def init_events(app: FastAPI, **db_settings: str) -> None:
         database = Database()
         app.set_db(database)
 
+        state = State(
+            backend=create_token_cache_backend(
+                settings.access_token_cache_backend, database
+            ),
+        )
+        database.set_state(state)
+        app.set_app_state(state)
+
         http = HTTPClient()
         app.set_http(http)
 
-        app.set_app_state(State())
-        app.set_ow_sync(OWSync(app))
+        ow_sync = OWSync(app)
+        app.set_ow_sync(ow_sync)
+
+        sync_scheduler = SyncScheduler(ow_sync)
+        ow_sync.set_scheduler(sync_scheduler)
+        app.set_sync_scheduler(sync_scheduler)
 
         permission_manager = PermissionManager.from_raw_permissions(PERMISSIONS)
         permission_manager.inject_app(app)
@@ -99,9 +129,13 @@ def init_events(app: FastAPI, **db_settings: str) -> None:
 
         await database.async_init(**db_settings)
         await http.async_init()
+        sync_scheduler.start()
 
     @app.on_event("shutdown")
     async def shutdown_handler() -> None:
+        if app.sync_scheduler is not None:
+            await app.sync_scheduler.close()
+
         database = app.db
         if database is not None:
             await database.close()
@@ -126,6 +160,7 @@ def init_api(**db_settings: str) -> FastAPI:
     app.openapi_version = "3.0.0"
     app.router.route_class = APIRoute
     init_middlewares(app)
+    init_exception_handlers(app)
     init_routes(app)
     init_events(app, **db_settings)
     return app
@@ -0,0 +1,79 @@
+"""
+HTTP request metrics, served by the /metrics endpoint.
+"""
+
+import time
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.utils.metrics import Counter, Gauge, Histogram
+
+# Bytes, from an empty body up to the largest leaderboards
+RESPONSE_SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total",
+    "Finished requests by route and status code",
+    ["method", "route", "status"],
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Time until the whole response was sent",
+    ["method", "route"],
+)
+HTTP_RESPONSE_SIZE_BYTES = Histogram(
+    "http_response_size_bytes",
+    "Size of response bodies as sent, after compression",
+    ["method", "route"],
+    buckets=RESPONSE_SIZE_BUCKETS,
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled",
+)
+
+
+def get_route_name(scope: Scope) -> str:
+    """The path template of the matched route, so ids don't end up in labels."""
+    route = scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+class MetricsMiddleware:
+    """Records latency, status and response size of every request by route.
+
+    A plain ASGI middleware rather than a `BaseHTTPMiddleware`, which would
+    run every request in an extra task.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_with_metrics(message: Message) -> None:
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+
+            method = scope["method"]
+            route = get_route_name(scope)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method, route)
+            HTTP_RESPONSE_SIZE_BYTES.observe(size, method, route)
+            HTTP_REQUESTS.inc(method, route, str(status))
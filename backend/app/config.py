@@ -6,6 +6,7 @@ VENGEFUL_DATABASE=test.db will set vengeful_database="test.db"
 """
 
 from pathlib import Path
+from typing import Literal, Optional
 
 from pydantic import BaseSettings
 
@@ -85,6 +86,11 @@ OW_GROUP_PERMISSIONS_AS_DICT: dict[
     OW_GROUP_PERMISSIONS  # type: ignore
 )
 
+# Values of `CountStrategy` and `PaginationQueries` of app.utils.pagination,
+# which imports this module
+CountStrategyName = Literal["exact", "cached", "estimate", "none"]
+PaginationQueriesName = Literal["sequential", "parallel", "window"]
+
 
 class Settings(BaseSettings):
     vengeful_database: str = ":memory:"
@@ -93,6 +99,44 @@ class Settings(BaseSettings):
     postgres_user: str = "postgres"
     postgres_password: str = "postgres"
     postgres_db: str = "dev"
+    # Postgres connection pool. Idle connections above min_size are closed
+    # after max_inactive_connection_lifetime seconds.
+    postgres_pool_min_size: int = 10
+    postgres_pool_max_size: int = 10
+    postgres_max_queries: int = 50000  # Before a connection is replaced
+    postgres_max_inactive_connection_lifetime: float = 300
+    postgres_command_timeout: Optional[float] = None
+    # Prepared statements cached per connection. Some of our queries are
+    # large, so statements up to 64 KiB are cached instead of 15 KiB.
+    postgres_statement_cache_size: int = 100
+    postgres_max_cached_statement_lifetime: int = 300
+    postgres_max_cacheable_statement_size: int = 64 * 1024
+    postgres_connect_attempts: int = 10
+    postgres_connect_retry_interval: float = 0.5
+    # Fail requests that acquire more than one pool connection, for tests
+    postgres_strict_request_connections: bool = False
+    # Optional read replica with the same credentials and pool settings.
+    # Read-only queries of read endpoints go to it, except for sessions that
+    # wrote less than `read_your_writes_window` seconds ago.
+    postgres_replica_host: Optional[str] = None
+    postgres_replica_port: Optional[int] = None  # Defaults to postgres_port
+    postgres_replica_read_your_writes_window: float = 10
+    # How the leaderboard and punishment log count their totals. "exact"
+    # counts on every request, "cached" reuses exact counts for
+    # `pagination_count_cache_ttl` seconds or until the next write through the
+    # API, "estimate" uses the planner's row estimate and "none" leaves the
+    # total out. Cached totals miss writes of background syncs until they
+    # expire.
+    leaderboard_count_strategy: CountStrategyName = "exact"
+    punishment_log_count_strategy: CountStrategyName = "exact"
+    pagination_count_cache_ttl: float = 60
+    # How the leaderboard and punishment log run the count and results queries
+    # when the total has to be counted. "sequential" runs one after the other
+    # on the connection of the request, "parallel" counts on a second
+    # connection at the same time and "window" counts in the results query
+    # with `COUNT(*) OVER ()`.
+    leaderboard_pagination_queries: PaginationQueriesName = "sequential"
+    punishment_log_pagination_queries: PaginationQueriesName = "sequential"
     max_punishment_types: int = 10
     max_groups_per_user: int = 20
     max_active_punishments_per_group: int = 1000
@@ -105,6 +149,51 @@ class Settings(BaseSettings):
     ow5_base_url: str = "http://host.docker.internal:4444/api/trpc"
     auth0_issuer: str = "https://auth.dev.online.ntnu.no"
     auth0_client_id: str = ""
+    # Access token cache. The ttl is an upper bound, tokens carrying an `exp`
+    # claim are dropped when they expire.
+    access_token_cache_max_size: int = 10000
+    access_token_cache_ttl: int = 60 * 60
+    access_token_cache_max_memory: int = 16 * 1024 * 1024  # Bytes
+    # Either "memory" or "postgres". The postgres backend shares cached tokens
+    # between workers, which then only keep them locally for `local_ttl`.
+    access_token_cache_backend: str = "memory"
+    access_token_cache_local_ttl: int = 30
+    # Background OW sync
+    sync_user_workers: int = 4
+    sync_user_min_interval: float = 10  # Seconds between syncs of the same user
+    sync_group_workers: int = 4  # Groups synced at the same time by bulk syncs
+    # Syncs holding a database connection at the same time, and connections
+    # of the pool that syncs leave to requests
+    sync_max_concurrency: int = 4
+    sync_reserved_connections: int = 4
+    sync_state_max_size: int = 10000
+    # Syncs of a group that was synced less than this many seconds ago are
+    # skipped for users already in it. Persisting it shares it between workers.
+    sync_group_freshness_window: float = 60
+    sync_group_freshness_persist: bool = False
+    # Unchanged OW group payloads are not written to the database. Every group
+    # is still fully reconciled at least this often (seconds).
+    sync_group_digest_ttl: float = 6 * 60 * 60
+    # OW users are fetched in pages of this size, 0 fetches all of them in a
+    # single streamed request. Up to `prefetch_pages` pages are fetched ahead
+    # of the code consuming them.
+    ow_users_page_size: int = 1000
+    ow_users_prefetch_pages: int = 2
+    # OW HTTP client. Timeouts are in seconds, read is the time allowed between
+    # two reads of the response.
+    ow_http_limit: int = 100
+    ow_http_limit_per_host: int = 50
+    ow_http_keepalive_timeout: float = 30
+    ow_http_dns_cache_ttl: int = 300
+    ow_http_connect_timeout: float = 3
+    ow_http_read_timeout: float = 10
+    ow_http_total_timeout: float = 20
+    # OW is not called for `reset_timeout` seconds after this many failures
+    # in a row
+    ow_circuit_breaker_failure_threshold: int = 5
+    ow_circuit_breaker_reset_timeout: float = 30
+    # Max number of calls in a single tRPC batch request
+    ow_batch_size: int = 10
 
 
 settings = Settings()
@@ -0,0 +1,92 @@
+import datetime
+import hashlib
+from typing import TYPE_CHECKING, Optional
+
+from asyncpg import Pool
+
+from app.types import OWUserId, UserId
+from app.utils.db import MaybeAcquire
+
+if TYPE_CHECKING:
+    from app.db.core import Database
+
+
+def hash_access_token(access_token: str) -> str:
+    """Access tokens are never stored in plain text"""
+    return hashlib.sha256(access_token.encode()).hexdigest()
+
+
+class AccessTokens:
+    def __init__(self, db: "Database"):
+        self.db = db
+
+    async def get(
+        self,
+        access_token: str,
+        conn: Optional[Pool] = None,
+    ) -> Optional[tuple[UserId, OWUserId, datetime.datetime]]:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = """SELECT user_id, ow_user_id, expires_at
+                    FROM access_token_cache
+                    WHERE access_token_hash = $1
+                        AND expires_at > (now() at time zone 'utc')"""
+            res = await conn.fetchrow(query, hash_access_token(access_token))
+
+        if res is None:
+            return None
+
+        return res["user_id"], OWUserId(res["ow_user_id"]), res["expires_at"]
+
+    async def upsert(
+        self,
+        access_token: str,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        expires_at: datetime.datetime,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Stores the token, replacing any other token cached for the same OW user."""
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            access_token_hash = hash_access_token(access_token)
+            query = """WITH removed AS (
+                        DELETE FROM access_token_cache
+                        WHERE ow_user_id = $2 AND access_token_hash <> $1
+                    )
+                    INSERT INTO access_token_cache(access_token_hash, ow_user_id, user_id, expires_at)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (access_token_hash)
+                    DO UPDATE SET ow_user_id = $2, user_id = $3, expires_at = $4"""
+            await conn.execute(
+                query,
+                access_token_hash,
+                ow_user_id,
+                user_id,
+                expires_at,
+            )
+
+    async def delete(
+        self,
+        access_token: str,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = "DELETE FROM access_token_cache WHERE access_token_hash = $1"
+            await conn.execute(query, hash_access_token(access_token))
+
+    async def delete_by_ow_user_id(
+        self,
+        ow_user_id: OWUserId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = "DELETE FROM access_token_cache WHERE ow_user_id = $1"
+            await conn.execute(query, ow_user_id)
+
+    async def delete_expired(
+        self,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = """DELETE FROM access_token_cache
+                    WHERE expires_at <= (now() at time zone 'utc')"""
+            await conn.execute(query)
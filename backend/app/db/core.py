@@ -2,24 +2,29 @@ import asyncio
 import json
 import logging
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional
 
 from asyncpg import Pool, create_pool
 from asyncpg.exceptions import CannotConnectNowError
 
 from app.config import settings
-from app.utils.db import MaybeAcquire
+from app.state import State
+from app.utils.cache import LRUCache
+from app.utils.db import InstrumentedPool, MaybeAcquire
 
+from .access_tokens import AccessTokens
 from .group_events import GroupEvents
 from .group_join_requests import GroupJoinRequests
 from .group_members import GroupMembers
 from .group_users import GroupUsers
 from .groups import Groups
+from .leaderboard import Leaderboard
 from .permissions import Permissions
 from .punishment_reactions import PunishmentReactions
 from .punishment_types import PunishmentTypes
 from .punishments import Punishments
 from .statistics import Statistics
+from .streaks import Streaks
 from .users import Users
 
 logger = logging.getLogger(__name__)
@@ -43,9 +48,23 @@ def read_sql_file(filepath: Path) -> str:
 
 
 class Database:
-    def __init__(self) -> None:
-        self._pool: Optional[Pool] = None
+    def __init__(self, state: Optional[State] = None) -> None:
+        self._pool: Optional[InstrumentedPool] = None
+        self._replica_pool: Optional[InstrumentedPool] = None
         self._db_name = ""
+        # Used to invalidate cached identities when users are remapped
+        self.state = state
+        # Sessions that wrote recently and read from the primary until the
+        # replica has caught up. Only known to this process.
+        self.recent_writes: LRUCache[str, bool] = LRUCache(
+            max_size=settings.access_token_cache_max_size,
+            default_ttl=settings.postgres_replica_read_your_writes_window,
+        )
+        # Totals of paginated lists, see `CountStrategy.CACHED`
+        self.count_cache: LRUCache[str, int] = LRUCache(
+            max_size=1000,
+            default_ttl=settings.pagination_count_cache_ttl,
+        )
 
         self.users = Users(self)
         self.groups = Groups(self)
@@ -58,6 +77,12 @@ class Database:
         self.group_users = GroupUsers(self)
         self.group_events = GroupEvents(self)
         self.group_join_requests = GroupJoinRequests(self)
+        self.access_tokens = AccessTokens(self)
+        self.leaderboard = Leaderboard(self)
+        self.streaks = Streaks(self)
+
+    def set_state(self, state: State) -> None:
+        self.state = state
 
     async def get_migration_lock_version(self, conn: Optional[Pool]) -> int:
         assert conn is not None
@@ -83,15 +108,46 @@ class Database:
         )
 
     @property
-    def pool(self) -> Pool:
+    def pool(self) -> InstrumentedPool:
         """A little hacky but mypy won't shut up about pool being None."""
         assert self._pool is not None
         return self._pool
 
     @pool.setter
-    def pool(self, value: Pool) -> None:
+    def pool(self, value: InstrumentedPool) -> None:
         self._pool = value
 
+    @property
+    def replica_pool(self) -> Optional[InstrumentedPool]:
+        return self._replica_pool
+
+    def get_pool_stats(self) -> dict[str, int]:
+        if self._pool is None:
+            return {}
+        return self._pool.get_stats()
+
+    def get_replica_pool_stats(self) -> dict[str, int]:
+        if self._replica_pool is None:
+            return {}
+        return self._replica_pool.get_stats()
+
+    def note_write(self, session: Optional[str]) -> None:
+        """Sends reads of the session to the primary for a while, so it sees
+        its own writes before they reach the replica. Cached totals might be
+        off after the write, so they are dropped."""
+        self.count_cache.clear()
+        if session is not None and self._replica_pool is not None:
+            self.recent_writes.set(session, True)
+
+    def get_replica_pool_for(
+        self, session: Optional[str]
+    ) -> Optional[InstrumentedPool]:
+        """The pool read-only queries of the session may use, if not the
+        primary."""
+        if session is not None and session in self.recent_writes:
+            return None
+        return self._replica_pool
+
     @staticmethod
     async def set_connection_codecs(conn: Optional[Pool]) -> None:
         assert conn is not None
@@ -99,33 +155,69 @@ class Database:
             "json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
         )
 
-    async def async_init(self, **db_settings: str) -> None:
-        for _ in range(10):  # Try for 10*0.5 seconds
+    async def create_pool(
+        self, db_settings: dict[str, Any], read_only: bool = False
+    ) -> Optional[InstrumentedPool]:
+        """Connects to postgres, retrying while it is starting up."""
+        retry_interval = settings.postgres_connect_retry_interval
+        for _ in range(settings.postgres_connect_attempts):
             try:
                 logger.info("Connecting to postgres database.")
-                self._db_name = db_settings.get("database", settings.postgres_db)
-                self._pool = await create_pool(
+                pool = await create_pool(
                     host=db_settings.get("host", settings.postgres_host),
                     port=db_settings.get("port", settings.postgres_port),
                     user=db_settings.get("user", settings.postgres_user),
                     password=db_settings.get("password", settings.postgres_password),
                     database=self._db_name,
                     init=Database.set_connection_codecs,
+                    min_size=settings.postgres_pool_min_size,
+                    max_size=settings.postgres_pool_max_size,
+                    max_queries=settings.postgres_max_queries,
+                    max_inactive_connection_lifetime=settings.postgres_max_inactive_connection_lifetime,
+                    command_timeout=settings.postgres_command_timeout,
+                    statement_cache_size=settings.postgres_statement_cache_size,
+                    max_cached_statement_lifetime=settings.postgres_max_cached_statement_lifetime,
+                    max_cacheable_statement_size=settings.postgres_max_cacheable_statement_size,
+                    # Makes Postgres reject writes on connections to replicas
+                    server_settings=(
+                        {"default_transaction_read_only": "on"} if read_only else None
+                    ),
                 )
+                return InstrumentedPool(pool, read_only=read_only)
             except (ConnectionError, CannotConnectNowError):
                 logger.info(
-                    "Connection to postgres database could not be established. Retrying in 0.5s"
+                    "Connection to postgres database could not be established. Retrying in %ss",
+                    retry_interval,
                 )
-                await asyncio.sleep(0.5)
-            else:
-                break
+                await asyncio.sleep(retry_interval)
+
+        return None
 
+    async def async_init(self, **db_settings: str) -> None:
+        self._db_name = db_settings.get("database", settings.postgres_db)
+        self._pool = await self.create_pool(db_settings)
         if self._pool is None:
             raise RuntimeError("Couldn't connect to postgres database.")
 
         await self.load_db_migrations()
 
+        replica_host = db_settings.get("replica_host", settings.postgres_replica_host)
+        if replica_host:
+            replica_port = db_settings.get(
+                "replica_port",
+                settings.postgres_replica_port or settings.postgres_port,
+            )
+            self._replica_pool = await self.create_pool(
+                {**db_settings, "host": replica_host, "port": replica_port},
+                read_only=True,
+            )
+            if self._replica_pool is None:
+                raise RuntimeError("Couldn't connect to postgres read replica.")
+            self._pool.get_replica = self.get_replica_pool_for
+
     async def close(self) -> None:
+        if self._replica_pool is not None:
+            await self._replica_pool.close()
         await self.pool.close()
 
     async def load_db_migrations(self, conn: Optional[Pool] = None) -> None:
@@ -5,7 +5,14 @@ from asyncpg import Pool
 
 from app.exceptions import NotFound
 from app.models.group_member import GroupMember, GroupMemberUpdate
-from app.types import GroupId, UserId
+from app.types import (
+    GroupId,
+    OWSyncGroupMember,
+    OWUserId,
+    PermissionPrivilege,
+    ReconciledGroupMembers,
+    UserId,
+)
 from app.utils.db import MaybeAcquire
 
 if TYPE_CHECKING:
@@ -97,6 +104,121 @@ class GroupMembers:
             )
             return [dict(r) for r in res]
 
+    async def reconcile_ow_members(
+        self,
+        group_id: GroupId,
+        members: list[OWSyncGroupMember],
+        privileges: list[tuple[OWUserId, PermissionPrivilege]],
+        conn: Optional[Pool] = None,
+    ) -> ReconciledGroupMembers:
+        """Makes the members of a group and their auto managed privileges match
+        OW in a single statement.
+
+        Users are created or updated, members missing from the group are added,
+        members are activated or deactivated to match their OW membership and
+        privileges not created by a user are added or removed. Members of the
+        group that OW doesn't list are deactivated. `members` must not contain
+        the same user twice.
+        """
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = """WITH payload AS (
+                        SELECT * FROM unnest(
+                            $2::text[], $3::text[], $4::text[], $5::text[],
+                            $6::boolean[], $7::timestamp[]
+                        ) AS p(ow_user_id, first_name, last_name, email, active, membership_end)
+                    ),
+                    upserted AS (
+                        INSERT INTO users(ow_user_id, first_name, last_name, email)
+                        SELECT ow_user_id, first_name, last_name, email FROM payload
+                        ON CONFLICT (ow_user_id) DO UPDATE
+                        SET first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name, email = EXCLUDED.email
+                        WHERE (users.first_name, users.last_name, users.email)
+                            IS DISTINCT FROM (EXCLUDED.first_name, EXCLUDED.last_name, EXCLUDED.email)
+                        RETURNING user_id, ow_user_id
+                    ),
+                    wanted AS (
+                        SELECT COALESCE(x.user_id, u.user_id) AS user_id, p.*
+                        FROM payload p
+                        LEFT JOIN upserted x ON x.ow_user_id = p.ow_user_id
+                        LEFT JOIN users u ON u.ow_user_id = p.ow_user_id
+                    ),
+                    added AS (
+                        INSERT INTO group_members(group_id, user_id, ow_group_user_id, active, added_at, inactive_at)
+                        SELECT
+                            $1, w.user_id, w.ow_user_id, w.active, now() at time zone 'utc',
+                            CASE WHEN w.active THEN NULL
+                                ELSE COALESCE(w.membership_end, now() at time zone 'utc') END
+                        FROM wanted w
+                        ON CONFLICT (group_id, user_id) DO NOTHING
+                        RETURNING user_id
+                    ),
+                    changed AS (
+                        UPDATE group_members gm
+                        SET active = COALESCE(s.active, FALSE),
+                            ow_group_user_id = COALESCE(s.ow_user_id, gm.ow_group_user_id),
+                            inactive_at = CASE WHEN COALESCE(s.active, FALSE) THEN gm.inactive_at
+                                ELSE COALESCE(s.membership_end, now() at time zone 'utc') END
+                        FROM (
+                            SELECT m.user_id, w.ow_user_id, w.active, w.membership_end
+                            FROM group_members m
+                            LEFT JOIN wanted w ON w.user_id = m.user_id
+                            WHERE m.group_id = $1
+                        ) s
+                        WHERE gm.group_id = $1 AND gm.user_id = s.user_id
+                            AND gm.active IS DISTINCT FROM COALESCE(s.active, FALSE)
+                        RETURNING gm.user_id, gm.active
+                    ),
+                    desired AS (
+                        SELECT DISTINCT w.user_id, r.privilege
+                        FROM unnest($8::text[], $9::text[]) AS r(ow_user_id, privilege)
+                        JOIN wanted w ON w.ow_user_id = r.ow_user_id
+                    ),
+                    privileges_added AS (
+                        INSERT INTO group_member_permissions(group_id, user_id, privilege)
+                        SELECT $1, d.user_id, d.privilege FROM desired d
+                        ON CONFLICT (group_id, user_id, privilege) DO NOTHING
+                        RETURNING user_id, privilege
+                    ),
+                    privileges_removed AS (
+                        DELETE FROM group_member_permissions p
+                        WHERE p.group_id = $1 AND p.created_by IS NULL
+                            AND NOT EXISTS (
+                                SELECT 1 FROM desired d
+                                WHERE d.user_id = p.user_id AND d.privilege = p.privilege
+                            )
+                        RETURNING user_id, privilege
+                    )
+                    SELECT
+                        ARRAY(SELECT user_id FROM upserted) AS users_upserted,
+                        ARRAY(SELECT user_id FROM added) AS members_added,
+                        ARRAY(SELECT user_id FROM changed WHERE NOT active) AS members_deactivated,
+                        ARRAY(SELECT user_id FROM changed WHERE active) AS members_reactivated,
+                        ARRAY(SELECT (user_id, privilege) FROM privileges_added) AS privileges_added,
+                        ARRAY(SELECT (user_id, privilege) FROM privileges_removed) AS privileges_removed
+                    """
+
+            res = await conn.fetchrow(
+                query,
+                group_id,
+                [m.id for m in members],
+                [m.first_name for m in members],
+                [m.last_name for m in members],
+                [m.email for m in members],
+                [m.has_active_membership for m in members],
+                [m.membership_end for m in members],
+                [ow_user_id for ow_user_id, _ in privileges],
+                [privilege for _, privilege in privileges],
+            )
+
+        return {
+            "users_upserted": res["users_upserted"],
+            "members_added": res["members_added"],
+            "members_deactivated": res["members_deactivated"],
+            "members_reactivated": res["members_reactivated"],
+            "privileges_added": [tuple(r) for r in res["privileges_added"]],
+            "privileges_removed": [tuple(r) for r in res["privileges_removed"]],
+        }
+
     async def get_raw_punishments(
         self,
         group_id: GroupId,
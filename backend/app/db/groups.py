@@ -16,7 +16,7 @@ from app.models.group_member import GroupMember, GroupMemberCreate
 from app.models.punishment import TotalPunishmentValue
 from app.models.punishment_type import PunishmentTypeCreate, PunishmentTypeRead
 from app.types import GroupId, InsertOrUpdateGroup, OWUserId, UserId, InviteCode
-from app.utils.db import MaybeAcquire
+from app.utils.db import MaybeAcquire, read_only
 
 if TYPE_CHECKING:
     from app.db.core import Database
@@ -33,6 +33,7 @@ class Groups:
     def __init__(self, db: "Database") -> None:
         self.db = db
 
+    @read_only
     async def is_in_group(
         self,
         user_id: Union[UserId, OWUserId],
@@ -73,6 +74,7 @@ class Groups:
                 return False, False
             return res["is_ow_group"], res["is_group_member"]
 
+    @read_only
     async def is_in_any_ow_group(
         self,
         user_id: Union[UserId, OWUserId],
@@ -104,6 +106,7 @@ class Groups:
 
         return [GroupSearchResult(**row) for row in res]
 
+    @read_only
     async def get(
         self,
         group_id: GroupId,
@@ -289,7 +292,9 @@ class Groups:
     ) -> InsertOrUpdateGroup:
         async with MaybeAcquire(conn, self.db.pool) as conn:
             try:
-                return await self.db.groups.insert(group, created_by, conn=conn)
+                # Savepoint, so a conflict doesn't abort an outer transaction
+                async with conn.transaction():
+                    return await self.db.groups.insert(group, created_by, conn=conn)
             except DatabaseIntegrityException:
                 return await self.db.groups.update(group, conn=conn)
 
@@ -365,14 +370,48 @@ class Groups:
             query = "UPDATE groups SET invite_code = $1 WHERE group_id = $2"
             await conn.execute(query, invite_code, group_id)
 
+    async def get_recently_synced(
+        self,
+        ow_group_ids: list[str],
+        max_age: float,
+        conn: Optional[Pool] = None,
+    ) -> dict[str, datetime.datetime]:
+        """Returns when the given OW groups were last synced, for the ones synced
+        less than `max_age` seconds ago."""
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = """SELECT ow_group_id, ow_synced_at FROM groups
+                    WHERE ow_group_id = ANY($1)
+                        AND ow_synced_at > (now() at time zone 'utc') - make_interval(secs => $2)"""
+            res = await conn.fetch(query, ow_group_ids, max_age)
+            return {r["ow_group_id"]: r["ow_synced_at"] for r in res}
+
+    async def set_synced(
+        self,
+        group_id: GroupId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            query = """UPDATE groups SET ow_synced_at = (now() at time zone 'utc')
+                    WHERE group_id = $1"""
+            await conn.execute(query, group_id)
+
     async def delete(
         self,
         group_id: GroupId,
         conn: Optional[Pool] = None,
     ) -> None:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = "DELETE FROM groups WHERE group_id = $1 RETURNING *"
-            res = await conn.fetchval(query, group_id)
+            async with conn.transaction():
+                # Their aggregates of the group are deleted along with it
+                user_ids = await self.db.leaderboard.get_users_in_group(
+                    group_id, conn=conn
+                )
 
-            if res is None:
-                raise NotFound
+                query = "DELETE FROM groups WHERE group_id = $1 RETURNING *"
+                res = await conn.fetchval(query, group_id)
+
+                if res is None:
+                    raise NotFound
+
+                if user_ids:
+                    await self.db.leaderboard.refresh_totals(user_ids, conn=conn)
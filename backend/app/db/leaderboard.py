@@ -0,0 +1,316 @@
+"""
+Per-user punishment aggregates backing the leaderboard.
+
+`punishment_aggregates` sums the punishments of every user per punishment
+type and year. Punishment writes apply their changes to it in the same
+transaction, after which the `leaderboard_totals` of the affected users are
+recomputed from it. Values and emojis are read from the punishment types, so
+editing a type only has to refresh the totals of its users. Emojis are listed
+in the order the punishments were given.
+"""
+
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Optional
+
+from asyncpg import Pool, Record
+
+from app.types import GroupId, PunishmentTypeId, UserId
+from app.utils.db import MaybeAcquire
+
+if TYPE_CHECKING:
+    from app.db.core import Database
+
+
+# What the aggregates should be, straight from the punishments
+EXPECTED_AGGREGATES_QUERY = """
+    SELECT
+        user_id,
+        punishment_type_id,
+        EXTRACT(YEAR FROM created_at)::int AS year,
+        COUNT(*)::int AS punishments,
+        SUM(amount)::int AS amount,
+        SUM(CASE WHEN paid THEN amount ELSE 0 END)::int AS paid_amount
+    FROM group_punishments
+    {where}
+    GROUP BY 1, 2, 3
+"""
+
+# Totals per user and year, plus year 0 for all years together. The aggregates
+# don't keep the order of the punishments, so the emojis are listed from the
+# punishments themselves, in the order they were given.
+TOTALS_QUERY = """
+    WITH totals AS (
+        SELECT
+            a.user_id,
+            COALESCE(a.year, 0) AS year,
+            SUM(a.amount * pt.value) AS total_value,
+            SUM(a.paid_amount * pt.value) AS paid_value,
+            SUM((a.amount - a.paid_amount) * pt.value) AS unpaid_value,
+            SUM(a.amount) AS amount_punishments,
+            COUNT(DISTINCT a.punishment_type_id) AS amount_unique_punishments
+        FROM {aggregates} a
+        JOIN punishment_types pt ON pt.punishment_type_id = a.punishment_type_id
+        JOIN groups g ON g.group_id = pt.group_id
+        WHERE g.ow_group_id IS NOT NULL {and_where}
+        GROUP BY GROUPING SETS ((a.user_id, a.year), (a.user_id))
+    ),
+    emojis AS (
+        SELECT
+            a.user_id,
+            COALESCE(a.year, 0) AS year,
+            STRING_AGG(
+                REPEAT(pt.emoji, a.amount), '' ORDER BY a.created_at, a.punishment_id
+            ) AS emojis
+        FROM (
+            SELECT *, EXTRACT(YEAR FROM created_at)::int AS year
+            FROM group_punishments
+        ) a
+        JOIN punishment_types pt ON pt.punishment_type_id = a.punishment_type_id
+        JOIN groups g ON g.group_id = pt.group_id
+        WHERE g.ow_group_id IS NOT NULL {and_where}
+        GROUP BY GROUPING SETS ((a.user_id, a.year), (a.user_id))
+    )
+    SELECT
+        t.user_id,
+        t.year,
+        t.total_value,
+        t.paid_value,
+        t.unpaid_value,
+        COALESCE(e.emojis, '') AS emojis,
+        t.amount_punishments,
+        t.amount_unique_punishments
+    FROM totals t
+    LEFT JOIN emojis e ON e.user_id = t.user_id AND e.year = t.year
+"""
+
+TOTALS_COLUMNS = """user_id, year, total_value, paid_value, unpaid_value, emojis,
+    amount_punishments, amount_unique_punishments"""
+
+
+class PunishmentChange(NamedTuple):
+    user_id: UserId
+    punishment_type_id: PunishmentTypeId
+    year: int
+    punishments: int
+    amount: int
+    paid_amount: int
+
+
+def get_punishment_changes(
+    rows: Iterable[Record],
+    sign: int = 1,
+    paid_only: bool = False,
+) -> list[PunishmentChange]:
+    """Changes to the aggregates from written `group_punishments` rows.
+
+    `sign` is -1 for removed punishments or punishments marked as unpaid. With
+    `paid_only` only the paid amount changes, for punishments marked as paid
+    or unpaid.
+    """
+    return [
+        PunishmentChange(
+            user_id=row["user_id"],
+            punishment_type_id=row["punishment_type_id"],
+            year=row["created_at"].year,
+            punishments=0 if paid_only else sign,
+            amount=0 if paid_only else sign * row["amount"],
+            paid_amount=sign * row["amount"] if paid_only or row["paid"] else 0,
+        )
+        for row in rows
+    ]
+
+
+class Leaderboard:
+    def __init__(self, db: "Database"):
+        self.db = db
+
+    async def apply_changes(
+        self,
+        changes: list[PunishmentChange],
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Adds the changes to the aggregates and refreshes the totals of the
+        users. Run it in the transaction of the punishment write."""
+        if not changes:
+            return
+
+        user_ids = list({c.user_id for c in changes})
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            async with conn.transaction():
+                # Before the upsert, which locks the aggregates of the users in
+                # no particular order
+                await self.lock_users(user_ids, conn=conn)
+                await conn.execute(
+                    """INSERT INTO punishment_aggregates AS a
+                       (user_id, punishment_type_id, year, punishments, amount, paid_amount)
+                       SELECT c.user_id, c.punishment_type_id, c.year,
+                              SUM(c.punishments), SUM(c.amount), SUM(c.paid_amount)
+                       FROM unnest(
+                           $1::uuid[], $2::uuid[], $3::int[], $4::int[], $5::int[], $6::int[]
+                       ) AS c(user_id, punishment_type_id, year, punishments, amount, paid_amount)
+                       GROUP BY 1, 2, 3
+                       ON CONFLICT (user_id, punishment_type_id, year) DO UPDATE
+                       SET punishments = a.punishments + EXCLUDED.punishments,
+                           amount = a.amount + EXCLUDED.amount,
+                           paid_amount = a.paid_amount + EXCLUDED.paid_amount""",
+                    *(list(column) for column in zip(*changes)),
+                )
+                await conn.execute(
+                    """DELETE FROM punishment_aggregates
+                       WHERE user_id = ANY($1::uuid[]) AND punishments = 0""",
+                    user_ids,
+                )
+
+                await self.refresh_totals(user_ids, conn=conn)
+
+    async def refresh_totals(
+        self,
+        user_ids: list[UserId],
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Recomputes the totals of the users from their aggregates."""
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            async with conn.transaction():
+                await self.lock_users(user_ids, conn=conn)
+                await conn.execute(
+                    "DELETE FROM leaderboard_totals WHERE user_id = ANY($1::uuid[])",
+                    user_ids,
+                )
+                totals = TOTALS_QUERY.format(
+                    aggregates="punishment_aggregates",
+                    and_where="AND a.user_id = ANY($1::uuid[])",
+                )
+                await conn.execute(
+                    f"INSERT INTO leaderboard_totals ({TOTALS_COLUMNS}) {totals}",
+                    user_ids,
+                )
+
+    async def lock_users(
+        self,
+        user_ids: list[UserId],
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Makes writes to the aggregates and totals of the same user take
+        turns until commit, so the last one always sees the writes of the
+        others. Users are locked in order, so writes to several users can't
+        deadlock each other."""
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            await conn.execute(
+                """SELECT pg_advisory_xact_lock(hashtextextended(u::text, 0))
+                   FROM unnest($1::uuid[]) AS u""",
+                sorted(user_ids),
+            )
+
+    async def refresh_punishment_type(
+        self,
+        punishment_type_id: PunishmentTypeId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Refreshes the totals of everyone given the punishment type, after
+        its value or emoji changed."""
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            user_ids = await self.get_users_with_punishment_types(
+                [punishment_type_id], conn=conn
+            )
+            if user_ids:
+                await self.refresh_totals(user_ids, conn=conn)
+
+    async def get_users_with_punishment_types(
+        self,
+        punishment_type_ids: list[PunishmentTypeId],
+        conn: Optional[Pool] = None,
+    ) -> list[UserId]:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            rows = await conn.fetch(
+                """SELECT DISTINCT user_id FROM punishment_aggregates
+                   WHERE punishment_type_id = ANY($1::uuid[])""",
+                punishment_type_ids,
+            )
+        return [row["user_id"] for row in rows]
+
+    async def get_users_in_group(
+        self,
+        group_id: GroupId,
+        conn: Optional[Pool] = None,
+    ) -> list[UserId]:
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            rows = await conn.fetch(
+                """SELECT DISTINCT a.user_id FROM punishment_aggregates a
+                   JOIN punishment_types pt
+                       ON pt.punishment_type_id = a.punishment_type_id
+                   WHERE pt.group_id = $1""",
+                group_id,
+            )
+        return [row["user_id"] for row in rows]
+
+    async def rebuild(
+        self,
+        user_ids: Optional[list[UserId]] = None,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Recomputes the aggregates and totals from the punishments, of all
+        users or only the given ones."""
+        where, and_where, args = "", "", []
+        if user_ids is not None:
+            where = "WHERE user_id = ANY($1::uuid[])"
+            and_where = "AND a.user_id = ANY($1::uuid[])"
+            args = [user_ids]
+
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            async with conn.transaction():
+                # Punishment writes wait until the rebuild is done, and then
+                # apply their changes on top of it
+                await conn.execute(
+                    """LOCK TABLE punishment_aggregates, leaderboard_totals
+                       IN SHARE ROW EXCLUSIVE MODE"""
+                )
+
+                await conn.execute(f"DELETE FROM punishment_aggregates {where}", *args)
+                expected = EXPECTED_AGGREGATES_QUERY.format(where=where)
+                await conn.execute(
+                    f"""INSERT INTO punishment_aggregates
+                        (user_id, punishment_type_id, year, punishments, amount, paid_amount)
+                        {expected}""",
+                    *args,
+                )
+
+                await conn.execute(f"DELETE FROM leaderboard_totals {where}", *args)
+                totals = TOTALS_QUERY.format(
+                    aggregates="punishment_aggregates", and_where=and_where
+                )
+                await conn.execute(
+                    f"INSERT INTO leaderboard_totals ({TOTALS_COLUMNS}) {totals}",
+                    *args,
+                )
+
+    async def check(self, conn: Optional[Pool] = None) -> list[UserId]:
+        """Returns the users whose aggregates don't match their punishments,
+        or whose totals don't match their aggregates."""
+        expected = EXPECTED_AGGREGATES_QUERY.format(where="")
+        totals = TOTALS_QUERY.format(aggregates="punishment_aggregates", and_where="")
+        query = f"""
+            WITH expected AS ({expected}),
+            stored AS (
+                SELECT user_id, punishment_type_id, year, punishments, amount,
+                    paid_amount
+                FROM punishment_aggregates
+            ),
+            expected_totals AS ({totals}),
+            stored_totals AS (
+                SELECT {TOTALS_COLUMNS} FROM leaderboard_totals
+            )
+            SELECT user_id FROM (SELECT * FROM expected EXCEPT SELECT * FROM stored) d
+            UNION
+            SELECT user_id FROM (SELECT * FROM stored EXCEPT SELECT * FROM expected) d
+            UNION
+            SELECT user_id FROM (
+                SELECT * FROM expected_totals EXCEPT SELECT * FROM stored_totals
+            ) d
+            UNION
+            SELECT user_id FROM (
+                SELECT * FROM stored_totals EXCEPT SELECT * FROM expected_totals
+            ) d
+            ORDER BY user_id
+        """
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            rows = await conn.fetch(query)
+        return [row["user_id"] for row in rows]
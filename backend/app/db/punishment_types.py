@@ -86,24 +86,31 @@ class PunishmentTypes:
         conn: Optional[Pool] = None,
     ) -> PunishmentTypeRead:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = """UPDATE punishment_types SET
-                    name = $3,
-                    value = $4,
-                    emoji = $5,
-                    updated_at = $6
-                    WHERE group_id = $1 AND punishment_type_id = $2
-                    RETURNING *
-                    """
-
-            punishment_type = await conn.fetchrow(
-                query,
-                group_id,
-                punishment_type_id,
-                punishment_type.name.strip(),
-                punishment_type.value,
-                punishment_type.emoji,
-                datetime.utcnow(),
-            )
+            async with conn.transaction():
+                query = """UPDATE punishment_types SET
+                        name = $3,
+                        value = $4,
+                        emoji = $5,
+                        updated_at = $6
+                        WHERE group_id = $1 AND punishment_type_id = $2
+                        RETURNING *
+                        """
+
+                punishment_type = await conn.fetchrow(
+                    query,
+                    group_id,
+                    punishment_type_id,
+                    punishment_type.name.strip(),
+                    punishment_type.value,
+                    punishment_type.emoji,
+                    datetime.utcnow(),
+                )
+
+                if punishment_type is not None:
+                    # The value or emoji might have changed
+                    await self.db.leaderboard.refresh_punishment_type(
+                        punishment_type_id, conn=conn
+                    )
 
         if punishment_type is None:
             raise PunishmentTypeNotExists
@@ -117,12 +124,25 @@ class PunishmentTypes:
         conn: Optional[Pool] = None,
     ) -> None:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = "DELETE FROM punishment_types WHERE group_id = $1 AND punishment_type_id = $2 RETURNING *"
-            val = await conn.fetchval(
-                query,
-                group_id,
-                punishment_type_id,
-            )
-
-            if val is None:  # None = Nothing was deleted as it wasnt found
-                raise PunishmentTypeNotExists
+            async with conn.transaction():
+                # Their aggregates and punishments of the type are deleted
+                # along with it
+                user_ids = await self.db.leaderboard.get_users_with_punishment_types(
+                    [punishment_type_id], conn=conn
+                )
+
+                query = "DELETE FROM punishment_types WHERE group_id = $1 AND punishment_type_id = $2 RETURNING *"
+                val = await conn.fetchval(
+                    query,
+                    group_id,
+                    punishment_type_id,
+                )
+
+                if val is None:  # None = Nothing was deleted as it wasnt found
+                    raise PunishmentTypeNotExists
+
+                if user_ids:
+                    await self.db.leaderboard.refresh_totals(user_ids, conn=conn)
+                    await self.db.streaks.refresh(
+                        [(user_id, group_id) for user_id in user_ids], conn=conn
+                    )
@@ -1,14 +1,16 @@
 import datetime
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Any, Optional, Sequence
 
-from asyncpg import Pool
+from asyncpg import Pool, Record
 
+from app.db.leaderboard import get_punishment_changes
+from app.db.streaks import WEEK_EXPR
 from app.exceptions import NotFound
 from app.models.punishment import PunishmentCreate, PunishmentRead, TopStreaker
 from app.models.punishment_reaction import PunishmentReactionRead
 from app.models.user import LogPunishmentOut
 from app.types import GroupId, PunishmentId, UserId
-from app.utils.db import MaybeAcquire
+from app.utils.db import MaybeAcquire, estimate_count, read_only
 
 if TYPE_CHECKING:
     from app.db.core import Database
@@ -97,6 +99,7 @@ class Punishments:
 
         return "WHERE " + " AND ".join(conditions), params, extra_joins
 
+    @read_only
     async def get_all(
         self,
         offset: int,
@@ -106,10 +109,77 @@ class Punishments:
         date_to: Optional[datetime.date] = None,
         search: Optional[str] = None,
         conn: Optional[Pool] = None,
+        after: Optional[Sequence[Any]] = None,
+        backwards: bool = False,
     ) -> list[LogPunishmentOut]:
+        """Punishments from newest to oldest.
+
+        With `after`, a (created_at, punishment_id) key, it returns the
+        punishments after that one instead of skipping `offset` punishments,
+        or the ones before it if `backwards`.
+        """
+        res = await self._fetch_all(
+            offset,
+            limit,
+            group_id,
+            date_from,
+            date_to,
+            search,
+            conn=conn,
+            after=after,
+            backwards=backwards,
+        )
+        return [LogPunishmentOut(**r) for r in res]
+
+    @read_only
+    async def get_all_with_total(
+        self,
+        offset: int,
+        limit: int,
+        group_id: Optional[GroupId] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None,
+        search: Optional[str] = None,
+        conn: Optional[Pool] = None,
+    ) -> tuple[list[LogPunishmentOut], Optional[int]]:
+        """The page of punishments along with the number of punishments in
+        all pages, counted in the same query. The count is None for a page
+        past the last one."""
+        res = await self._fetch_all(
+            offset,
+            limit,
+            group_id,
+            date_from,
+            date_to,
+            search,
+            conn=conn,
+            with_total=True,
+        )
+        total = res[0]["full_count"] if res else None
+        return [LogPunishmentOut(**r) for r in res], total
+
+    async def _fetch_all(
+        self,
+        offset: int,
+        limit: int,
+        group_id: Optional[GroupId] = None,
+        date_from: Optional[datetime.date] = None,
+        date_to: Optional[datetime.date] = None,
+        search: Optional[str] = None,
+        conn: Optional[Pool] = None,
+        after: Optional[Sequence[Any]] = None,
+        backwards: bool = False,
+        with_total: bool = False,
+    ) -> list[Record]:
         async with MaybeAcquire(conn, self.db.pool) as conn:
             where_clause, params, extra_joins = self._build_where(group_id, date_from, date_to, search)
 
+            if after is not None:
+                params.extend(after)
+                op = ">" if backwards else "<"
+                where_clause += f" AND (gp.created_at, gp.punishment_id) {op} (${len(params) - 1}, ${len(params)})"
+            order = "ASC" if backwards else "DESC"
+
             params.append(offset)
             offset_param = f"${len(params)}"
             params.append(limit)
@@ -137,6 +207,7 @@ class Punishments:
                     'ow_user_id', given_to_user.ow_user_id
                 ) AS user,
                 g.name_short as group_name
+                {", COUNT(*) OVER () AS full_count" if with_total else ""}
             FROM group_punishments gp
             LEFT JOIN punishment_types pt
                 ON pt.punishment_type_id = gp.punishment_type_id
@@ -155,15 +226,19 @@ class Punishments:
             {extra_joins}
             {where_clause}
             GROUP BY gp.punishment_id, created_by_user.first_name, created_by_user.email, created_by_user.last_name, pt.punishment_type_id, given_to_user.user_id, g.name_short
-            ORDER BY gp.created_at DESC
+            ORDER BY gp.created_at {order}, gp.punishment_id {order}
             OFFSET {offset_param}
             LIMIT {limit_param}
             """
 
             res = await conn.fetch(query, *params)
 
-        return [LogPunishmentOut(**r) for r in res]
+        rows: list[Record] = list(res)
+        if backwards:
+            rows.reverse()
+        return rows
 
+    @read_only
     async def get_all_count(
         self,
         group_id: Optional[GroupId] = None,
@@ -171,17 +246,21 @@ class Punishments:
         date_to: Optional[datetime.date] = None,
         search: Optional[str] = None,
         conn: Optional[Pool] = None,
+        estimate: bool = False,
     ) -> int:
         async with MaybeAcquire(conn, self.db.pool) as conn:
             where_clause, params, extra_joins = self._build_where(group_id, date_from, date_to, search)
-            query = f"""
-                SELECT COUNT(*) FROM group_punishments gp
+            from_clause = f"""
+                FROM group_punishments gp
                 LEFT JOIN groups g ON gp.group_id = g.group_id
                 {extra_joins}
                 {where_clause}
                 """
 
-            res = await conn.fetchval(query, *params)
+            if estimate:
+                return await estimate_count(conn, f"SELECT 1 {from_clause}", *params)
+
+            res = await conn.fetchval(f"SELECT COUNT(*) {from_clause}", *params)
 
         return res
 
@@ -194,58 +273,64 @@ class Punishments:
         conn: Optional[Pool] = None,
     ) -> dict[str, list[PunishmentId]]:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = """INSERT INTO group_punishments(group_id,
-                                                     user_id,
-                                                     punishment_type_id,
-                                                     reason,
-                                                     reason_hidden,
-                                                     amount,
-                                                     created_by,
-                                                     created_at,
-                                                     paid,
-                                                     paid_at,
-                                                     marked_paid_by,
-                                                     legacy)
-                    (SELECT
-                        p.group_id,
-                        p.user_id,
-                        p.punishment_type_id,
-                        p.reason,
-                        p.reason_hidden,
-                        p.amount,
-                        p.created_by,
-                        p.created_at,
-                        p.paid,
-                        p.paid_at,
-                        p.marked_paid_by,
-                        p.legacy
-                    FROM
-                        unnest($1::group_punishments[]) as p
-                    )
-                    RETURNING punishment_id
-                    """
-            res = await conn.fetch(
-                query,
-                [
-                    (
-                        None,
-                        group_id,
-                        user_id,
-                        p.punishment_type_id,
-                        p.reason,
-                        p.reason_hidden,
-                        p.amount,
-                        datetime.datetime.utcnow(),
-                        created_by,
-                        False,
-                        None,
-                        None,
-                        p.legacy,
-                    )
-                    for p in punishments
-                ],
-            )
-            return {"ids": [r["punishment_id"] for r in res]}
+            async with conn.transaction():
+                query = """INSERT INTO group_punishments(group_id,
+                                                         user_id,
+                                                         punishment_type_id,
+                                                         reason,
+                                                         reason_hidden,
+                                                         amount,
+                                                         created_by,
+                                                         created_at,
+                                                         paid,
+                                                         paid_at,
+                                                         marked_paid_by,
+                                                         legacy)
+                        (SELECT
+                            p.group_id,
+                            p.user_id,
+                            p.punishment_type_id,
+                            p.reason,
+                            p.reason_hidden,
+                            p.amount,
+                            p.created_by,
+                            p.created_at,
+                            p.paid,
+                            p.paid_at,
+                            p.marked_paid_by,
+                            p.legacy
+                        FROM
+                            unnest($1::group_punishments[]) as p
+                        )
+                        RETURNING *
+                        """
+                res = await conn.fetch(
+                    query,
+                    [
+                        (
+                            None,
+                            group_id,
+                            user_id,
+                            p.punishment_type_id,
+                            p.reason,
+                            p.reason_hidden,
+                            p.amount,
+                            datetime.datetime.utcnow(),
+                            created_by,
+                            False,
+                            None,
+                            None,
+                            p.legacy,
+                        )
+                        for p in punishments
+                    ],
+                )
+                await self.db.leaderboard.apply_changes(
+                    get_punishment_changes(res), conn=conn
+                )
+                if res:
+                    await self.db.streaks.refresh([(user_id, group_id)], conn=conn)
+                return {"ids": [r["punishment_id"] for r in res]}
 
     async def delete(
         self,
@@ -253,11 +338,21 @@ class Punishments:
         conn: Optional[Pool] = None,
     ) -> None:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = "DELETE FROM group_punishments WHERE punishment_id = $1 RETURNING *"
-            res = await conn.fetchval(query, punishment_id)
+            async with conn.transaction():
+                query = (
+                    "DELETE FROM group_punishments WHERE punishment_id = $1 RETURNING *"
+                )
+                res = await conn.fetchrow(query, punishment_id)
 
-            if res is None:
-                raise NotFound
+                if res is None:
+                    raise NotFound
+
+                await self.db.leaderboard.apply_changes(
+                    get_punishment_changes([res], sign=-1), conn=conn
+                )
+                await self.db.streaks.refresh(
+                    [(res["user_id"], res["group_id"])], conn=conn
+                )
 
     async def mark_multiple_as_paid(
         self,
@@ -268,10 +363,16 @@ class Punishments:
     ) -> None:
         async with MaybeAcquire(conn, self.db.pool) as conn:
             async with conn.transaction():
-                query = """UPDATE group_punishments
+                query = """WITH old AS (
+                            SELECT punishment_id, paid FROM group_punishments
+                            WHERE group_id = $3 AND punishment_id = ANY($4::uuid[])
+                            FOR UPDATE
+                        )
+                        UPDATE group_punishments gp
                         SET paid = true, paid_at = $1, marked_paid_by = $2
-                        WHERE group_id = $3 AND punishment_id = ANY($4::uuid[])
-                        RETURNING *"""
+                        FROM old
+                        WHERE gp.punishment_id = old.punishment_id
+                        RETURNING gp.*, old.paid AS was_paid"""
                 res = await conn.fetch(
                     query,
                     datetime.datetime.utcnow(),
@@ -283,6 +384,13 @@ class Punishments:
                 if len(res) != len(punishment_ids):
                     raise NotFound
 
+                await self.db.leaderboard.apply_changes(
+                    get_punishment_changes(
+                        [r for r in res if not r["was_paid"]], paid_only=True
+                    ),
+                    conn=conn,
+                )
+
     async def mark_multiple_as_unpaid(
         self,
         group_id: GroupId,
@@ -291,10 +399,16 @@ class Punishments:
     ) -> None:
         async with MaybeAcquire(conn, self.db.pool) as conn:
             async with conn.transaction():
-                query = """UPDATE group_punishments
+                query = """WITH old AS (
+                            SELECT punishment_id, paid FROM group_punishments
+                            WHERE group_id = $1 AND punishment_id = ANY($2::uuid[])
+                            FOR UPDATE
+                        )
+                        UPDATE group_punishments gp
                         SET paid = false, paid_at = null, marked_paid_by = null
-                        WHERE group_id = $1 AND punishment_id = ANY($2::uuid[])
-                        RETURNING *"""
+                        FROM old
+                        WHERE gp.punishment_id = old.punishment_id
+                        RETURNING gp.*, old.paid AS was_paid"""
                 res = await conn.fetch(
                     query,
                     group_id,
@@ -304,6 +418,13 @@ class Punishments:
                 if len(res) != len(punishment_ids):
                     raise NotFound
 
+                await self.db.leaderboard.apply_changes(
+                    get_punishment_changes(
+                        [r for r in res if r["was_paid"]], sign=-1, paid_only=True
+                    ),
+                    conn=conn,
+                )
+
     async def mark_all_punishments_as_paid_for_user(
         self,
         group_id: GroupId,
@@ -312,70 +433,47 @@ class Punishments:
         conn: Optional[Pool] = None,
     ) -> None:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = """UPDATE group_punishments
-                    SET paid = true, paid_at = $1, marked_paid_by = $2
-                    WHERE group_id = $3 AND user_id = $4 AND paid = false
-                    RETURNING *"""
-            res = await conn.fetch(
-                query,
-                datetime.datetime.utcnow(),
-                marked_paid_by,
-                group_id,
-                user_id,
-            )
+            async with conn.transaction():
+                query = """UPDATE group_punishments
+                        SET paid = true, paid_at = $1, marked_paid_by = $2
+                        WHERE group_id = $3 AND user_id = $4 AND paid = false
+                        RETURNING *"""
+                res = await conn.fetch(
+                    query,
+                    datetime.datetime.utcnow(),
+                    marked_paid_by,
+                    group_id,
+                    user_id,
+                )
 
-            if len(res) == 0:
-                raise NotFound
+                if len(res) == 0:
+                    raise NotFound
 
+                await self.db.leaderboard.apply_changes(
+                    get_punishment_changes(res, paid_only=True), conn=conn
+                )
+
+    @read_only
     async def get_top_streakers(
         self,
         conn: Optional[Pool] = None,
     ) -> list[TopStreaker]:
+        """The longest current streaks of 3+ weeks in OW groups, where the
+        newest punished week is this week or the last."""
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            query = """
-            WITH punishment_weeks AS (
-                SELECT DISTINCT
-                    gp.user_id,
-                    gp.group_id,
-                    EXTRACT(EPOCH FROM date_trunc('week', gp.created_at AT TIME ZONE 'Europe/Oslo'))::bigint / 604800 AS abs_week
-                FROM group_punishments gp
-                JOIN groups g ON g.group_id = gp.group_id
-                WHERE g.ow_group_id IS NOT NULL
-            ),
-            ranked AS (
-                SELECT
-                    user_id,
-                    group_id,
-                    abs_week,
-                    abs_week + ROW_NUMBER() OVER (PARTITION BY user_id, group_id ORDER BY abs_week DESC) AS streak_group,
-                    ROW_NUMBER() OVER (PARTITION BY user_id, group_id ORDER BY abs_week DESC) AS rn
-                FROM punishment_weeks
-            ),
-            newest AS (
-                SELECT user_id, group_id, streak_group, abs_week
-                FROM ranked
-                WHERE rn = 1
-            ),
-            current_streaks AS (
-                SELECT
-                    r.user_id,
-                    r.group_id,
-                    COUNT(*) AS streak_length
-                FROM ranked r
-                JOIN newest n ON r.user_id = n.user_id AND r.group_id = n.group_id AND r.streak_group = n.streak_group
-                WHERE n.abs_week >= (EXTRACT(EPOCH FROM date_trunc('week', NOW() AT TIME ZONE 'Europe/Oslo'))::bigint / 604800) - 1
-                GROUP BY r.user_id, r.group_id
-                HAVING COUNT(*) >= 3
-            )
+            query = f"""
             SELECT
-                cs.user_id,
+                s.user_id,
                 TRIM(CONCAT(COALESCE(NULLIF(u.first_name, ''), u.email), ' ', u.last_name)) AS display_name,
                 g.name_short AS group_name,
-                cs.streak_length
-            FROM current_streaks cs
-            JOIN users u ON u.user_id = cs.user_id
-            JOIN groups g ON g.group_id = cs.group_id
-            ORDER BY cs.streak_length DESC
+                s.streak_length
+            FROM punishment_streaks s
+            JOIN users u ON u.user_id = s.user_id
+            JOIN groups g ON g.group_id = s.group_id
+            WHERE g.ow_group_id IS NOT NULL
+                AND s.streak_length >= 3
+                AND s.last_week >= {WEEK_EXPR.format("NOW()")} - 1
+            ORDER BY s.streak_length DESC
             LIMIT 3
             """
             res = await conn.fetch(query)
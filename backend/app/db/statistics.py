@@ -1,13 +1,14 @@
 from typing import Optional
 from asyncpg import Pool
 
-from app.utils.db import MaybeAcquire
+from app.utils.db import MaybeAcquire, read_only
 
 
 class Statistics:
     def __init__(self, db: "Database") -> None:
         self.db = db
 
+    @read_only
     async def get_all_group_statistics(
         self, gambling_only: bool = False, conn: Optional[Pool] = None
     ) -> dict[str, int]:
@@ -41,6 +42,7 @@ class Statistics:
                 return []
             return [dict(row) for row in res]
 
+    @read_only
     async def get_group_statistics(self, group_id: str, conn: Optional[Pool] = None):
         """
         Returns statistics about users in a group.
@@ -71,6 +73,7 @@ class Statistics:
                 return []
             return dict(res)
 
+    @read_only
     async def get_user_statistics(self, user_id: str, conn: Optional[Pool] = None):
         """
         Returns statistics about a user.
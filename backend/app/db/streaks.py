@@ -0,0 +1,133 @@
+"""
+Current punishment streaks backing the top streakers.
+
+`punishment_streaks` holds the newest run of consecutive weeks with
+punishments of every user in every group, ending in `last_week`. Punishment
+inserts and deletes recompute the streaks of their user and group in the same
+transaction, which only reads the punishments of that user in that group.
+Streaks end by time passing too, so readers compare `last_week` with the
+current week.
+"""
+
+from typing import TYPE_CHECKING, Optional
+
+from asyncpg import Pool
+
+from app.types import GroupId, UserId
+from app.utils.db import MaybeAcquire
+
+if TYPE_CHECKING:
+    from app.db.core import Database
+
+
+# Weeks since the epoch, starting on Mondays in Norwegian time
+WEEK_EXPR = "EXTRACT(EPOCH FROM date_trunc('week', {} AT TIME ZONE 'Europe/Oslo'))::bigint / 604800"
+
+# What the streaks should be, straight from the punishments. Weeks of the same
+# run share `week + ROW_NUMBER()`, which is `last_week + 1` for the newest run.
+EXPECTED_STREAKS_QUERY = f"""
+    SELECT user_id, group_id, last_week, COUNT(*)::int AS streak_length
+    FROM (
+        SELECT
+            user_id,
+            group_id,
+            week,
+            week + ROW_NUMBER() OVER (
+                PARTITION BY user_id, group_id ORDER BY week DESC
+            ) AS streak_group,
+            MAX(week) OVER (PARTITION BY user_id, group_id) AS last_week
+        FROM (
+            SELECT DISTINCT user_id, group_id, {WEEK_EXPR.format("created_at")} AS week
+            FROM group_punishments
+            {{where}}
+        ) w
+    ) r
+    WHERE streak_group = last_week + 1
+    GROUP BY user_id, group_id, last_week
+"""
+
+STREAKS_COLUMNS = "user_id, group_id, last_week, streak_length"
+
+# Matches the streaks of the given (user_id, group_id) pairs
+PAIRS_WHERE = "WHERE (user_id, group_id) IN (SELECT * FROM unnest($1::uuid[], $2::uuid[]))"
+
+
+class Streaks:
+    def __init__(self, db: "Database"):
+        self.db = db
+
+    async def refresh(
+        self,
+        pairs: list[tuple[UserId, GroupId]],
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Recomputes the streaks of the (user_id, group_id) pairs. Run it in
+        the transaction of the punishment write."""
+        if not pairs:
+            return
+
+        pairs = sorted(set(pairs))
+        user_ids, group_ids = (list(column) for column in zip(*pairs))
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            async with conn.transaction():
+                # Refreshes of the same streak take turns until commit, so the
+                # last one always sees the writes of the others
+                await conn.execute(
+                    """SELECT pg_advisory_xact_lock(
+                           hashtextextended(u::text || g::text, 0)
+                       )
+                       FROM unnest($1::uuid[], $2::uuid[]) AS p(u, g)""",
+                    user_ids,
+                    group_ids,
+                )
+                await conn.execute(
+                    f"DELETE FROM punishment_streaks {PAIRS_WHERE}",
+                    user_ids,
+                    group_ids,
+                )
+                expected = EXPECTED_STREAKS_QUERY.format(where=PAIRS_WHERE)
+                await conn.execute(
+                    f"INSERT INTO punishment_streaks ({STREAKS_COLUMNS}) {expected}",
+                    user_ids,
+                    group_ids,
+                )
+
+    async def rebuild(self, conn: Optional[Pool] = None) -> None:
+        """Recomputes all streaks from the punishments."""
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            async with conn.transaction():
+                # Punishment writes wait until the rebuild is done, and then
+                # refresh their streaks on top of it
+                await conn.execute(
+                    "LOCK TABLE punishment_streaks IN SHARE ROW EXCLUSIVE MODE"
+                )
+
+                await conn.execute("DELETE FROM punishment_streaks")
+                expected = EXPECTED_STREAKS_QUERY.format(where="")
+                await conn.execute(
+                    f"INSERT INTO punishment_streaks ({STREAKS_COLUMNS}) {expected}"
+                )
+
+    async def check(
+        self, conn: Optional[Pool] = None
+    ) -> list[tuple[UserId, GroupId]]:
+        """Returns the (user_id, group_id) pairs whose streaks don't match
+        their punishments."""
+        expected = EXPECTED_STREAKS_QUERY.format(where="")
+        query = f"""
+            WITH expected AS ({expected}),
+            stored AS (
+                SELECT {STREAKS_COLUMNS} FROM punishment_streaks
+            )
+            SELECT user_id, group_id FROM (
+                SELECT * FROM expected EXCEPT SELECT * FROM stored
+            ) d
+            UNION
+            SELECT user_id, group_id FROM (
+                SELECT * FROM stored EXCEPT SELECT * FROM expected
+            ) d
+            ORDER BY user_id, group_id
+        """
+        async with MaybeAcquire(conn, self.db.pool) as conn:
+            rows = await conn.fetch(query)
+        return [(row["user_id"], row["group_id"]) for row in rows]
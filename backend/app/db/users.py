@@ -1,6 +1,6 @@
-from typing import TYPE_CHECKING, Any, Optional, Union
+from typing import TYPE_CHECKING, Any, Optional, Sequence, Union
 
-from asyncpg import Pool
+from asyncpg import Pool, Record
 from asyncpg.exceptions import UniqueViolationError
 
 from app.exceptions import DatabaseIntegrityException, NotFound
@@ -13,7 +13,7 @@ from app.models.user import (
 )
 from app.models.punishment import LeaderboardPunishmentRead
 from app.types import InsertOrUpdateUser, OWUserId, UserId
-from app.utils.db import MaybeAcquire
+from app.utils.db import MaybeAcquire, estimate_count, read_only
 
 if TYPE_CHECKING:
     from app.db.core import Database
@@ -32,13 +32,24 @@ class Users:
             assert isinstance(res, int)
             return res
 
+    @read_only
     async def get_leaderboard_count(
         self,
         active_only: bool = True,
         conn: Optional[Pool] = None,
+        estimate: bool = False,
     ) -> int:
         async with MaybeAcquire(conn, self.db.pool) as conn:
             if active_only:
+                if estimate:
+                    return await estimate_count(
+                        conn,
+                        """SELECT DISTINCT user_id
+                           FROM group_members
+                           INNER JOIN groups ON group_members.group_id = groups.group_id
+                           WHERE (groups.ow_group_id IS NOT NULL OR groups.special)
+                               AND group_members.active = TRUE""",
+                    )
                 res = await conn.fetchval(
                     """SELECT
                             count(DISTINCT(user_id))
@@ -51,15 +62,12 @@ class Users:
                     """,
                 )
             else:
+                if estimate:
+                    return await estimate_count(
+                        conn, "SELECT 1 FROM leaderboard_totals WHERE year = 0"
+                    )
                 res = await conn.fetchval(
-                    """SELECT
-                            count(DISTINCT(gp.user_id))
-                        FROM
-                            group_punishments gp
-                            INNER JOIN groups ON gp.group_id = groups.group_id
-                        WHERE
-                            groups.ow_group_id IS NOT NULL;
-                    """,
+                    "SELECT COUNT(*) FROM leaderboard_totals WHERE year = 0"
                 )
             assert isinstance(res, int)
             return res
@@ -141,6 +149,11 @@ class Users:
                             user.ow_user_id,
                             old_ow_user_id,
                         )
+                        # Tokens resolved to the old OW user id no longer match the user
+                        if self.db.state is not None:
+                            await self.db.state.invalidate_ow_user_id(
+                                old_ow_user_id, conn=conn
+                            )
                     return {"id": user_id, "action": "UPDATE"}
                 raise DatabaseIntegrityException(detail=str(exc)) from exc
 
@@ -394,6 +407,16 @@ class Users:
             result = await conn.fetch(query, user_id)
             return [Group(**row) for row in result]
 
+    @staticmethod
+    def get_leaderboard_sort_column(
+        this_year: bool, year: Optional[int], sort_by: str
+    ) -> str:
+        column = "paid_value" if sort_by == "paid" else "total_value"
+        if this_year or year is not None:
+            return f"{column}_this_year"
+        return column
+
+    @read_only
     async def get_minified_leaderboard(
         self,
         this_year: bool,
@@ -403,120 +426,139 @@ class Users:
         offset: int,
         limit: int,
         conn: Optional[Pool] = None,
+        after: Optional[Sequence[Any]] = None,
+        backwards: bool = False,
     ) -> list[MinifiedLeaderboardUser]:
-        from datetime import date
+        """Users ordered by the sort column, then by first name and user id.
+
+        With `after`, a (sort value, first name, user id) key, it returns the
+        users after that one instead of skipping `offset` users, or the users
+        before it if `backwards`.
+        """
+        res = await self._fetch_minified_leaderboard(
+            this_year,
+            year,
+            active_only,
+            sort_by,
+            offset,
+            limit,
+            conn=conn,
+            after=after,
+            backwards=backwards,
+        )
+        return [MinifiedLeaderboardUser(**r) for r in res]
 
-        if year is not None:
-            year_start = date(year, 1, 1)
-            year_end = date(year + 1, 1, 1)
-        else:
-            year_start = None
-            year_end = None
+    @read_only
+    async def get_minified_leaderboard_with_total(
+        self,
+        this_year: bool,
+        year: Optional[int],
+        active_only: bool,
+        sort_by: str,
+        offset: int,
+        limit: int,
+        conn: Optional[Pool] = None,
+    ) -> tuple[list[MinifiedLeaderboardUser], Optional[int]]:
+        """The page of users along with the number of users on the whole
+        leaderboard, counted in the same query. The count is None for a page
+        past the last one."""
+        res = await self._fetch_minified_leaderboard(
+            this_year,
+            year,
+            active_only,
+            sort_by,
+            offset,
+            limit,
+            conn=conn,
+            with_total=True,
+        )
+        total = res[0]["full_count"] if res else None
+        return [MinifiedLeaderboardUser(**r) for r in res], total
 
+    async def _fetch_minified_leaderboard(
+        self,
+        this_year: bool,
+        year: Optional[int],
+        active_only: bool,
+        sort_by: str,
+        offset: int,
+        limit: int,
+        conn: Optional[Pool] = None,
+        after: Optional[Sequence[Any]] = None,
+        backwards: bool = False,
+        with_total: bool = False,
+    ) -> list[Record]:
         async with MaybeAcquire(conn, self.db.pool) as conn:
-            if year is not None:
-                year_filter = "p.created_at >= $3 AND p.created_at < $4"
-            else:
-                year_filter = "p.created_at >= DATE_TRUNC('year', CURRENT_DATE)"
-
-            punishment_subquery = f"""
-                SELECT
-                    p.user_id,
-                    SUM(pt.value * p.amount) AS total_value,
-                    SUM(CASE WHEN p.paid THEN pt.value * p.amount ELSE 0 END) AS paid_value,
-                    SUM(CASE WHEN NOT p.paid THEN pt.value * p.amount ELSE 0 END) AS unpaid_value,
-                    STRING_AGG(REPEAT(pt.emoji, p.amount), '') AS emojis,
-                    SUM(p.amount) AS amount_punishments,
-                    COUNT(DISTINCT p.punishment_type_id) AS amount_unique_punishments,
-                    SUM(CASE WHEN {year_filter} THEN pt.value * p.amount ELSE 0 END) AS total_value_this_year,
-                    SUM(CASE WHEN {year_filter} AND p.paid THEN pt.value * p.amount ELSE 0 END) AS paid_value_this_year,
-                    SUM(CASE WHEN {year_filter} AND NOT p.paid THEN pt.value * p.amount ELSE 0 END) AS unpaid_value_this_year,
-                    STRING_AGG(CASE WHEN {year_filter} THEN REPEAT(pt.emoji, p.amount) ELSE '' END, '') AS emojis_this_year,
-                    SUM(CASE WHEN {year_filter} THEN p.amount ELSE 0 END) AS amount_punishments_this_year,
-                    COUNT(DISTINCT CASE WHEN {year_filter} THEN p.punishment_type_id ELSE NULL END) AS amount_unique_punishments_this_year
-                FROM group_punishments p
-                LEFT JOIN punishment_types pt
-                    ON pt.punishment_type_id = p.punishment_type_id
-                LEFT JOIN groups g
-                    ON g.group_id = p.group_id
-                WHERE g.ow_group_id IS NOT NULL
-                GROUP BY p.user_id
-            """
-
+            # Totals are kept up to date per user in leaderboard_totals, with
+            # the totals of all years as year 0
             if active_only:
-                query = f"""
-                SELECT
-                    DISTINCT u.user_id,
-                    u.first_name,
-                    u.last_name,
-                    u.email,
-                    u.ow_user_id,
-                    COALESCE(p.total_value, 0) AS total_value,
-                    COALESCE(p.paid_value, 0) AS paid_value,
-                    COALESCE(p.unpaid_value, 0) AS unpaid_value,
-                    COALESCE(p.emojis, '') AS emojis,
-                    COALESCE(p.amount_punishments, 0) AS amount_punishments,
-                    COALESCE(p.amount_unique_punishments, 0) AS amount_unique_punishments,
-                    COALESCE(p.total_value_this_year, 0) AS total_value_this_year,
-                    COALESCE(p.paid_value_this_year, 0) AS paid_value_this_year,
-                    COALESCE(p.unpaid_value_this_year, 0) AS unpaid_value_this_year,
-                    COALESCE(p.emojis_this_year, '') AS emojis_this_year,
-                    COALESCE(p.amount_punishments_this_year, 0) AS amount_punishments_this_year,
-                    COALESCE(p.amount_unique_punishments_this_year, 0) AS amount_unique_punishments_this_year
-                FROM users u
-                LEFT JOIN ({punishment_subquery}) p ON p.user_id = u.user_id
-                LEFT JOIN group_members gm
-                    ON gm.user_id = u.user_id
-                LEFT JOIN groups g
-                    ON g.group_id = gm.group_id
-                WHERE (g.ow_group_id IS NOT NULL OR g.special)
-                    AND gm.active = TRUE
-                """
+                where_clause = """WHERE EXISTS (
+                        SELECT 1 FROM group_members gm
+                        JOIN groups g ON g.group_id = gm.group_id
+                        WHERE gm.user_id = u.user_id
+                            AND (g.ow_group_id IS NOT NULL OR g.special)
+                            AND gm.active = TRUE
+                    )"""
             else:
-                query = f"""
+                where_clause = "WHERE t.user_id IS NOT NULL"
+
+            query = f"""
                 SELECT
-                    DISTINCT u.user_id,
+                    u.user_id,
                     u.first_name,
                     u.last_name,
                     u.email,
                     u.ow_user_id,
-                    COALESCE(p.total_value, 0) AS total_value,
-                    COALESCE(p.paid_value, 0) AS paid_value,
-                    COALESCE(p.unpaid_value, 0) AS unpaid_value,
-                    COALESCE(p.emojis, '') AS emojis,
-                    COALESCE(p.amount_punishments, 0) AS amount_punishments,
-                    COALESCE(p.amount_unique_punishments, 0) AS amount_unique_punishments,
-                    COALESCE(p.total_value_this_year, 0) AS total_value_this_year,
-                    COALESCE(p.paid_value_this_year, 0) AS paid_value_this_year,
-                    COALESCE(p.unpaid_value_this_year, 0) AS unpaid_value_this_year,
-                    COALESCE(p.emojis_this_year, '') AS emojis_this_year,
-                    COALESCE(p.amount_punishments_this_year, 0) AS amount_punishments_this_year,
-                    COALESCE(p.amount_unique_punishments_this_year, 0) AS amount_unique_punishments_this_year
+                    COALESCE(t.total_value, 0) AS total_value,
+                    COALESCE(t.paid_value, 0) AS paid_value,
+                    COALESCE(t.unpaid_value, 0) AS unpaid_value,
+                    COALESCE(t.emojis, '') AS emojis,
+                    COALESCE(t.amount_punishments, 0) AS amount_punishments,
+                    COALESCE(t.amount_unique_punishments, 0) AS amount_unique_punishments,
+                    COALESCE(ty.total_value, 0) AS total_value_this_year,
+                    COALESCE(ty.paid_value, 0) AS paid_value_this_year,
+                    COALESCE(ty.unpaid_value, 0) AS unpaid_value_this_year,
+                    COALESCE(ty.emojis, '') AS emojis_this_year,
+                    COALESCE(ty.amount_punishments, 0) AS amount_punishments_this_year,
+                    COALESCE(ty.amount_unique_punishments, 0) AS amount_unique_punishments_this_year
+                    {", COUNT(*) OVER () AS full_count" if with_total else ""}
                 FROM users u
-                INNER JOIN (
-                    SELECT DISTINCT gp.user_id
-                    FROM group_punishments gp
-                    JOIN groups g ON g.group_id = gp.group_id
-                    WHERE g.ow_group_id IS NOT NULL
-                ) eligible ON eligible.user_id = u.user_id
-                LEFT JOIN ({punishment_subquery}) p ON p.user_id = u.user_id
+                LEFT JOIN leaderboard_totals t
+                    ON t.user_id = u.user_id AND t.year = 0
+                LEFT JOIN leaderboard_totals ty
+                    ON ty.user_id = u.user_id
+                    AND ty.year = COALESCE($3, EXTRACT(YEAR FROM CURRENT_DATE)::int)
+                {where_clause}
                 """
 
-            if sort_by == "paid":
-                sort_col = "paid_value_this_year" if (this_year or year is not None) else "paid_value"
+            sort_col = self.get_leaderboard_sort_column(this_year, year, sort_by)
+            params: list = [offset, limit, year]
+            if after is not None:
+                if sort_col.endswith("_this_year"):
+                    sort_expr = f"COALESCE(ty.{sort_col[:-len('_this_year')]}, 0)"
+                else:
+                    sort_expr = f"COALESCE(t.{sort_col}, 0)"
+                # Values descend, names and ids ascend
+                value_op, name_op = (">", "<") if backwards else ("<", ">")
+                query += f"""AND ({sort_expr} {value_op} $4 OR ({sort_expr} = $4
+                    AND (u.first_name, u.user_id) {name_op} ($5, $6))) """
+                params.extend(after)
+
+            if backwards:
+                # The rows right before the key, flipped back below
+                query += f"ORDER BY {sort_col} ASC, u.first_name DESC, u.user_id DESC "
             else:
-                sort_col = "total_value_this_year" if (this_year or year is not None) else "total_value"
-            query += f"ORDER BY {sort_col} DESC, u.first_name ASC "
+                query += f"ORDER BY {sort_col} DESC, u.first_name ASC, u.user_id ASC "
             query += "OFFSET $1 LIMIT $2"
 
-            params: list = [offset, limit]
-            if year is not None:
-                params.extend([year_start, year_end])
-
             res = await conn.fetch(query, *params)
 
-        return [MinifiedLeaderboardUser(**r) for r in res]
+        rows: list[Record] = list(res)
+        if backwards:
+            rows.reverse()
+        return rows
 
+    @read_only
     async def get_punishments_for_leaderboard_user(
         self,
         user_id: UserId,
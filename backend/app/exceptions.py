@@ -15,6 +15,10 @@ class NotAuthorizedException(OWException):
     pass
 
 
+class OWUnavailableException(OWException):
+    """OW failed to respond, or is not called since it keeps failing."""
+
+
 class DatabaseIntegrityException(VineyardException):
     def __init__(
         self,
@@ -29,6 +33,11 @@ class NotFound(VineyardException):
     pass
 
 
+class MultipleConnectionsAcquired(VineyardException):
+    """A request acquired a second pool connection while connection usage
+    was tracked strictly."""
+
+
 class PunishmentTypeNotExists(VineyardException):
     def __init__(self, **kwargs: Any) -> None:
         self.kwargs = kwargs
@@ -5,22 +5,39 @@ import json
 import os
 import asyncio
 import functools
-from typing import Any, Optional
-
-from aiohttp import ClientSession
+import time
+from contextlib import asynccontextmanager, contextmanager
+from types import SimpleNamespace
+from typing import Any, AsyncGenerator, AsyncIterator, Iterator, Optional, Union
+
+from aiohttp import (
+    ClientError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    TCPConnector,
+    TraceConfig,
+    TraceConnectionQueuedEndParams,
+    TraceConnectionQueuedStartParams,
+)
 from app.config import (
     settings,
 )
 from app.types import OWSyncGroup, OWSyncGroupMember, OWSyncUser
+from app.utils.circuit_breaker import CircuitBreaker
 from app.utils.date import parse_naive_datetime
+from app.utils.json_stream import iter_json_array
 
-from .exceptions import NotAuthorizedException
+from .exceptions import NotAuthorizedException, OWException, OWUnavailableException
 
 BASE_OLD_ONLINE = settings.ow4_base_url
 BASE_OW5 = settings.ow5_base_url
 
+# Size of the chunks streamed responses are read in
+STREAM_CHUNK_SIZE = 64 * 1024
 
-def create_trpc_input(value: str) -> str:
+
+def create_trpc_input(value: Any) -> str:
     payload = {"json": value}
     return json.dumps(payload)
 
@@ -38,6 +55,75 @@ def split_full_name(full_name: str) -> tuple[str, str]:
     return first_name, last_name
 
 
+def parse_ow_group(item: dict[str, Any]) -> OWSyncGroup:
+    return OWSyncGroup(
+        slug=item["slug"],
+        name=item["name"] if item["name"] is not None else item["abbreviation"],
+        type=item["type"],
+        imageUrl=item["imageUrl"],
+        abbreviation=item["abbreviation"],
+    )
+
+
+def parse_ow_user(item: dict[str, Any]) -> OWSyncUser:
+    full_name = item.get("name", "")
+    first_name, last_name = split_full_name(full_name)
+
+    return OWSyncUser(
+        id=item["id"],
+        email=item["email"],
+        first_name=first_name,
+        last_name=last_name,
+    )
+
+
+def parse_ow_group_members(raw: list[Any]) -> list[OWSyncGroupMember]:
+    now = datetime.datetime.now()
+
+    ow_users: list[OWSyncGroupMember] = []
+    for _, user in raw:
+        roles = [
+            role["type"]
+            for membership in user["groupMemberships"]
+            for role in membership["roles"]
+            if (membership["end"] is None)
+            or (parse_naive_datetime(membership["end"]) > now)
+        ]
+
+        has_active_group_membership = any(
+            (gm["end"] is None) or (parse_naive_datetime(gm["end"]) > now)
+            for gm in user["groupMemberships"]
+        )
+
+        # Get the most recent membership end date for inactive members
+        membership_end: Optional[datetime.datetime] = None
+        if not has_active_group_membership:
+            end_dates = [
+                parse_naive_datetime(gm["end"])
+                for gm in user["groupMemberships"]
+                if gm["end"] is not None
+            ]
+            if end_dates:
+                membership_end = max(end_dates)
+
+        full_name = user.get("name", "")
+        first_name, last_name = split_full_name(full_name)
+
+        ow_user = OWSyncGroupMember(
+            id=user["id"],
+            email=user["email"],
+            first_name=first_name,
+            last_name=last_name,
+            roles=roles,
+            has_active_membership=has_active_group_membership,
+            membership_end=membership_end,
+        )
+
+        ow_users.append(ow_user)
+
+    return ow_users
+
+
 def create_aiohttp_closed_event(session: ClientSession) -> asyncio.Event:
     """Work around aiohttp issue that doesn't properly close transports on exit.
     See https://github.com/aio-libs/aiohttp/issues/1925#issuecomment-639080209
@@ -92,11 +178,124 @@ def create_aiohttp_closed_event(session: ClientSession) -> asyncio.Event:
     return all_is_lost
 
 
+class ConnectionPoolStats:
+    """Keeps track of how the connections of a session are used.
+
+    aiohttp has no public API for the current state of its pool, so requests
+    are counted from the time they're sent until their response is released.
+    Those not waiting for a connection hold one.
+    """
+
+    def __init__(self) -> None:
+        self.created = 0
+        self.reused = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._in_flight = 0
+        self._waiting = 0
+
+    @contextmanager
+    def track_request(self) -> Iterator[None]:
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+
+    def create_trace_config(self) -> TraceConfig:
+        trace_config = TraceConfig()
+        trace_config.on_connection_create_end.append(self._on_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_reuseconn)
+        # The signal types of aiohttp don't match the callbacks it calls
+        trace_config.on_connection_queued_start.append(
+            self._on_queued_start  # type: ignore[arg-type]
+        )
+        trace_config.on_connection_queued_end.append(
+            self._on_queued_end  # type: ignore[arg-type]
+        )
+        return trace_config
+
+    async def _on_create_end(self, *args: Any) -> None:
+        self.created += 1
+
+    async def _on_reuseconn(self, *args: Any) -> None:
+        self.reused += 1
+
+    async def _on_queued_start(
+        self,
+        session: ClientSession,
+        ctx: SimpleNamespace,
+        params: TraceConnectionQueuedStartParams,
+    ) -> None:
+        self.queued += 1
+        self._waiting += 1
+        ctx.queued_at = time.perf_counter()
+
+    async def _on_queued_end(
+        self,
+        session: ClientSession,
+        ctx: SimpleNamespace,
+        params: TraceConnectionQueuedEndParams,
+    ) -> None:
+        self._waiting -= 1
+        waited = time.perf_counter() - ctx.queued_at
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "in_use": self._in_flight - self._waiting,
+            "waiting": self._waiting,
+            "created": self.created,
+            "reused": self.reused,
+            "queued": self.queued,
+            "wait_time_ms": round(self.wait_time * 1000),
+            "max_wait_time_ms": round(self.max_wait_time * 1000),
+        }
+
+
 class HTTPClient:
     _session: ClientSession
 
+    def __init__(
+        self,
+        limit: int = settings.ow_http_limit,
+        limit_per_host: int = settings.ow_http_limit_per_host,
+        keepalive_timeout: float = settings.ow_http_keepalive_timeout,
+        dns_cache_ttl: int = settings.ow_http_dns_cache_ttl,
+        connect_timeout: float = settings.ow_http_connect_timeout,
+        read_timeout: float = settings.ow_http_read_timeout,
+        total_timeout: float = settings.ow_http_total_timeout,
+        failure_threshold: int = settings.ow_circuit_breaker_failure_threshold,
+        reset_timeout: float = settings.ow_circuit_breaker_reset_timeout,
+        batch_size: int = settings.ow_batch_size,
+    ) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.batch_size = batch_size
+        self.timeout = ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_read=read_timeout,
+        )
+        self.pool_stats = ConnectionPoolStats()
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
     async def async_init(self) -> None:
-        self._session = ClientSession()
+        connector = TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        self._session = ClientSession(
+            connector=connector,
+            timeout=self.timeout,
+            trace_configs=[self.pool_stats.create_trace_config()],
+        )
 
     async def close(self) -> None:
         if self._session is not None:
@@ -108,12 +307,53 @@ class HTTPClient:
             except asyncio.TimeoutError:
                 pass
 
+    @asynccontextmanager
+    async def _get(
+        self,
+        url: str,
+        access_token: str,
+    ) -> AsyncIterator[ClientResponse]:
+        """Sends a GET request to OW through the circuit breaker.
+
+        Raises OWUnavailableException without sending anything while the
+        circuit is open. Connection errors, timeouts and 5xx responses count
+        as failures, also while the caller reads the body. The request only
+        counts as a success once the caller is done with the response.
+        """
+        breaker = self.circuit_breaker
+        if not breaker.allow_request():
+            raise OWUnavailableException("OW circuit breaker is open")
+
+        recorded = False
+        try:
+            with self.pool_stats.track_request():
+                async with self._session.get(
+                    url,
+                    headers={"Authorization": f"Bearer {access_token}"},
+                ) as response:
+                    if response.status >= 500:
+                        raise OWUnavailableException(
+                            f"OW responded with {response.status}"
+                        )
+
+                    yield response
+
+            breaker.record_success()
+            recorded = True
+        except (ClientError, asyncio.TimeoutError, OWUnavailableException):
+            breaker.record_failure()
+            recorded = True
+            raise
+        finally:
+            if not recorded:
+                breaker.release()
+
     async def get_ow_profile_by_access_token(
         self, access_token: str
     ) -> Optional[OWSyncUser]:
-        async with self._session.get(
+        async with self._get(
             f"{BASE_OW5}/user.getMe",
-            headers={"Authorization": f"Bearer {access_token}"},
+            access_token,
         ) as response:
             if response.status == 401 or response.status == 404:
                 return None
@@ -138,9 +378,9 @@ class HTTPClient:
     async def get_ow_groups_by_user_id(self, user_id: str, access_token: str) -> list[OWSyncGroup]:
         input = create_trpc_input({"userId": user_id})
 
-        async with self._session.get(
+        async with self._get(
             f"{BASE_OW5}/group.allByMember?input={input}",
-            headers={"Authorization": f"Bearer {access_token}"},
+            access_token,
         ) as response:
             data = await response.json()
 
@@ -149,27 +389,28 @@ class HTTPClient:
             if raw is None:
                 return []
 
-            return [
-                OWSyncGroup(
-                    slug=item["slug"],
-                    name=(
-                        item["name"]
-                        if item["name"] is not None
-                        else item["abbreviation"]
-                    ),
-                    type=item["type"],
-                    imageUrl=item["imageUrl"],
-                    abbreviation=item["abbreviation"],
-                )
-                for item in raw
-            ]
+            return [parse_ow_group(item) for item in raw]
+
+    async def get_all_ow_groups(self, access_token: str) -> list[OWSyncGroup]:
+        async with self._get(
+            f"{BASE_OW5}/group.all",
+            access_token,
+        ) as response:
+            data = await response.json()
+
+            raw = data.get("result", {}).get("data", {}).get("json", {})
+
+            if raw is None:
+                return []
+
+            return [parse_ow_group(item) for item in raw]
 
     async def get_ow_group_users(self, group_id: str, access_token: str) -> list[OWSyncGroupMember]:
         input = create_trpc_input(group_id)
 
-        async with self._session.get(
+        async with self._get(
             f"{BASE_OW5}/group.getMembers?input={input}",
-            headers={"Authorization": f"Bearer {access_token}"},
+            access_token,
         ) as response:
             if response.status == 404:
                 return []
@@ -181,82 +422,170 @@ class HTTPClient:
             if raw is None:
                 return []
 
-            now = datetime.datetime.now()
-
-            ow_users: list[OWSyncGroupMember] = []
-            for _, user in raw:
-                roles = [
-                    role["type"]
-                    for membership in user["groupMemberships"]
-                    for role in membership["roles"]
-                    if (membership["end"] is None)
-                    or (parse_naive_datetime(membership["end"]) > now)
-                ]
-
-                has_active_group_membership = any(
-                    (gm["end"] is None) or (parse_naive_datetime(gm["end"]) > now)
-                    for gm in user["groupMemberships"]
-                )
-
-                # Get the most recent membership end date for inactive members
-                membership_end: Optional[datetime.datetime] = None
-                if not has_active_group_membership:
-                    end_dates = [
-                        parse_naive_datetime(gm["end"])
-                        for gm in user["groupMemberships"]
-                        if gm["end"] is not None
-                    ]
-                    if end_dates:
-                        membership_end = max(end_dates)
-
-                full_name = user.get("name", "")
-                first_name, last_name = split_full_name(full_name)
-
-                ow_user = OWSyncGroupMember(
-                    id=user["id"],
-                    email=user["email"],
-                    first_name=first_name,
-                    last_name=last_name,
-                    roles=roles,
-                    has_active_membership=has_active_group_membership,
-                    membership_end=membership_end,
-                )
-
-                ow_users.append(ow_user)
-
-            return ow_users
-
-    async def get_all_ow_users(self, access_token: str) -> Optional[list[OWSyncUser]]:
-        input = create_trpc_input({"take": 10000000})
+            return parse_ow_group_members(raw)
+
+    async def get_ow_groups_users(
+        self,
+        group_ids: list[str],
+        access_token: str,
+    ) -> dict[str, list[OWSyncGroupMember]]:
+        """Fetches the members of several groups using tRPC batch calls.
+
+        Groups that don't exist in OW get no members, any other error in the
+        batch raises OWException.
+        """
+        batches = [
+            group_ids[i : i + self.batch_size]
+            for i in range(0, len(group_ids), self.batch_size)
+        ]
+        results = await asyncio.gather(
+            *(self._get_ow_groups_users_batch(b, access_token) for b in batches)
+        )
+        return {k: v for result in results for k, v in result.items()}
+
+    async def _get_ow_groups_users_batch(
+        self,
+        group_ids: list[str],
+        access_token: str,
+    ) -> dict[str, list[OWSyncGroupMember]]:
+        procedures = ",".join("group.getMembers" for _ in group_ids)
+        input = json.dumps({str(i): {"json": g} for i, g in enumerate(group_ids)})
+
+        async with self._get(
+            f"{BASE_OW5}/{procedures}?batch=1&input={input}",
+            access_token,
+        ) as response:
+            data = await response.json()
 
-        async with self._session.get(
+        # The whole batch failed, e.g. because the token is not valid
+        if not isinstance(data, list):
+            raise OWException(f"Batch request failed with status {response.status}")
+
+        members: dict[str, list[OWSyncGroupMember]] = {}
+        for group_id, item in zip(group_ids, data):
+            error = item.get("error")
+            if error is not None:
+                error_data = error.get("json", {}).get("data", {})
+                if error_data.get("httpStatus") == 404:
+                    members[group_id] = []
+                    continue
+
+                message = error.get("json", {}).get("message")
+                raise OWException(f"Fetching members of {group_id} failed: {message}")
+
+            raw = item.get("result", {}).get("data", {}).get("json", {})
+            members[group_id] = parse_ow_group_members(raw) if raw is not None else []
+
+        return members
+
+    async def get_ow_users_page(
+        self,
+        access_token: str,
+        take: int,
+        cursor: Optional[str] = None,
+    ) -> tuple[list[OWSyncUser], Optional[str]]:
+        """Returns a page of OW users and the cursor of the next page, which is
+        None for the last page.
+
+        Raises NotAuthorizedException if the token is not allowed to list users.
+        """
+        payload: dict[str, Any] = {"take": take}
+        if cursor is not None:
+            payload["cursor"] = cursor
+        input = create_trpc_input(payload)
+
+        async with self._get(
             f"{BASE_OW5}/user.all?input={input}",
-            headers={"Authorization": f"Bearer {access_token}"},
+            access_token,
         ) as response:
             if response.status == 401 or response.status == 404:
-                return None
+                raise NotAuthorizedException
 
             data = await response.json()
 
-            raw = (
-                data.get("result", {}).get("data", {}).get("json", {}).get("items", [])
-            )
+            raw = data.get("result", {}).get("data", {}).get("json", {})
 
             if raw is None:
-                return []
+                return [], None
+
+            items = raw.get("items") or []
+            return [parse_ow_user(item) for item in items], raw.get("nextCursor")
+
+    async def iter_all_ow_users(
+        self,
+        access_token: str,
+        page_size: int = settings.ow_users_page_size,
+        prefetch_pages: int = settings.ow_users_prefetch_pages,
+    ) -> AsyncGenerator[OWSyncUser, None]:
+        """Yields all OW users, fetching the next pages while the current one is
+        being consumed.
+
+        Every page needs the cursor of the one before it, so there is only one
+        request in flight at a time and at most `prefetch_pages` pages waiting
+        to be consumed. Raises NotAuthorizedException if the token is not
+        allowed to list users.
+        """
+        if page_size <= 0:
+            async for user in self.stream_all_ow_users(access_token):
+                yield user
+            return
+
+        pages: asyncio.Queue[Union[list[OWSyncUser], BaseException, None]]
+        pages = asyncio.Queue(maxsize=max(prefetch_pages, 1))
+
+        async def fetch_pages() -> None:
+            cursor = None
+            try:
+                while True:
+                    users, cursor = await self.get_ow_users_page(
+                        access_token, page_size, cursor
+                    )
+                    await pages.put(users)
+                    if cursor is None or not users:
+                        break
+            except Exception as e:  # pylint: disable=broad-except
+                await pages.put(e)
+            else:
+                await pages.put(None)
+
+        task = asyncio.create_task(fetch_pages())
+        try:
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                if isinstance(page, BaseException):
+                    raise page
+
+                for user in page:
+                    yield user
+        finally:
+            task.cancel()
+
+    async def stream_all_ow_users(self, access_token: str) -> AsyncIterator[OWSyncUser]:
+        """Yields all OW users from a single request while the response is
+        still being received.
 
-            ow_users: list[OWSyncUser] = []
+        Raises NotAuthorizedException if the token is not allowed to list users.
+        """
+        input = create_trpc_input({"take": 10000000})
 
-            for data in raw:
-                full_name = data.get("name", "")
-                first_name, last_name = split_full_name(full_name)
+        async with self._get(
+            f"{BASE_OW5}/user.all?input={input}",
+            access_token,
+        ) as response:
+            if response.status == 401 or response.status == 404:
+                raise NotAuthorizedException
 
-                ow_user = OWSyncUser(
-                    id=data["id"],
-                    email=data["email"],
-                    first_name=first_name,
-                    last_name=last_name,
-                )
-                ow_users.append(ow_user)
+            items = iter_json_array(
+                response.content.iter_chunked(STREAM_CHUNK_SIZE),
+                ["result", "data", "json", "items"],
+            )
+            async for data in items:
+                yield parse_ow_user(data)
 
-            return ow_users
+    async def get_all_ow_users(self, access_token: str) -> Optional[list[OWSyncUser]]:
+        try:
+            return [u async for u in self.iter_all_ow_users(access_token)]
+        except NotAuthorizedException:
+            return None
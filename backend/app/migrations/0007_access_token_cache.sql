@@ -0,0 +1,9 @@
+-- Shared access token cache. Unlogged since it can always be rebuilt from OW.
+CREATE UNLOGGED TABLE IF NOT EXISTS access_token_cache (
+	access_token_hash TEXT PRIMARY KEY,
+	user_id uuid NOT NULL references users(user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+	ow_user_id TEXT NOT NULL,
+	expires_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS access_token_cache_ow_user_id_idx ON access_token_cache (ow_user_id);
@@ -0,0 +1 @@
+ALTER TABLE groups ADD COLUMN ow_synced_at TIMESTAMP WITHOUT TIME ZONE;
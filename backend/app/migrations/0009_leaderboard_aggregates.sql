@@ -0,0 +1,34 @@
+-- Punishments summed per user, punishment type and year of creation. Kept up
+-- to date by the punishment writes in app/db/punishments.py.
+CREATE TABLE IF NOT EXISTS punishment_aggregates (
+	user_id uuid NOT NULL references users(user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+	punishment_type_id uuid NOT NULL references punishment_types(punishment_type_id) ON DELETE CASCADE ON UPDATE CASCADE,
+	year INTEGER NOT NULL,
+	punishments INTEGER NOT NULL,
+	amount INTEGER NOT NULL,
+	paid_amount INTEGER NOT NULL,
+	PRIMARY KEY (user_id, punishment_type_id, year)
+);
+
+CREATE INDEX IF NOT EXISTS punishment_aggregates_punishment_type_id_idx ON punishment_aggregates (punishment_type_id);
+
+-- Leaderboard columns per user, from the aggregates of OW groups. Year 0 holds
+-- the totals of all years.
+CREATE TABLE IF NOT EXISTS leaderboard_totals (
+	user_id uuid NOT NULL references users(user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+	year INTEGER NOT NULL,
+	total_value BIGINT NOT NULL,
+	paid_value BIGINT NOT NULL,
+	unpaid_value BIGINT NOT NULL,
+	emojis TEXT NOT NULL,
+	amount_punishments BIGINT NOT NULL,
+	amount_unique_punishments BIGINT NOT NULL,
+	PRIMARY KEY (user_id, year)
+);
+
+CREATE INDEX IF NOT EXISTS leaderboard_totals_total_value_idx ON leaderboard_totals (year, total_value DESC);
+CREATE INDEX IF NOT EXISTS leaderboard_totals_paid_value_idx ON leaderboard_totals (year, paid_value DESC);
+
+INSERT INTO punishment_aggregates (user_id, punishment_type_id, year, punishments, amount, paid_amount) SELECT user_id, punishment_type_id, EXTRACT(YEAR FROM created_at)::int, COUNT(*), SUM(amount), SUM(CASE WHEN paid THEN amount ELSE 0 END) FROM group_punishments GROUP BY 1, 2, 3 ON CONFLICT DO NOTHING;
+
+INSERT INTO leaderboard_totals SELECT a.user_id, COALESCE(a.year, 0), SUM(a.amount * pt.value), SUM(a.paid_amount * pt.value), SUM((a.amount - a.paid_amount) * pt.value), STRING_AGG(REPEAT(pt.emoji, a.amount), '' ORDER BY pt.created_at, pt.punishment_type_id), SUM(a.amount), COUNT(DISTINCT a.punishment_type_id) FROM punishment_aggregates a JOIN punishment_types pt ON pt.punishment_type_id = a.punishment_type_id JOIN groups g ON g.group_id = pt.group_id WHERE g.ow_group_id IS NOT NULL GROUP BY GROUPING SETS ((a.user_id, a.year), (a.user_id)) ON CONFLICT DO NOTHING;
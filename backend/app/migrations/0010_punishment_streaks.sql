@@ -0,0 +1,17 @@
+-- The newest run of consecutive punished weeks per user and group, ending in
+-- `last_week`. Weeks are counted from the epoch. Kept up to date by the
+-- punishment writes in app/db/punishments.py.
+CREATE TABLE IF NOT EXISTS punishment_streaks (
+	user_id uuid NOT NULL references users(user_id) ON DELETE CASCADE ON UPDATE CASCADE,
+	group_id uuid NOT NULL references groups(group_id) ON DELETE CASCADE ON UPDATE CASCADE,
+	last_week BIGINT NOT NULL,
+	streak_length INTEGER NOT NULL,
+	PRIMARY KEY (user_id, group_id)
+);
+
+CREATE INDEX IF NOT EXISTS punishment_streaks_streak_length_idx ON punishment_streaks (streak_length DESC);
+
+-- Streaks are refreshed from the punishments of one user in one group
+CREATE INDEX IF NOT EXISTS group_punishments_user_id_group_id_idx ON group_punishments (user_id, group_id);
+
+INSERT INTO punishment_streaks (user_id, group_id, last_week, streak_length) SELECT user_id, group_id, last_week, COUNT(*) FROM (SELECT user_id, group_id, week, week + ROW_NUMBER() OVER (PARTITION BY user_id, group_id ORDER BY week DESC) AS streak_group, MAX(week) OVER (PARTITION BY user_id, group_id) AS last_week FROM (SELECT DISTINCT user_id, group_id, EXTRACT(EPOCH FROM date_trunc('week', created_at AT TIME ZONE 'Europe/Oslo'))::bigint / 604800 AS week FROM group_punishments) w) r WHERE streak_group = last_week + 1 GROUP BY user_id, group_id, last_week ON CONFLICT DO NOTHING;
@@ -0,0 +1,339 @@
+"""Runs OW syncs in the background instead of inside request handlers."""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Optional,
+)
+
+import sentry_sdk
+from asyncpg import Pool
+
+from .config import settings
+from .exceptions import OWUnavailableException
+from .types import OWUserId, UserId
+from .utils.cache import LRUCache
+
+if TYPE_CHECKING:
+    from .sync import OWSync
+
+logger = logging.getLogger(__name__)
+
+# How long we remember when something was last synced
+SYNC_STATE_TTL = 24 * 60 * 60
+
+
+class SyncJob:
+    def __init__(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Optional[bool]]],
+    ) -> None:
+        self.key = key
+        self.func = func
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+
+class JobQueue:
+    """Runs jobs on a fixed number of worker tasks.
+
+    Jobs are deduplicated by key while they are waiting to be run, and a job is
+    never started more often than once every `min_interval` seconds. Jobs that
+    raise are reported to Sentry, jobs returning False have failed but already
+    reported it themselves. The futures returned by `schedule` never raise.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        workers: int,
+        min_interval: float = 0,
+        max_keys: int = settings.sync_state_max_size,
+    ) -> None:
+        self.name = name
+        self.workers = workers
+        self.min_interval = min_interval
+
+        self._queue: asyncio.Queue[SyncJob] = asyncio.Queue()
+        self._jobs: dict[Hashable, SyncJob] = {}
+        self._delayed: dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks: list[asyncio.Task[None]] = []
+
+        # Monotonic time of the last start and wall clock time of the last
+        # successful completion for each key.
+        self.last_started: LRUCache[Hashable, float] = LRUCache(
+            max_size=max_keys,
+            default_ttl=SYNC_STATE_TTL,
+            clock=time.monotonic,
+        )
+        self.last_succeeded: LRUCache[Hashable, float] = LRUCache(
+            max_size=max_keys,
+            default_ttl=SYNC_STATE_TTL,
+        )
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            self._tasks.append(
+                asyncio.create_task(self._worker(), name=f"{self.name}-worker-{i}")
+            )
+
+    async def close(self) -> None:
+        for handle in self._delayed.values():
+            handle.cancel()
+        self._delayed.clear()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+        for job in self._jobs.values():
+            job.future.cancel()
+        self._jobs.clear()
+
+    def schedule(
+        self,
+        key: Hashable,
+        func: Callable[[], Awaitable[Optional[bool]]],
+    ) -> "asyncio.Future[None]":
+        """Schedules a job unless one with the same key is already waiting.
+
+        If the job is held back by `min_interval` the returned future is
+        already done, since the key was synced a moment ago anyway.
+        """
+        job = self._jobs.get(key)
+        if job is not None:
+            return job.future if key not in self._delayed else _done_future()
+
+        job = SyncJob(key, func)
+        self._jobs[key] = job
+
+        delay = 0.0
+        last_started = self.last_started.get(key)
+        if last_started is not None:
+            delay = last_started + self.min_interval - time.monotonic()
+
+        if delay > 0:
+            self._delayed[key] = asyncio.get_running_loop().call_later(
+                delay, self._enqueue_delayed, job
+            )
+            return _done_future()
+
+        self._queue.put_nowait(job)
+        return job.future
+
+    def _enqueue_delayed(self, job: SyncJob) -> None:
+        self._delayed.pop(job.key, None)
+        self._queue.put_nowait(job)
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._queue.get()
+
+            # New requests for this key now need a new run
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+            self.last_started.set(job.key, time.monotonic())
+
+            try:
+                succeeded = await job.func()
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except OWUnavailableException as e:
+                # Already known, no need to report every job that hits it
+                logger.info("%s job %s skipped: %s", self.name, job.key, e)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.exception("%s job %s failed", self.name, job.key)
+                sentry_sdk.capture_exception(e)
+            else:
+                if succeeded is not False:
+                    self.last_succeeded.set(job.key, time.time())
+            finally:
+                if not job.future.done():
+                    job.future.set_result(None)
+                self._queue.task_done()
+
+
+class SyncExecutor:
+    """Limits how much of the database pool OW syncs may use.
+
+    At most `max_concurrency` syncs hold a connection at the same time, and a
+    sync only gets one while more than `reserved_connections` connections of
+    the pool are free. Requests acquire from the pool directly, so they always
+    have the reserved connections to themselves and get any connection that is
+    released before waiting syncs do.
+
+    Waiting syncs check again whenever the pool has a connection released,
+    see `InstrumentedPool.wait_until`.
+    """
+
+    def __init__(
+        self,
+        get_pool: Callable[[], Pool],
+        max_concurrency: int = settings.sync_max_concurrency,
+        reserved_connections: int = settings.sync_reserved_connections,
+    ) -> None:
+        self._get_pool = get_pool
+        self.max_concurrency = max_concurrency
+        self.reserved_connections = reserved_connections
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.waiting = 0
+        self.running = 0
+        self.max_waiting = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _has_free_connection(self, pool: Pool) -> bool:
+        max_size = int(pool.get_max_size())
+        free = max_size - int(pool.get_size()) + int(pool.get_idle_size())
+        # Never reserve the whole pool, syncs would wait forever
+        return free > min(self.reserved_connections, max_size - 1)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Pool]:
+        """Acquires a connection for a sync once the pool can spare one."""
+        pool = self._get_pool()
+
+        start = time.monotonic()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+            try:
+                await pool.wait_until(lambda: self._has_free_connection(pool))
+                conn = await pool.acquire()
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+
+        wait_time = time.monotonic() - start
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        self.running += 1
+        try:
+            yield conn
+        finally:
+            self.running -= 1
+            self.completed += 1
+            try:
+                await pool.release(conn)
+            finally:
+                self._semaphore.release()
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "waiting": self.waiting,
+            "running": self.running,
+            "max_waiting": self.max_waiting,
+            "completed": self.completed,
+            "wait_time_ms": int(self.wait_time * 1000),
+            "max_wait_time_ms": int(self.max_wait_time * 1000),
+        }
+
+
+def _done_future() -> "asyncio.Future[None]":
+    future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+    future.set_result(None)
+    return future
+
+
+class SyncScheduler:
+    """Schedules per-user OW syncs.
+
+    The groups of a user are fetched and written as part of the user job, see
+    `OWSync.sync_groups_for_user`.
+    """
+
+    def __init__(
+        self,
+        ow_sync: "OWSync",
+        user_workers: int = settings.sync_user_workers,
+        user_min_interval: float = settings.sync_user_min_interval,
+    ) -> None:
+        self.ow_sync = ow_sync
+        self.users = JobQueue(
+            "user-sync",
+            user_workers,
+            min_interval=user_min_interval,
+        )
+
+    def start(self) -> None:
+        self.users.start()
+
+    async def close(self) -> None:
+        await self.users.close()
+
+    def schedule_user_sync(
+        self,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        access_token: str,
+    ) -> "asyncio.Future[None]":
+        return self.users.schedule(
+            ow_user_id,
+            partial(self._sync_user, ow_user_id, user_id, access_token),
+        )
+
+    async def request_user_sync(
+        self,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        access_token: str,
+        wait_for_updates: bool = True,
+    ) -> None:
+        """Schedules a sync of the groups of a user.
+
+        The sync is only waited for if we don't know the memberships of the user
+        yet, otherwise the request is served from the database while the sync
+        runs in the background.
+        """
+        is_synced = self.is_user_synced(ow_user_id)
+        future = self.schedule_user_sync(ow_user_id, user_id, access_token)
+
+        if wait_for_updates and not is_synced:
+            # Shielded since other requests may be waiting for the same sync
+            await asyncio.shield(future)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "users_queued": self.users.queue_size,
+            **{f"db_{k}": v for k, v in self.ow_sync.executor.get_stats().items()},
+        }
+
+    def get_user_last_synced(self, ow_user_id: OWUserId) -> Optional[float]:
+        return self.users.last_succeeded.get(ow_user_id)
+
+    def is_user_synced(self, ow_user_id: OWUserId) -> bool:
+        """Whether the memberships of the user are known to be in the database."""
+        return self.get_user_last_synced(ow_user_id) is not None
+
+    async def _sync_user(
+        self,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        access_token: str,
+    ) -> bool:
+        return await self.ow_sync.sync_for_user(
+            ow_user_id,
+            user_id,
+            access_token,
+            wait_for_updates=True,
+        )
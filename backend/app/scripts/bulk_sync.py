@@ -0,0 +1,286 @@
+"""
+Syncs all OW users and committees in one go, outside of the request path.
+
+    python -m app.scripts.bulk_sync --access-token <token> [--interval 3600]
+
+The access token must be allowed to list all OW users. It can also be given
+through the OW_SYNC_ACCESS_TOKEN environment variable, which is preferred when
+the sync runs on a schedule.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import AsyncIterable, AsyncIterator, Iterator, Optional, Sequence, TypeVar
+
+from asyncpg import UniqueViolationError
+
+from app.api import FastAPI
+from app.config import settings
+from app.db.core import Database
+from app.http import HTTPClient
+from app.models.user import UserCreate
+from app.state import State, create_token_cache_backend
+from app.sync import OWSync
+from app.types import OWSyncGroup, OWSyncUser, OWUserId
+
+logger = logging.getLogger(__name__)
+
+SYNCED_GROUP_TYPES = ("COMMITTEE", "NODE_COMMITTEE")
+
+T = TypeVar("T")
+
+
+async def chunked(items: AsyncIterable[T], size: int) -> AsyncIterator[list[T]]:
+    chunk: list[T] = []
+    async for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+class PhaseTimer:
+    """Records how long each phase of a sync takes."""
+
+    def __init__(self) -> None:
+        self.timings: dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            logger.info("Phase %s took %.2fs", name, self.timings[name])
+
+
+class BulkSync:
+    def __init__(
+        self,
+        app: FastAPI,
+        access_token: str,
+        chunk_size: int = 1000,
+        page_size: int = settings.ow_users_page_size,
+        concurrency: int = settings.sync_group_workers,
+        force: bool = False,
+    ) -> None:
+        self.app = app
+        self.access_token = access_token
+        self.chunk_size = chunk_size
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self.force = force
+
+        self.timer = PhaseTimer()
+        self.users = 0
+        self.groups_synced = 0
+        self.groups_unchanged = 0
+        self.groups_failed = 0
+
+    async def run(self) -> dict[str, float]:
+        """Runs all phases and returns the time spent in each of them."""
+        # Users are written while the next pages are being fetched
+        with self.timer.phase("users"):
+            ow_users = self.app.http.iter_all_ow_users(
+                self.access_token, page_size=self.page_size
+            )
+            async for chunk in chunked(ow_users, self.chunk_size):
+                await self.upsert_users(chunk)
+                self.users += len(chunk)
+
+        with self.timer.phase("fetch_groups"):
+            groups = [
+                g
+                for g in await self.app.http.get_all_ow_groups(self.access_token)
+                if g.type in SYNCED_GROUP_TYPES
+            ]
+
+        with self.timer.phase("sync_groups"):
+            semaphore = asyncio.Semaphore(self.concurrency)
+            await asyncio.gather(*(self.sync_group(g, semaphore) for g in groups))
+
+        return self.timer.timings
+
+    async def upsert_users(self, users: Sequence[OWSyncUser]) -> None:
+        # Postgres refuses to upsert the same row twice in one statement
+        user_creates = {
+            u.id: UserCreate(
+                ow_user_id=OWUserId(u.id),
+                first_name=u.first_name,
+                last_name=u.last_name,
+                email=u.email,
+            )
+            for u in users
+        }
+
+        async with self.app.db.pool.acquire() as conn:
+            try:
+                async with conn.transaction():
+                    await self.app.db.users.upsert_multiple(
+                        list(user_creates.values()), conn=conn
+                    )
+            except UniqueViolationError:
+                # An email moved to another OW user. Upserting one by one
+                # remaps those users.
+                for user_create in user_creates.values():
+                    await self.app.db.users.upsert(user_create, conn=conn)
+
+    async def sync_group(
+        self,
+        group_data: OWSyncGroup,
+        semaphore: asyncio.Semaphore,
+    ) -> None:
+        async with semaphore:
+            try:
+                ow_group_users = await self.app.http.get_ow_group_users(
+                    group_data.slug, self.access_token
+                )
+                written = await self.app.ow_sync.sync_group(
+                    group_data,
+                    ow_group_users,
+                    force=self.force,
+                )
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Failed to sync group %s", group_data.slug)
+                self.groups_failed += 1
+                return
+
+        if written:
+            self.groups_synced += 1
+        else:
+            self.groups_unchanged += 1
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "users": self.users,
+            "groups_synced": self.groups_synced,
+            "groups_unchanged": self.groups_unchanged,
+            "groups_failed": self.groups_failed,
+        }
+
+
+async def create_app() -> FastAPI:
+    app = FastAPI()
+
+    database = Database()
+    app.set_db(database)
+
+    state = State(
+        backend=create_token_cache_backend(
+            settings.access_token_cache_backend, database
+        ),
+    )
+    database.set_state(state)
+    app.set_app_state(state)
+
+    http = HTTPClient()
+    app.set_http(http)
+    app.set_ow_sync(OWSync(app))
+
+    await database.async_init()
+    await http.async_init()
+    return app
+
+
+async def main(
+    access_token: str,
+    chunk_size: int,
+    page_size: int,
+    concurrency: int,
+    interval: Optional[float],
+    force: bool,
+) -> bool:
+    app = await create_app()
+    try:
+        while True:
+            bulk_sync = BulkSync(
+                app,
+                access_token,
+                chunk_size=chunk_size,
+                page_size=page_size,
+                concurrency=concurrency,
+                force=force,
+            )
+            timings = await bulk_sync.run()
+            logger.info(
+                "Bulk sync done in %.2fs: %s",
+                sum(timings.values()),
+                bulk_sync.get_stats(),
+            )
+
+            if interval is None:
+                return bulk_sync.groups_failed == 0
+
+            # Groups that did not change since the last run are skipped
+            await asyncio.sleep(interval)
+    finally:
+        await app.db.close()
+        await app.http.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--access-token",
+        default=os.environ.get("OW_SYNC_ACCESS_TOKEN"),
+        help="OW access token, defaults to $OW_SYNC_ACCESS_TOKEN",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of users written per statement",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=settings.ow_users_page_size,
+        help="Number of users fetched from OW per request, 0 fetches all at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=settings.sync_group_workers,
+        help="Number of groups synced at the same time",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="Keep running and sync again every this many seconds",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Fully reconcile groups even if they did not change since the last run",
+    )
+
+    args = parser.parse_args()
+    if not args.access_token:
+        parser.error("an access token is required")
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    succeeded = asyncio.run(
+        main(
+            args.access_token,
+            chunk_size=args.chunk_size,
+            page_size=args.page_size,
+            concurrency=args.concurrency,
+            interval=args.interval,
+            force=args.force,
+        )
+    )
+    raise SystemExit(0 if succeeded else 1)
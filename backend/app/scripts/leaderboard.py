@@ -0,0 +1,97 @@
+"""
+Checks or rebuilds the punishment aggregates the leaderboard is served from.
+
+    python -m app.scripts.leaderboard check [--repair]
+    python -m app.scripts.leaderboard rebuild [--user-id <id> ...]
+
+The aggregates are kept up to date by every punishment write, so a rebuild is
+only needed if a check finds users whose aggregates drifted, for example after
+punishments were edited by hand.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from typing import Optional
+from uuid import UUID
+
+from app.db.core import Database
+from app.types import UserId
+
+logger = logging.getLogger(__name__)
+
+
+async def check(database: Database, repair: bool) -> bool:
+    user_ids = await database.leaderboard.check()
+    if not user_ids:
+        logger.info("Leaderboard aggregates are consistent")
+        return True
+
+    logger.warning(
+        "Leaderboard aggregates of %d users are inconsistent: %s",
+        len(user_ids),
+        ", ".join(str(user_id) for user_id in user_ids),
+    )
+    if not repair:
+        return False
+
+    await database.leaderboard.rebuild(user_ids)
+    return await check(database, repair=False)
+
+
+async def rebuild(database: Database, user_ids: Optional[list[UserId]]) -> bool:
+    start = time.perf_counter()
+    await database.leaderboard.rebuild(user_ids)
+    logger.info(
+        "Rebuilt leaderboard aggregates of %s in %.2fs",
+        f"{len(user_ids)} users" if user_ids is not None else "all users",
+        time.perf_counter() - start,
+    )
+    return True
+
+
+async def main(args: argparse.Namespace) -> bool:
+    database = Database()
+    await database.async_init()
+    try:
+        if args.command == "check":
+            return await check(database, repair=args.repair)
+        return await rebuild(database, user_ids=args.user_ids)
+    finally:
+        await database.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    check_parser = commands.add_parser(
+        "check", help="Compare the aggregates with the punishments"
+    )
+    check_parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="Rebuild the aggregates of the inconsistent users",
+    )
+
+    rebuild_parser = commands.add_parser(
+        "rebuild", help="Recompute the aggregates from the punishments"
+    )
+    rebuild_parser.add_argument(
+        "--user-id",
+        dest="user_ids",
+        type=UUID,
+        action="append",
+        help="Only rebuild this user, can be given multiple times",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    succeeded = asyncio.run(main(parse_args()))
+    raise SystemExit(0 if succeeded else 1)
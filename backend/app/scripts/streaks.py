@@ -0,0 +1,96 @@
+"""
+Checks or rebuilds the punishment streaks the top streakers are served from.
+
+    python -m app.scripts.streaks check [--repair]
+    python -m app.scripts.streaks rebuild [--interval 86400]
+
+The streaks are kept up to date by every punishment insert and delete. The
+rebuild is a safety net for punishments written around them, for example by
+hand, and can run on a schedule with --interval.
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from app.db.core import Database
+
+logger = logging.getLogger(__name__)
+
+
+async def check(database: Database, repair: bool) -> bool:
+    pairs = await database.streaks.check()
+    if not pairs:
+        logger.info("Punishment streaks are consistent")
+        return True
+
+    logger.warning(
+        "Punishment streaks of %d users in groups are inconsistent: %s",
+        len(pairs),
+        ", ".join(f"{user_id} in {group_id}" for user_id, group_id in pairs),
+    )
+    if not repair:
+        return False
+
+    await database.streaks.refresh(pairs)
+    return await check(database, repair=False)
+
+
+async def rebuild(database: Database, interval: Optional[float]) -> bool:
+    while True:
+        start = time.perf_counter()
+        await database.streaks.rebuild()
+        logger.info(
+            "Rebuilt punishment streaks in %.2fs", time.perf_counter() - start
+        )
+
+        if interval is None:
+            return True
+        await asyncio.sleep(interval)
+
+
+async def main(args: argparse.Namespace) -> bool:
+    database = Database()
+    await database.async_init()
+    try:
+        if args.command == "check":
+            return await check(database, repair=args.repair)
+        return await rebuild(database, interval=args.interval)
+    finally:
+        await database.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    check_parser = commands.add_parser(
+        "check", help="Compare the streaks with the punishments"
+    )
+    check_parser.add_argument(
+        "--repair",
+        action="store_true",
+        help="Refresh the inconsistent streaks",
+    )
+
+    rebuild_parser = commands.add_parser(
+        "rebuild", help="Recompute the streaks from the punishments"
+    )
+    rebuild_parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        help="Keep rebuilding every this many seconds instead of once",
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    succeeded = asyncio.run(main(parse_args()))
+    raise SystemExit(0 if succeeded else 1)
@@ -1,29 +1,345 @@
 """Handles state and cache related operations."""
 
-from typing import Optional
+import base64
+import binascii
+import datetime
+import json
+import time
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Optional
 
-from .types import OWUserId
+from asyncpg import Pool
+
+from .config import settings
+from .types import OWUserId, UserId
+from .utils.cache import LRUCache
+
+if TYPE_CHECKING:
+    from .db.core import Database
+
+UserIds = tuple[UserId, OWUserId]
+
+
+def get_access_token_expiry(access_token: str) -> Optional[float]:
+    """Reads the `exp` claim of a JWT access token without verifying it.
+
+    The token is only used to decide how long we are allowed to cache it, the
+    actual verification is done by OW when the token is first seen.
+    """
+    parts = access_token.split(".")
+    if len(parts) != 3:
+        return None
+
+    payload = parts[1]
+    payload += "=" * (-len(payload) % 4)
+
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload))
+    except (binascii.Error, ValueError):
+        return None
+
+    exp = claims.get("exp") if isinstance(claims, dict) else None
+    if not isinstance(exp, (int, float)):
+        return None
+
+    return float(exp)
+
+
+class TokenCacheBackend(ABC):
+    """Storage for the access token -> user mapping.
+
+    Storing a token replaces any other token cached for the same OW user.
+    """
+
+    @abstractmethod
+    async def get(self, access_token: str) -> Optional[tuple[UserIds, float]]:
+        """Returns the cached ids along with the unix time they expire at."""
+
+    @abstractmethod
+    async def set(
+        self,
+        access_token: str,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        expires_at: float,
+    ) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, access_token: str) -> None:
+        ...
+
+    @abstractmethod
+    async def delete_by_ow_user_id(
+        self,
+        ow_user_id: OWUserId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        ...
+
+
+class InMemoryTokenCacheBackend(TokenCacheBackend):
+    def __init__(
+        self,
+        max_size: int,
+        default_ttl: float,
+        max_memory: Optional[int] = None,
+    ) -> None:
+        self.access_tokens_to_user_ids: LRUCache[
+            str, tuple[UserIds, float]
+        ] = LRUCache(
+            max_size=max_size,
+            default_ttl=default_ttl,
+            max_memory=max_memory,
+        )
+        self.ow_user_ids_to_access_tokens: LRUCache[OWUserId, str] = LRUCache(
+            max_size=max_size,
+            default_ttl=default_ttl,
+            max_memory=max_memory,
+        )
+
+    def get_nowait(self, access_token: str) -> Optional[tuple[UserIds, float]]:
+        return self.access_tokens_to_user_ids.get(access_token)
+
+    def set_nowait(
+        self,
+        access_token: str,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        expires_at: float,
+    ) -> None:
+        to_remove = self.ow_user_ids_to_access_tokens.delete(ow_user_id)
+
+        self.access_tokens_to_user_ids.set(
+            access_token, ((user_id, ow_user_id), expires_at), expires_at
+        )
+        self.ow_user_ids_to_access_tokens.set(ow_user_id, access_token, expires_at)
+
+        if to_remove is not None and to_remove != access_token:
+            self.access_tokens_to_user_ids.delete(to_remove)
+
+    def delete_nowait(self, access_token: str) -> None:
+        item = self.access_tokens_to_user_ids.delete(access_token)
+        if item is not None:
+            self.ow_user_ids_to_access_tokens.delete(item[0][1])
+
+    def delete_by_ow_user_id_nowait(self, ow_user_id: OWUserId) -> None:
+        access_token = self.ow_user_ids_to_access_tokens.delete(ow_user_id)
+        if access_token is not None:
+            self.access_tokens_to_user_ids.delete(access_token)
+
+    def get_access_token_by_ow_user_id(self, ow_user_id: OWUserId) -> Optional[str]:
+        access_token = self.ow_user_ids_to_access_tokens.get(ow_user_id)
+        if access_token is None:
+            return None
+
+        # The token may have been evicted from the primary cache on its own
+        item = self.access_tokens_to_user_ids.get(access_token)
+        if item is None or item[0][1] != ow_user_id:
+            self.ow_user_ids_to_access_tokens.delete(ow_user_id)
+            return None
+
+        return access_token
+
+    async def get(self, access_token: str) -> Optional[tuple[UserIds, float]]:
+        return self.get_nowait(access_token)
+
+    async def set(
+        self,
+        access_token: str,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        expires_at: float,
+    ) -> None:
+        self.set_nowait(access_token, ow_user_id, user_id, expires_at)
+
+    async def delete(self, access_token: str) -> None:
+        self.delete_nowait(access_token)
+
+    async def delete_by_ow_user_id(
+        self,
+        ow_user_id: OWUserId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        self.delete_by_ow_user_id_nowait(ow_user_id)
+
+
+class PostgresTokenCacheBackend(TokenCacheBackend):
+    """Shares cached tokens between all workers through an unlogged table."""
+
+    # How many writes between each cleanup of expired rows
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, db: "Database") -> None:
+        self.db = db
+        self._writes = 0
+
+    async def get(self, access_token: str) -> Optional[tuple[UserIds, float]]:
+        res = await self.db.access_tokens.get(access_token)
+        if res is None:
+            return None
+
+        user_id, ow_user_id, expires_at = res
+        timestamp = expires_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return (user_id, ow_user_id), timestamp
+
+    async def set(
+        self,
+        access_token: str,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+        expires_at: float,
+    ) -> None:
+        async with self.db.pool.acquire() as conn:
+            await self.db.access_tokens.upsert(
+                access_token,
+                ow_user_id,
+                user_id,
+                datetime.datetime.utcfromtimestamp(expires_at),
+                conn=conn,
+            )
+
+            self._writes += 1
+            if self._writes % self.PURGE_INTERVAL == 0:
+                await self.db.access_tokens.delete_expired(conn=conn)
+
+    async def delete(self, access_token: str) -> None:
+        await self.db.access_tokens.delete(access_token)
+
+    async def delete_by_ow_user_id(
+        self,
+        ow_user_id: OWUserId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        await self.db.access_tokens.delete_by_ow_user_id(ow_user_id, conn=conn)
+
+
+def create_token_cache_backend(
+    name: str,
+    db: "Database",
+) -> Optional[TokenCacheBackend]:
+    """Creates the shared backend configured by `access_token_cache_backend`."""
+    if name == "memory":
+        return None
+    if name == "postgres":
+        return PostgresTokenCacheBackend(db)
+
+    raise ValueError(f"Unknown access token cache backend: {name}")
 
 
 class State:
-    def __init__(self) -> None:
-        self.access_tokens_to_ow_user_ids: dict[str, OWUserId] = {}
-        self.ow_user_ids_to_access_tokens: dict[OWUserId, str] = {}
+    """Caches which user an access token belongs to.
+
+    Lookups always go through an in-process cache first. If a shared backend
+    is configured it is consulted on local misses, and entries found there are
+    only kept locally for a short while so that invalidations done by other
+    workers are picked up.
+    """
+
+    def __init__(
+        self,
+        backend: Optional[TokenCacheBackend] = None,
+        max_size: int = settings.access_token_cache_max_size,
+        default_ttl: float = settings.access_token_cache_ttl,
+        max_memory: Optional[int] = settings.access_token_cache_max_memory,
+        local_ttl: float = settings.access_token_cache_local_ttl,
+    ) -> None:
+        self.default_ttl = default_ttl
+        self.backend = backend
+        self.local = InMemoryTokenCacheBackend(
+            max_size=max_size,
+            default_ttl=local_ttl if backend is not None else default_ttl,
+            max_memory=max_memory,
+        )
+
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def set_backend(self, backend: Optional[TokenCacheBackend]) -> None:
+        self.backend = backend
+
+    def _get_expires_at(self, access_token: str) -> float:
+        max_expires_at = time.time() + self.default_ttl
+        expires_at = get_access_token_expiry(access_token)
+        if expires_at is None:
+            return max_expires_at
+        return min(expires_at, max_expires_at)
+
+    async def add_access_token(
+        self,
+        access_token: str,
+        ow_user_id: OWUserId,
+        user_id: UserId,
+    ) -> None:
+        expires_at = self._get_expires_at(access_token)
+        if expires_at <= time.time():
+            return
+
+        self.local.set_nowait(access_token, ow_user_id, user_id, expires_at)
+        if self.backend is not None:
+            await self.backend.set(access_token, ow_user_id, user_id, expires_at)
+
+    def get_user_ids_by_access_token_nowait(
+        self, access_token: str
+    ) -> Optional[UserIds]:
+        """Only looks in the local cache."""
+        item = self.local.get_nowait(access_token)
+        return item[0] if item is not None else None
+
+    async def get_user_ids_by_access_token(
+        self, access_token: str
+    ) -> Optional[UserIds]:
+        ids = self.get_user_ids_by_access_token_nowait(access_token)
+        if ids is not None:
+            return ids
+
+        if self.backend is None:
+            return None
+
+        item = await self.backend.get(access_token)
+        if item is None:
+            self.shared_misses += 1
+            return None
+
+        self.shared_hits += 1
+        (user_id, ow_user_id), expires_at = item
+        self.local.set_nowait(access_token, ow_user_id, user_id, expires_at)
+        return user_id, ow_user_id
 
-    def add_access_token(self, access_token: str, user_id: OWUserId) -> None:
-        to_remove = self.ow_user_ids_to_access_tokens.get(user_id)
+    async def get_ow_user_id_by_access_token(
+        self, access_token: str
+    ) -> Optional[OWUserId]:
+        ids = await self.get_user_ids_by_access_token(access_token)
+        return ids[1] if ids is not None else None
 
-        self.access_tokens_to_ow_user_ids[access_token] = user_id
-        self.ow_user_ids_to_access_tokens[user_id] = access_token
+    def get_access_token_by_ow_user_id(self, ow_user_id: OWUserId) -> Optional[str]:
+        """Only looks in the local cache, the shared backend never stores
+        tokens in plain text."""
+        return self.local.get_access_token_by_ow_user_id(ow_user_id)
 
-        if to_remove is not None:
-            try:
-                del self.access_tokens_to_ow_user_ids[to_remove]
-            except KeyError:
-                pass
+    async def remove_access_token(self, access_token: str) -> None:
+        self.local.delete_nowait(access_token)
+        if self.backend is not None:
+            await self.backend.delete(access_token)
 
-    def get_ow_user_id_by_access_token(self, access_token: str) -> Optional[OWUserId]:
-        return self.access_tokens_to_ow_user_ids.get(access_token)
+    async def invalidate_ow_user_id(
+        self,
+        ow_user_id: OWUserId,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        """Forgets the cached identity of an OW user, e.g. when the user row
+        it resolved to has been remapped to another OW user id."""
+        self.local.delete_by_ow_user_id_nowait(ow_user_id)
+        if self.backend is not None:
+            await self.backend.delete_by_ow_user_id(ow_user_id, conn=conn)
 
-    def get_access_token_by_ow_user_id(self, user_id: OWUserId) -> Optional[str]:
-        return self.ow_user_ids_to_access_tokens.get(user_id)
+    def get_stats(self) -> dict[str, int]:
+        local = self.local
+        cache = local.access_tokens_to_user_ids
+        return {
+            "size": len(cache),
+            "memory": cache.memory + local.ow_user_ids_to_access_tokens.memory,
+            **cache.stats.as_dict(),
+            "shared_hits": self.shared_hits,
+            "shared_misses": self.shared_misses,
+        }
@@ -2,15 +2,19 @@
 
 import asyncio
 import datetime
+import hashlib
+import json
+import time
 import sentry_sdk
-from collections import defaultdict
-from typing import TYPE_CHECKING, Any, Optional, cast
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional, cast
 
 from asyncpg import Pool
 
-from .exceptions import DatabaseIntegrityException, NotFound
-from .models.group import GroupCreate
-from .models.group_member import GroupMember, GroupMemberCreate, GroupMemberUpdate
+from .config import settings
+from .exceptions import DatabaseIntegrityException, NotFound, OWUnavailableException
+from .models.group import Group, GroupCreate
+from .models.group_member import GroupMember, GroupMemberCreate
 from .models.user import UserCreate, UserUpdate
 from .types import (
     GroupId,
@@ -18,12 +22,16 @@ from .types import (
     OWSyncGroupMember,
     OWUserId,
     PermissionPrivilege,
+    ReconciledGroupMembers,
     UserId,
 )
-from .utils.db import MaybeAcquire
+from .scheduler import SyncExecutor
+from .utils.cache import LRUCache
+from .utils.db import MaybeAcquire, untrack_connection_usage
 
 if TYPE_CHECKING:
     from .api import FastAPI
+    from .scheduler import SyncScheduler
 
 IGNORE_OW_GROUPS = "komiteledere"
 
@@ -34,42 +42,215 @@ OW_GROUP_ROLES_TO_PERMISSIONS: dict[str, tuple[str, ...]] = {
 }
 
 
+def get_group_digest(
+    group_data: OWSyncGroup,
+    group_users: list[OWSyncGroupMember],
+) -> str:
+    """Fingerprints everything a group sync writes to the database.
+
+    Members are sorted so that the digest does not depend on the order OW
+    happens to return them in.
+    """
+    members = sorted(
+        (
+            {
+                **u.dict(exclude={"roles"}),
+                "roles": sorted(u.roles),
+            }
+            for u in group_users
+        ),
+        key=lambda m: m["id"],
+    )
+    payload = {
+        "slug": group_data.slug,
+        "name": group_data.name,
+        "abbreviation": group_data.abbreviation,
+        "image": group_data.imageUrl,
+        "members": members,
+    }
+    data = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class GroupSyncFreshness:
+    """Keeps track of which OW groups have been synced recently, and the
+    digest of the OW payload that was last applied for each of them.
+
+    Connections it needs itself come from `executor`, if given.
+    """
+
+    def __init__(
+        self,
+        app: "FastAPI",
+        window: float = settings.sync_group_freshness_window,
+        persist: bool = settings.sync_group_freshness_persist,
+        digest_ttl: float = settings.sync_group_digest_ttl,
+        executor: Optional[SyncExecutor] = None,
+    ) -> None:
+        self.app = app
+        self.window = window
+        self.persist = persist
+        self.executor = executor
+        self._last_synced: LRUCache[str, float] = LRUCache(
+            max_size=settings.sync_state_max_size,
+            default_ttl=window,
+        )
+        # Expiring digests makes sure every group is fully reconciled now and
+        # then, in case its rows were changed behind the back of the sync.
+        self._digests: LRUCache[str, str] = LRUCache(
+            max_size=settings.sync_state_max_size,
+            default_ttl=digest_ttl,
+        )
+
+        self.skipped = 0
+        self.performed = 0
+        self.unchanged = 0
+
+    async def get_fresh(
+        self,
+        ow_group_ids: list[str],
+        conn: Optional[Pool] = None,
+    ) -> set[str]:
+        """Returns the groups that were synced within the freshness window."""
+        fresh = {g for g in ow_group_ids if self._last_synced.get(g) is not None}
+
+        not_fresh = [g for g in ow_group_ids if g not in fresh]
+        if self.persist and not_fresh:
+            async with self._acquire(conn) as conn:
+                synced = await self.app.db.groups.get_recently_synced(
+                    not_fresh, self.window, conn=conn
+                )
+            for ow_group_id, synced_at in synced.items():
+                timestamp = synced_at.replace(tzinfo=datetime.timezone.utc).timestamp()
+                self._last_synced.set(ow_group_id, timestamp, timestamp + self.window)
+                fresh.add(ow_group_id)
+
+        return fresh
+
+    @asynccontextmanager
+    async def _acquire(self, conn: Optional[Pool]) -> AsyncIterator[Optional[Pool]]:
+        if conn is not None or self.executor is None:
+            yield conn
+            return
+
+        async with self.executor.acquire() as conn:
+            yield conn
+
+    async def mark_synced(
+        self,
+        ow_group_id: str,
+        group_id: GroupId,
+        digest: Optional[str] = None,
+        conn: Optional[Pool] = None,
+    ) -> None:
+        self.performed += 1
+        self._last_synced.set(ow_group_id, time.time())
+        if digest is not None:
+            self._digests.set(ow_group_id, digest)
+        if self.persist:
+            await self.app.db.groups.set_synced(group_id, conn=conn)
+
+    def mark_unchanged(self, ow_group_id: str) -> None:
+        """Marks a group as synced without touching the database."""
+        self.unchanged += 1
+        self._last_synced.set(ow_group_id, time.time())
+
+    def is_unchanged(self, ow_group_id: str, digest: str) -> bool:
+        return self._digests.get(ow_group_id) == digest
+
+    def forget(self, ow_group_id: Optional[str] = None) -> None:
+        """Forces the next sync of a group, or of all groups, to do a full
+        reconcile."""
+        if ow_group_id is None:
+            self._digests.clear()
+            self._last_synced.clear()
+        else:
+            self._digests.delete(ow_group_id)
+            self._last_synced.delete(ow_group_id)
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "skipped": self.skipped,
+            "performed": self.performed,
+            "unchanged": self.unchanged,
+        }
+
+
 class OWSync:
     def __init__(self, app: "FastAPI"):
         self.app = app
+        # Database work of syncs goes through this, so it can't starve requests
+        self.executor = SyncExecutor(lambda: self.app.db.pool)
+        self.group_freshness = GroupSyncFreshness(app, executor=self.executor)
+        self.scheduler: Optional["SyncScheduler"] = None
+        self._pending_access_tokens: dict[
+            str, asyncio.Task[tuple[UserId, OWUserId]]
+        ] = {}
 
     async def sync_for_access_token(
         self,
         access_token: str,
-        *,
-        conn: Optional[Pool] = None,
     ) -> tuple[UserId, OWUserId]:
-        ow_user_id = self.app.app_state.get_ow_user_id_by_access_token(access_token)
-        if ow_user_id is None:
-            ow_profile = await self.app.http.get_ow_profile_by_access_token(
-                access_token
+        cached = self.app.app_state.get_user_ids_by_access_token_nowait(access_token)
+        if cached is not None:
+            return cached
+
+        # Concurrent requests with the same new token share a single lookup
+        task = self._pending_access_tokens.get(access_token)
+        if task is None:
+            task = asyncio.create_task(self._resolve_access_token(access_token))
+            self._pending_access_tokens[access_token] = task
+            task.add_done_callback(
+                lambda t: self._forget_pending_access_token(access_token, t)
             )
-            if ow_profile is None:
-                raise NotFound
 
-            ow_user_id = cast(OWUserId, ow_profile.id)
-            self.app.app_state.add_access_token(access_token, ow_user_id)
+        # Shielded so that one cancelled request does not fail the others
+        return await asyncio.shield(task)
 
-            user_id = await self.create_user_if_not_exists(
-                ow_user_id=ow_user_id,
-                first_name=ow_profile.first_name,
-                last_name=ow_profile.last_name,
-                email=ow_profile.email,
-                conn=conn,
-            )
-            return user_id, ow_user_id
+    def set_scheduler(self, scheduler: "SyncScheduler") -> None:
+        self.scheduler = scheduler
 
-        user = await self.app.db.users.get(
-            user_id=ow_user_id,
-            is_ow_user_id=True,
-            conn=conn,
+    def _forget_pending_access_token(
+        self,
+        access_token: str,
+        task: "asyncio.Task[tuple[UserId, OWUserId]]",
+    ) -> None:
+        if self._pending_access_tokens.get(access_token) is task:
+            del self._pending_access_tokens[access_token]
+
+        # Retrieve the exception so asyncio doesn't log it if nobody awaited it
+        if not task.cancelled():
+            task.exception()
+
+    async def _resolve_access_token(
+        self,
+        access_token: str,
+    ) -> tuple[UserId, OWUserId]:
+        # Shared by all requests waiting for the token, so the connections
+        # used here don't belong to the request that happened to start it
+        untrack_connection_usage()
+
+        cached = await self.app.app_state.get_user_ids_by_access_token(access_token)
+        if cached is not None:
+            return cached
+
+        ow_profile = await self.app.http.get_ow_profile_by_access_token(access_token)
+        if ow_profile is None:
+            raise NotFound
+
+        ow_user_id = cast(OWUserId, ow_profile.id)
+        user_id = await self.create_user_if_not_exists(
+            ow_user_id=ow_user_id,
+            first_name=ow_profile.first_name,
+            last_name=ow_profile.last_name,
+            email=ow_profile.email,
         )
-        return user.user_id, ow_user_id
+        await self.app.app_state.add_access_token(access_token, ow_user_id, user_id)
+        return user_id, ow_user_id
+
+    async def _get_groups(self, user_id: UserId) -> list[Group]:
+        async with self.executor.acquire() as conn:
+            return await self.app.db.users.get_groups(user_id, conn=conn)
 
     async def sync_for_user(
         self,
@@ -77,11 +258,20 @@ class OWSync:
         user_id: UserId,
         access_token: str,
         wait_for_updates: bool = True,
-    ) -> None:
+    ) -> bool:
+        """Syncs the OW groups of a user. Returns False if the sync failed, in
+        which case the error has been reported to Sentry.
+
+        The sync is skipped while OW is unavailable, the groups of the user are
+        then served as they are in the database.
+        """
+        if self.app.http.circuit_breaker.is_open:
+            return False
+
         try:
             ow_groups_data, groups_data = await asyncio.gather(
                 self.app.http.get_ow_groups_by_user_id(ow_user_id, access_token),
-                self.app.db.users.get_groups(user_id),
+                self._get_groups(user_id),
             )
             filtered_groups_data = [
                 g for g in ow_groups_data if g.type in ("COMMITTEE", "NODE_COMMITTEE")
@@ -95,11 +285,29 @@ class OWSync:
                 and g.ow_group_id not in ow_group_ids
             ]
 
-            regular_sync_tasks = [
-                asyncio.create_task(self.sync_group_for_user(ow_user_id, g, access_token))
-                for g in filtered_groups_data
+            # Groups the user is already in that were synced a moment ago by
+            # another member have nothing new to offer
+            db_ow_group_ids = {g.ow_group_id for g in groups_data}
+            fresh_ow_group_ids = await self.group_freshness.get_fresh(
+                [g.slug for g in filtered_groups_data if g.slug in db_ow_group_ids]
+            )
+            self.group_freshness.skipped += len(fresh_ow_group_ids)
+            groups_to_sync = [
+                g for g in filtered_groups_data if g.slug not in fresh_ow_group_ids
             ]
 
+            # All groups are fetched in one round-trip and written in one
+            # transaction
+            regular_sync_tasks = []
+            if groups_to_sync:
+                regular_sync_tasks.append(
+                    asyncio.create_task(
+                        self.sync_groups_for_user(
+                            ow_user_id, groups_to_sync, access_token
+                        )
+                    )
+                )
+
             not_in_ow_group_tasks = []
             if group_ids_not_in_ow_group_anymore:
                 not_in_ow_group_tasks.append(
@@ -110,6 +318,10 @@ class OWSync:
                     )
                 )
 
+            if regular_sync_tasks or not_in_ow_group_tasks:
+                # The memberships of the user change, which they should see
+                self.app.db.note_write(access_token)
+
             if wait_for_updates:
                 await asyncio.gather(*regular_sync_tasks, *not_in_ow_group_tasks)
             else:
@@ -119,15 +331,20 @@ class OWSync:
 
                 sum_ow_groups = 0
                 for group in filtered_groups_data:
-                    if group.id in db_groups:
+                    if group.slug in db_groups:
                         sum_ow_groups += 1
 
                 # Only wait for the tasks if we need to add or remove the user from one or more groups
                 if sum_ow_groups != len(filtered_groups_data):
                     await asyncio.gather(*regular_sync_tasks, *not_in_ow_group_tasks)
+        except OWUnavailableException:
+            return False
         except Exception as e:
             sentry_sdk.capture_exception(e)
             print("Error reported to Sentry")
+            return False
+
+        return True
 
     async def create_user_if_not_exists(
         self,
@@ -218,102 +435,22 @@ class OWSync:
         group_id: GroupId,
         group_users: list[OWSyncGroupMember],
         conn: Optional[Pool] = None,
-    ) -> None:
-        async with MaybeAcquire(conn, self.app.db.pool) as conn:
-            group_members = await self.app.db.group_members.get_all_raw(
-                group_id, conn=conn
-            )
-            id_map = {m["ow_group_user_id"]: m["user_id"] for m in group_members}
-
-            to_add = [u for u in group_users if u.id not in id_map]
-
-            active_ow_group_member_ids = {
-                item.id for item in group_users if item.has_active_membership
-            }
-
-            # Map ow_group_user_id to OWSyncGroupMember for getting membership_end
-            ow_user_map = {u.id: u for u in group_users}
-
-            to_soft_delete = [
-                (m["user_id"], m["ow_group_user_id"])
-                for m in group_members
-                if m["ow_group_user_id"] not in active_ow_group_member_ids and m["active"]
-            ]
-
-            added_members = []
-            if to_add:
-                added_members = await self.add_users_to_group(
-                    group_id,
-                    to_add,
-                    conn=conn,
-                )
-
-            if to_soft_delete:
-                member_updates = []
-                for user_id, ow_group_user_id in to_soft_delete:
-                    ow_user = ow_user_map.get(ow_group_user_id)
-                    inactive_at = ow_user.membership_end if ow_user and ow_user.membership_end else datetime.datetime.utcnow()
-                    member_updates.append(
-                        GroupMemberUpdate(
-                            user_id=user_id,
-                            ow_group_user_id=ow_group_user_id,
-                            active=False,
-                            inactive_at=inactive_at,
-                        )
-                    )
-                await self.app.db.group_members.update_multiple(
-                    group_id,
-                    member_updates,
-                    conn=conn,
-                )
-
-            updated_id_map = dict(id_map)
-            updated_id_map.update(
-                {m.ow_group_user_id: m.user_id for m in added_members}
-            )
-
-            privileges = {
-                updated_id_map[u.id]: self.map_roles(u.roles)
-                for u in group_users
-                if u.id in updated_id_map
-            }
-
-            db_permissions = (
-                await self.app.db.permissions.get_auto_managed_permissions_for_group(
-                    group_id,
-                    conn=conn,
-                )
-            )
-
-            db_permissions_map = defaultdict(list)
-            for role in db_permissions:
-                db_permissions_map[role.user_id].append(role.privilege)
-
-            privileges_to_add = []
-            for user_id, _privileges in privileges.items():
-                for privilege in _privileges:
-                    if privilege not in db_permissions_map[user_id]:
-                        privileges_to_add.append((user_id, privilege))
-
-            privileges_to_remove = []
-            for user_id, _privileges in db_permissions_map.items():
-                for privilege in _privileges:
-                    if privilege not in privileges.get(user_id, []):
-                        privileges_to_remove.append((user_id, privilege))
-
-            if privileges_to_add:
-                await self.app.db.permissions.insert_permissions_for_multiple_users(
-                    group_id,
-                    privileges_to_add,
-                    conn=conn,
-                )
-
-            if privileges_to_remove:
-                await self.app.db.permissions.remove_permissions_for_multiple_users(
-                    group_id,
-                    privileges_to_remove,
-                    conn=conn,
-                )
+    ) -> ReconciledGroupMembers:
+        """Reconciles the members of an existing group with OW in a single
+        round-trip, see `GroupMembers.reconcile_ow_members`."""
+        members = list({u.id: u for u in group_users}.values())
+        privileges = [
+            (OWUserId(u.id), privilege)
+            for u in members
+            for privilege in self.map_roles(u.roles)
+        ]
+
+        return await self.app.db.group_members.reconcile_ow_members(
+            group_id,
+            members,
+            privileges,
+            conn=conn,
+        )
 
     async def set_inactive_in_groups(
         self,
@@ -323,20 +460,118 @@ class OWSync:
         """This method is used to update groups that the user is not longer a part of in OW"""
 
         # Update all group members tied to the user id to be inactive
-        async with self.app.db.pool.acquire() as conn:
+        async with self.executor.acquire() as conn:
             query = """UPDATE group_members
                        SET active = FALSE, inactive_at = COALESCE(inactive_at, now() at time zone 'utc')
                        WHERE user_id = $1 AND group_id = ANY($2)"""
             await conn.execute(query, ow_user_id, group_ids)
 
-    async def sync_group_for_user(
+    async def sync_groups_for_user(
         self,
         ow_user_id: OWUserId,
-        group_data: OWSyncGroup,
+        groups_data: list[OWSyncGroup],
         access_token: str,
+        force: bool = False,
     ) -> None:
-        ow_group_users = await self.app.http.get_ow_group_users(group_data.slug, access_token)
+        members = await self.app.http.get_ow_groups_users(
+            [g.slug for g in groups_data], access_token
+        )
+
+        groups = []
+        for group_data in groups_data:
+            ow_group_users = members.get(group_data.slug, [])
+            # OW lists the groups of a user before the memberships show up
+            if not any(u.id == ow_user_id for u in ow_group_users):
+                continue
+            groups.append((group_data, ow_group_users))
+
+        await self.sync_groups(groups, exclude_ow_user_id=ow_user_id, force=force)
+
+    async def sync_group(
+        self,
+        group_data: OWSyncGroup,
+        ow_group_users: list[OWSyncGroupMember],
+        exclude_ow_user_id: Optional[str] = None,
+        force: bool = False,
+    ) -> bool:
+        """Writes a single group, returns whether anything was written."""
+        written = await self.sync_groups(
+            [(group_data, ow_group_users)],
+            exclude_ow_user_id=exclude_ow_user_id,
+            force=force,
+        )
+        return bool(written)
+
+    async def sync_groups(
+        self,
+        groups: list[tuple[OWSyncGroup, list[OWSyncGroupMember]]],
+        exclude_ow_user_id: Optional[str] = None,
+        force: bool = False,
+    ) -> list[str]:
+        """Writes groups and their members from OW to the database in a single
+        transaction.
+
+        Payloads identical to the one last applied for a group are skipped
+        without touching the database, unless `force` is set. Each group is
+        written in its own savepoint, so one failing group does not roll back
+        the others. The first error is raised after the rest are committed.
+        Returns the OW ids of the groups that were written.
+        """
+        freshness = self.group_freshness
+
+        to_write = []
+        for group_data, ow_group_users in groups:
+            digest = get_group_digest(group_data, ow_group_users)
+            if not force and freshness.is_unchanged(group_data.slug, digest):
+                freshness.mark_unchanged(group_data.slug)
+                continue
+            to_write.append((group_data, ow_group_users, digest))
+
+        if not to_write:
+            return []
+
+        written: list[tuple[str, GroupId, Optional[str]]] = []
+        errors: list[Exception] = []
+        async with self.executor.acquire() as conn:
+            async with conn.transaction():
+                for group_data, ow_group_users, digest in to_write:
+                    try:
+                        async with conn.transaction():
+                            group_id, created = await self.write_group(
+                                group_data,
+                                ow_group_users,
+                                exclude_ow_user_id=exclude_ow_user_id,
+                                conn=conn,
+                            )
+                    except Exception as e:  # pylint: disable=broad-except
+                        errors.append(e)
+                        continue
+
+                    # The excluded member is only added by the next sync,
+                    # which must not be skipped
+                    if created and exclude_ow_user_id is not None:
+                        written.append((group_data.slug, group_id, None))
+                    else:
+                        written.append((group_data.slug, group_id, digest))
+
+            for slug, group_id, applied_digest in written:
+                await freshness.mark_synced(
+                    slug, group_id, digest=applied_digest, conn=conn
+                )
 
+        if errors:
+            raise errors[0]
+
+        return [slug for slug, _, _ in written]
+
+    async def write_group(
+        self,
+        group_data: OWSyncGroup,
+        ow_group_users: list[OWSyncGroupMember],
+        exclude_ow_user_id: Optional[str] = None,
+        conn: Optional[Pool] = None,
+    ) -> tuple[GroupId, bool]:
+        """Returns the id of the group and whether it was created."""
         image_data = group_data.imageUrl
         group_create = GroupCreate(
             ow_group_id=group_data.slug,
@@ -348,15 +583,7 @@ class OWSync:
             ),  # TODO?: Maybe change to something default??
         )
 
-        ow_group_user_id = None
-        for ow_group_user in ow_group_users:
-            if ow_group_user.id == ow_user_id:
-                ow_group_user_id = ow_group_user.id
-                break
-
-        assert ow_group_user_id is not None
-
-        async with self.app.db.pool.acquire() as conn:
+        async with MaybeAcquire(conn, self.app.db.pool) as conn:
             group_res = await self.app.db.groups.insert_or_update(
                 group_create,
                 created_by=None,
@@ -368,7 +595,7 @@ class OWSync:
             if action == "CREATE":
                 members = await self.add_users_to_group(
                     group_id,
-                    [u for u in ow_group_users if u.id != ow_group_user_id],
+                    [u for u in ow_group_users if u.id != exclude_ow_user_id],
                     conn=conn,
                 )
                 await self.handle_initial_group_permissions(
@@ -385,11 +612,7 @@ class OWSync:
                     conn=conn,
                 )
 
-                await self.update_multiple(
-                    group_id=group_id,
-                    group_users=ow_group_users,
-                    conn=conn,
-                )
+        return group_id, action == "CREATE"
 
     async def update_user(
         self,
@@ -410,64 +633,3 @@ class OWSync:
                 user_update,
                 conn=conn,
             )
-
-    async def update_multiple(
-        self,
-        group_id: GroupId,
-        group_users: list[OWSyncGroupMember],
-        conn: Optional[Pool] = None,
-    ) -> None:
-        async with MaybeAcquire(conn, self.app.db.pool) as conn:
-            db_group_users = await self.app.db.group_users.get_all_raw(
-                group_id=group_id,
-                conn=conn,
-            )
-            mapped = {g["ow_user_id"]: g for g in db_group_users}
-
-            users_to_update = []
-            group_members_to_update = []
-            for group_user in group_users:
-                db_user = mapped.get(group_user.id)
-                if db_user is None:
-                    continue
-
-                keys = ("first_name", "last_name", "email")
-                if any(getattr(group_user, key) != db_user[key] for key in keys):
-                    users_to_update.append(
-                        UserUpdate(
-                            user_id=db_user["user_id"],
-                            ow_user_id=group_user.id,
-                            first_name=group_user.first_name,
-                            last_name=group_user.last_name,
-                            email=group_user.email,
-                        )
-                    )
-
-                if (
-                    group_user.has_active_membership != db_user["active"]
-                ):  # They are opposite, so update if they match
-                    # Use membership_end from OW if available, otherwise use current time
-                    inactive_at = None
-                    if not group_user.has_active_membership:
-                        inactive_at = group_user.membership_end or datetime.datetime.utcnow()
-                    group_members_to_update.append(
-                        GroupMemberUpdate(
-                            user_id=db_user["user_id"],
-                            ow_group_user_id=group_user.id,
-                            active=group_user.has_active_membership,
-                            inactive_at=inactive_at,
-                        )
-                    )
-
-            if users_to_update:
-                await self.app.db.users.update_multiple(
-                    users_to_update,
-                    conn=conn,
-                )
-
-            if group_members_to_update:
-                await self.app.db.group_members.update_multiple(
-                    group_id,
-                    group_members_to_update,
-                    conn=conn,
-                )
@@ -59,6 +59,15 @@ class InsertOrUpdateGroup(TypedDict):
     action: str
 
 
+class ReconciledGroupMembers(TypedDict):
+    users_upserted: list[UserId]
+    members_added: list[UserId]
+    members_deactivated: list[UserId]
+    members_reactivated: list[UserId]
+    privileges_added: list[tuple[UserId, PermissionPrivilege]]
+    privileges_removed: list[tuple[UserId, PermissionPrivilege]]
+
+
 class InviteCode(str):
     pass
 
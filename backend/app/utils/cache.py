@@ -0,0 +1,150 @@
+"""
+A size and memory bounded LRU cache with per-entry expiry.
+"""
+
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+def estimate_size(key: Any, value: Any) -> int:
+    """Rough estimate of the memory used by a single cache entry."""
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(sys.getsizeof(v) for v in value)
+    return size
+
+
+class CacheStats:
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class LRUCache(Generic[K, V]):
+    """Least recently used cache where every entry has its own expiry time.
+
+    Entries are evicted when either `max_size` entries or `max_memory` bytes
+    (as estimated by `sizeof`) is exceeded. Expired entries are removed lazily
+    when they are looked up, or when they reach the least recently used end
+    while room is made for new entries.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        default_ttl: float,
+        max_memory: Optional[int] = None,
+        sizeof: Callable[[Any, Any], int] = estimate_size,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.max_memory = max_memory
+        self.stats = CacheStats()
+
+        self._sizeof = sizeof
+        self._clock = clock
+        self._data: OrderedDict[K, tuple[V, float, int]] = OrderedDict()
+        self._memory = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        # Neither counts as a lookup nor refreshes the entry
+        item = self._data.get(key)
+        return item is not None and item[1] > self._clock()
+
+    @property
+    def memory(self) -> int:
+        return self._memory
+
+    def get(self, key: K) -> Optional[V]:
+        item = self._data.get(key)
+        if item is None:
+            self.stats.misses += 1
+            return None
+
+        value, expires_at, _ = item
+        if expires_at <= self._clock():
+            self._remove(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.stats.hits += 1
+        return value
+
+    def set(self, key: K, value: V, expires_at: Optional[float] = None) -> None:
+        now = self._clock()
+        if expires_at is None:
+            expires_at = now + self.default_ttl
+        else:
+            # Never trust an entry for longer than the default ttl
+            expires_at = min(expires_at, now + self.default_ttl)
+
+        if expires_at <= now:
+            self.delete(key)
+            return
+
+        self._remove(key)
+
+        size = self._sizeof(key, value)
+        self._data[key] = (value, expires_at, size)
+        self._memory += size
+
+        self._evict()
+
+    def delete(self, key: K) -> Optional[V]:
+        item = self._remove(key)
+        return item[0] if item is not None else None
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._memory = 0
+
+    def purge_expired(self) -> int:
+        now = self._clock()
+        expired = [k for k, (_, expires_at, _) in self._data.items() if expires_at <= now]
+        for key in expired:
+            self._remove(key)
+
+        self.stats.expirations += len(expired)
+        return len(expired)
+
+    def _remove(self, key: K) -> Optional[tuple[V, float, int]]:
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._memory -= item[2]
+        return item
+
+    def _is_full(self) -> bool:
+        if len(self._data) > self.max_size:
+            return True
+        return self.max_memory is not None and self._memory > self.max_memory
+
+    def _evict(self) -> None:
+        now = self._clock()
+        while self._data and self._is_full():
+            _, (_, expires_at, size) = self._data.popitem(last=False)
+            self._memory -= size
+            if expires_at <= now:
+                self.stats.expirations += 1
+            else:
+                self.stats.evictions += 1
@@ -0,0 +1,95 @@
+"""Stops calling an upstream service for a while after it keeps failing."""
+
+import enum
+import time
+from typing import Callable
+
+
+class CircuitState(enum.Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures.
+
+    While open, calls are rejected right away. After `reset_timeout` seconds a
+    single probe call is let through in the half-open state. The circuit closes
+    again if the probe succeeds, and opens for another `reset_timeout` if it
+    fails.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int,
+        reset_timeout: float,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+
+        self.state = CircuitState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def is_open(self) -> bool:
+        """Whether calls are currently being rejected without a probe."""
+        if self.state == CircuitState.CLOSED:
+            return False
+        if self.state == CircuitState.HALF_OPEN:
+            return self._probing
+        return self._clock() < self._opened_at + self.reset_timeout
+
+    def allow_request(self) -> bool:
+        if self.state == CircuitState.CLOSED:
+            return True
+
+        if self.state == CircuitState.OPEN and not self.is_open:
+            self.state = CircuitState.HALF_OPEN
+
+        if self.state == CircuitState.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self.state = CircuitState.CLOSED
+        self._failures = 0
+        self._probing = False
+
+    def release(self) -> None:
+        """Lets another probe through if the current one ended without a
+        result, e.g. because it was cancelled."""
+        if self.state == CircuitState.HALF_OPEN:
+            self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if (
+            self.state == CircuitState.HALF_OPEN
+            or self._failures >= self.failure_threshold
+        ):
+            self._open()
+
+    def _open(self) -> None:
+        if self.state != CircuitState.OPEN:
+            self.times_opened += 1
+        self.state = CircuitState.OPEN
+        self._opened_at = self._clock()
+        self._probing = False
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "open": int(self.state != CircuitState.CLOSED),
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
@@ -1,13 +1,104 @@
+import asyncio
+import bisect
+import functools
+import hashlib
 import json
-from typing import Any, Optional
+import logging
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Generator,
+    Iterator,
+    Optional,
+    TypeVar,
+    cast,
+)
 
-from asyncpg.pool import Pool, PoolAcquireContext
+from asyncpg.pool import Pool, PoolAcquireContext, PoolConnectionProxy
+
+from app.exceptions import MultipleConnectionsAcquired
+from app.utils.metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds of the acquire latency histogram buckets
+ACQUIRE_TIME_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Distinct queries that get their own name, the rest are counted as "other"
+MAX_QUERY_NAMES = 1000
+
+DB_POOL_ACQUIRE_SECONDS = Histogram(
+    "db_pool_acquire_seconds",
+    "Time spent waiting for a connection from the pool",
+    ["pool"],
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_seconds",
+    "Duration of database queries",
+    ["query"],
+)
+DB_QUERY_ERRORS = Counter(
+    "db_query_errors_total",
+    "Database queries that raised",
+    ["query"],
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "db_pool_connections",
+    "Connections of the pools by state, updated when metrics are scraped",
+    ["pool", "state"],
+)
+DB_MULTIPLE_CONNECTION_REQUESTS = Counter(
+    "db_multiple_connection_requests_total",
+    "Requests that acquired more than one pool connection",
+    ["route"],
+)
+
+_TABLE_RE = re.compile(r"\b(?:from|into|update)\s+([a-z_][a-z0-9_]*)")
+_query_names: dict[str, str] = {}
+
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+# Set while a method marked with `read_only` runs
+_read_only: ContextVar[bool] = ContextVar("read_only", default=False)
+# Access token of the request being handled, see `Database.note_write`
+_session: ContextVar[Optional[str]] = ContextVar("session", default=None)
+
+
+def read_only(func: F) -> F:
+    """Marks a repository method that only reads.
+
+    Connections it acquires through `MaybeAcquire`, or gets from a
+    `RequestConnection` passed as `conn`, come from the read replica when one
+    is configured, unless the session wrote recently. A concrete connection
+    passed as `conn` is used as is.
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        token = _read_only.set(True)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _read_only.reset(token)
+
+    return cast(F, wrapper)
 
 
 class MaybeAcquire:
     """Aqcuires a connection from the connection pool only if the
     connection passed is None. This exists to avoid having to acquire
     a new connection multiple times during a single function.
+
+    A `RequestConnection` passed is resolved to the connection of the request.
+
+    Whether to read from the replica is decided when entering the block.
+    Methods called inside it, and tasks they start, no longer count as
+    `read_only`.
     """
 
     def __init__(
@@ -18,14 +109,375 @@ class MaybeAcquire:
         self._connection = connection
         self.pool = pool
         self._cleanup = False
+        self._read_only_token: Optional[Token[bool]] = None
 
     async def __aenter__(self) -> PoolAcquireContext:
-        if self._connection is None:
+        read_only = _read_only.get()
+        self._read_only_token = _read_only.set(False)
+        try:
+            return await self._acquire(read_only)
+        except BaseException:
+            _read_only.reset(self._read_only_token)
+            raise
+
+    async def _acquire(self, read_only: bool) -> PoolAcquireContext:
+        connection = self._connection
+        if isinstance(connection, RequestConnection):
+            if read_only:
+                return await connection.get_for_read()
+            return await connection.get()
+
+        if connection is None:
+            if read_only:
+                self.pool = self.pool.get_replica(_session.get()) or self.pool
             self._cleanup = True
             self._connection = c = await self.pool.acquire()
             return c
         return self._connection
 
     async def __aexit__(self, *args: Any) -> None:
-        if self._cleanup:
-            await self.pool.release(self._connection)
+        try:
+            if self._cleanup:
+                await self.pool.release(self._connection)
+        finally:
+            if self._read_only_token is not None:
+                _read_only.reset(self._read_only_token)
+
+
+async def estimate_count(conn: Pool, query: str, *args: Any) -> int:
+    """The number of rows the planner expects `query` to return, from table
+    statistics and without running it."""
+    plan = await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args)
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class RequestConnection:
+    """A single pool connection shared by everything handling a request.
+
+    The connection is acquired the first time it is used and held until
+    `release` is called, so requests answered without the database never
+    take a connection from the pool.
+
+        async with request.connection as conn:
+            ...
+
+    Leaving the block does not release the connection, later blocks of the
+    same request get the same one.
+
+    It can also be passed as `conn` to repository methods. Methods marked
+    `read_only` then read from `replica_pool` until the request has used the
+    primary connection, after which they use that one too, so a request
+    always sees its own writes.
+    """
+
+    def __init__(self, pool: Pool, replica_pool: Optional[Pool] = None) -> None:
+        self.pool = pool
+        self.replica_pool = replica_pool
+        self._connection: Optional[PoolConnectionProxy] = None
+        self._replica_connection: Optional[PoolConnectionProxy] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def acquired(self) -> bool:
+        return self._connection is not None
+
+    async def get(self) -> PoolConnectionProxy:
+        if self._connection is None:
+            async with self._lock:
+                if self._connection is None:
+                    self._connection = await self.pool.acquire()
+        return self._connection
+
+    async def get_for_read(self) -> PoolConnectionProxy:
+        if self._connection is not None or self.replica_pool is None:
+            return await self.get()
+
+        if self._replica_connection is None:
+            async with self._lock:
+                if self._replica_connection is None:
+                    self._replica_connection = await self.replica_pool.acquire()
+        return self._replica_connection
+
+    async def __aenter__(self) -> PoolConnectionProxy:
+        return await self.get()
+
+    async def __aexit__(self, *args: Any) -> None:
+        pass
+
+    async def release(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            await self.pool.release(connection)
+
+        replica_connection, self._replica_connection = self._replica_connection, None
+        if replica_connection is not None and self.replica_pool is not None:
+            await self.replica_pool.release(replica_connection)
+
+
+class PoolStats:
+    """Counts acquisitions of pool connections and how long they waited."""
+
+    def __init__(self) -> None:
+        self.waiting = 0
+        self.acquired = 0
+        self.failed = 0
+        self.acquire_time = 0.0
+        self.max_acquire_time = 0.0
+        # One extra bucket for everything slower than the last bound
+        self.buckets = [0] * (len(ACQUIRE_TIME_BUCKETS) + 1)
+
+    def observe(self, seconds: float) -> None:
+        self.acquired += 1
+        self.acquire_time += seconds
+        self.max_acquire_time = max(self.max_acquire_time, seconds)
+        self.buckets[bisect.bisect_left(ACQUIRE_TIME_BUCKETS, seconds * 1000)] += 1
+
+    def get_stats(self) -> dict[str, int]:
+        stats = {
+            "waiting": self.waiting,
+            "acquired": self.acquired,
+            "failed": self.failed,
+            "acquire_time_ms": int(self.acquire_time * 1000),
+            "max_acquire_time_ms": int(self.max_acquire_time * 1000),
+        }
+
+        # Cumulative like Prometheus histograms
+        count = 0
+        for bound, bucket in zip(ACQUIRE_TIME_BUCKETS, self.buckets):
+            count += bucket
+            stats[f"acquire_le_{bound}ms"] = count
+        stats["acquire_le_inf"] = count + self.buckets[-1]
+
+        return stats
+
+
+class InstrumentedPool:
+    """Wraps an asyncpg pool to record how long acquiring a connection takes.
+
+    Pools of read replicas are created with `read_only`, which makes Postgres
+    reject writes on their connections. They are left out of the connection
+    usage of requests, which is about connections to the primary.
+    """
+
+    def __init__(self, pool: Pool, read_only: bool = False) -> None:
+        self._pool = pool
+        self.name = "replica" if read_only else "primary"
+        self.read_only = read_only
+        self.stats = PoolStats()
+        # The pool of the read replica that reads of a session may use, see
+        # `read_only`. Set by the database when it has a replica.
+        self.get_replica: Callable[
+            [Optional[str]], Optional[InstrumentedPool]
+        ] = lambda session: None
+        # Notified whenever a connection goes back to the pool
+        self._released = asyncio.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> "PoolAcquire":
+        """Like `Pool.acquire`, it can be awaited or used with `async with`."""
+        return PoolAcquire(self, timeout)
+
+    async def _acquire(self, timeout: Optional[float]) -> "InstrumentedConnection":
+        start = time.perf_counter()
+        self.stats.waiting += 1
+        try:
+            connection = await self._pool.acquire(timeout=timeout)
+        except BaseException:
+            self.stats.failed += 1
+            raise
+        finally:
+            self.stats.waiting -= 1
+
+        elapsed = time.perf_counter() - start
+        self.stats.observe(elapsed)
+        DB_POOL_ACQUIRE_SECONDS.observe(elapsed, self.name)
+
+        usage = _connection_usage.get()
+        if usage is not None and not self.read_only:
+            usage.acquired += 1
+            if usage.strict and usage.acquired > 1:
+                await self.release(connection)
+                raise MultipleConnectionsAcquired(
+                    f"Acquired {usage.acquired} connections in a single request"
+                )
+
+        return InstrumentedConnection(connection)
+
+    async def release(
+        self, connection: PoolConnectionProxy, timeout: Optional[float] = None
+    ) -> None:
+        if isinstance(connection, InstrumentedConnection):
+            connection = connection.connection
+        await self._pool.release(connection, timeout=timeout)
+        async with self._released:
+            self._released.notify_all()
+
+    async def wait_until(self, predicate: Callable[[], bool]) -> None:
+        """Waits until `predicate` holds, checking it again every time a
+        connection is released."""
+        async with self._released:
+            await self._released.wait_for(predicate)
+
+    async def close(self) -> None:
+        await self._pool.close()
+
+    def get_size(self) -> int:
+        return int(self._pool.get_size())
+
+    def get_idle_size(self) -> int:
+        return int(self._pool.get_idle_size())
+
+    def get_min_size(self) -> int:
+        return int(self._pool.get_min_size())
+
+    def get_max_size(self) -> int:
+        return int(self._pool.get_max_size())
+
+    def get_stats(self) -> dict[str, int]:
+        return {
+            "size": self.get_size(),
+            "idle": self.get_idle_size(),
+            "min_size": self.get_min_size(),
+            "max_size": self.get_max_size(),
+            **self.stats.get_stats(),
+        }
+
+
+class PoolAcquire:
+    """A connection of an `InstrumentedPool`, released when leaving the block."""
+
+    def __init__(self, pool: InstrumentedPool, timeout: Optional[float]) -> None:
+        self._pool = pool
+        self._timeout = timeout
+        self._connection: Optional[InstrumentedConnection] = None
+
+    def __await__(self) -> Generator[Any, None, "InstrumentedConnection"]:
+        return self._pool._acquire(self._timeout).__await__()
+
+    async def __aenter__(self) -> "InstrumentedConnection":
+        self._connection = await self._pool._acquire(self._timeout)
+        return self._connection
+
+    async def __aexit__(self, *args: Any) -> None:
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            await self._pool.release(connection)
+
+
+def get_query_name(query: str) -> str:
+    """Returns a stable name for a query, like `select_groups_1a2b3c4d`.
+
+    The name is made from the statement type, the first table and a hash of
+    the query with whitespace normalized.
+    """
+    name = _query_names.get(query)
+    if name is not None:
+        return name
+
+    if len(_query_names) >= MAX_QUERY_NAMES:
+        return "other"
+
+    normalized = " ".join(query.split()).lower()
+    verb = normalized.split(" ", 1)[0] if normalized else "empty"
+    table = _TABLE_RE.search(normalized)
+    digest = hashlib.sha1(normalized.encode()).hexdigest()[:8]
+
+    name = "_".join(p for p in (verb, table and table.group(1), digest) if p)
+    _query_names[query] = name
+    return name
+
+
+class InstrumentedConnection:
+    """Wraps a pool connection to time its queries, named by `get_query_name`.
+
+    Everything else, like `transaction`, goes to the connection as is.
+    """
+
+    def __init__(self, connection: PoolConnectionProxy) -> None:
+        self.connection = connection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.connection, name)
+
+    async def _timed(
+        self,
+        method: Callable[..., Awaitable[Any]],
+        query: str,
+        *args: Any,
+        **kwargs: Any,
+    ) -> Any:
+        name = get_query_name(query)
+        start = time.perf_counter()
+        try:
+            return await method(query, *args, **kwargs)
+        except BaseException:
+            DB_QUERY_ERRORS.inc(name)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, name)
+
+    async def execute(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._timed(self.connection.execute, query, *args, **kwargs)
+
+    async def executemany(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._timed(self.connection.executemany, query, *args, **kwargs)
+
+    async def fetch(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._timed(self.connection.fetch, query, *args, **kwargs)
+
+    async def fetchrow(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._timed(self.connection.fetchrow, query, *args, **kwargs)
+
+    async def fetchval(self, query: str, *args: Any, **kwargs: Any) -> Any:
+        return await self._timed(self.connection.fetchval, query, *args, **kwargs)
+
+
+class ConnectionUsage:
+    __slots__ = ("acquired", "strict")
+
+    def __init__(self, strict: bool = False) -> None:
+        self.acquired = 0
+        self.strict = strict
+
+
+_connection_usage: ContextVar[Optional[ConnectionUsage]] = ContextVar(
+    "connection_usage", default=None
+)
+
+
+@contextmanager
+def track_connection_usage(strict: bool = False) -> Iterator[ConnectionUsage]:
+    """Counts the pool connections acquired inside the block, including by
+    tasks started in it.
+
+    If `strict` is set, acquiring a second connection raises
+    `MultipleConnectionsAcquired`.
+    """
+    usage = ConnectionUsage(strict)
+    token = _connection_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _connection_usage.reset(token)
+
+
+@contextmanager
+def use_session(session: Optional[str]) -> Iterator[None]:
+    """Connections acquired inside the block for `read_only` methods come from
+    the replica only if `session` did not write recently."""
+    token = _session.set(session)
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+def untrack_connection_usage() -> None:
+    """Stops counting the connections of the current task towards the
+    tracked block it was started in.
+
+    For tasks shared by several requests, which can't use the connection of
+    any one of them.
+    """
+    _connection_usage.set(None)
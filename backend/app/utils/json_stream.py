@@ -0,0 +1,128 @@
+"""Incremental parsing of JSON arrays nested inside large response bodies."""
+
+import codecs
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Sequence
+
+WHITESPACE = " \t\n\r"
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """Reads JSON values out of a stream of byte chunks.
+
+    Only the part of the stream that has not been consumed yet is kept in
+    memory, so the buffer stays around the size of the largest single value
+    that is read.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes]) -> None:
+        self._chunks = chunks.__aiter__()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+
+    async def _fill(self) -> bool:
+        if self._eof:
+            return False
+
+        try:
+            chunk = await self._chunks.__anext__()
+        except StopAsyncIteration:
+            self._buffer = self._buffer[self._pos :] + self._utf8.decode(b"", True)
+            self._pos = 0
+            self._eof = True
+            return False
+
+        self._buffer = self._buffer[self._pos :] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+
+    async def peek(self) -> str:
+        """Skips whitespace and returns the next character, or "" at the end."""
+        while True:
+            while self._pos < len(self._buffer):
+                char = self._buffer[self._pos]
+                if char not in WHITESPACE:
+                    return char
+                self._pos += 1
+
+            if not await self._fill():
+                return ""
+
+    async def expect(self, char: str) -> None:
+        found = await self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in JSON stream, got {found!r}")
+        self._pos += 1
+
+    async def read_value(self) -> Any:
+        first = await self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not await self._fill():
+                    raise
+                continue
+
+            # A number or literal at the end of the buffer may continue in
+            # the next chunk
+            if first in '{["' or end < len(self._buffer) or self._eof:
+                self._pos = end
+                return value
+
+            await self._fill()
+
+
+async def _skip_to(reader: _Reader, path: Sequence[str]) -> bool:
+    """Moves the reader to the value at `path`, walking through objects."""
+    for key in path:
+        if await reader.peek() != "{":
+            return False
+        await reader.expect("{")
+
+        while True:
+            if await reader.peek() == "}":
+                return False
+
+            current_key = await reader.read_value()
+            await reader.expect(":")
+            if current_key == key:
+                break
+
+            await reader.read_value()
+            if await reader.peek() == ",":
+                await reader.expect(",")
+
+    return True
+
+
+async def iter_json_array(
+    chunks: AsyncIterable[bytes],
+    path: Sequence[str],
+) -> AsyncIterator[Any]:
+    """Yields the items of the array found at `path` as they are parsed.
+
+    `path` is the list of object keys leading to the array, e.g.
+    `["result", "data", "json", "items"]` for a tRPC response. Nothing is
+    yielded if the path does not exist or does not point to an array. Values
+    before the array are parsed in full just to be skipped, and everything
+    after it is never read.
+    """
+    reader = _Reader(chunks)
+    if not await _skip_to(reader, path) or await reader.peek() != "[":
+        return
+
+    await reader.expect("[")
+    if await reader.peek() == "]":
+        return
+
+    while True:
+        yield await reader.read_value()
+
+        if await reader.peek() == "]":
+            return
+        await reader.expect(",")
@@ -0,0 +1,215 @@
+"""Minimal Prometheus style metrics, rendered in the text exposition format.
+
+Metrics are created once at import time and register themselves in
+`REGISTRY`. Recording only looks up the series of the given label values and
+updates numbers in place, so it is cheap enough for the hot path.
+"""
+
+import bisect
+from typing import Callable, Iterable, Optional, Sequence
+
+# Seconds, suitable for request and query latencies
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    type = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional["Registry"] = None,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry or REGISTRY).register(self)
+
+    def _check_labels(self, labels: tuple[str, ...]) -> None:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {labels}"
+            )
+
+    def collect(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {_escape(self.documentation)}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.collect()
+
+
+class Counter(Metric):
+    """By convention the name of a counter ends with `_total`."""
+
+    type = "counter"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional["Registry"] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self._values
+        if labels not in values:
+            self._check_labels(labels)
+            values[labels] = 0
+        values[labels] += amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def collect(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}{label_str} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional["Registry"] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._functions: dict[tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, *labels: str) -> None:
+        if labels not in self._values:
+            self._check_labels(labels)
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        values = self._values
+        if labels not in values:
+            self._check_labels(labels)
+            values[labels] = 0
+        values[labels] += amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, function: Callable[[], float], *labels: str) -> None:
+        """Reads the value from `function` whenever the metrics are rendered."""
+        self._check_labels(labels)
+        self._functions[labels] = function
+
+    def get(self, *labels: str) -> float:
+        function = self._functions.get(labels)
+        if function is not None:
+            return function()
+        return self._values.get(labels, 0)
+
+    def collect(self) -> Iterable[str]:
+        values = dict(self._values)
+        values.update({k: f() for k, f in self._functions.items()})
+        for labels, value in values.items():
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}{label_str} {_format_value(value)}"
+
+
+class _HistogramSeries:
+    __slots__ = ("buckets", "sum", "count")
+
+    def __init__(self, size: int) -> None:
+        # One extra bucket for values above the last bound
+        self.buckets = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Optional["Registry"] = None,
+    ) -> None:
+        super().__init__(name, documentation, labelnames, registry)
+        self.bounds = tuple(sorted(buckets))
+        self._series: dict[tuple[str, ...], _HistogramSeries] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            self._check_labels(labels)
+            series = self._series[labels] = _HistogramSeries(len(self.bounds))
+
+        series.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    def get_count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series.count if series is not None else 0
+
+    def get_sum(self, *labels: str) -> float:
+        series = self._series.get(labels)
+        return series.sum if series is not None else 0
+
+    def collect(self) -> Iterable[str]:
+        names = (*self.labelnames, "le")
+        for labels, series in self._series.items():
+            # Buckets are cumulative in the exposition format
+            count = 0
+            for bound, bucket in zip((*self.bounds, float("inf")), series.buckets):
+                count += bucket
+                label_str = _format_labels(names, (*labels, _format_value(bound)))
+                yield f"{self.name}_bucket{label_str} {count}"
+
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {_format_value(series.sum)}"
+            yield f"{self.name}_count{label_str} {series.count}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> None:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = [line for m in self._metrics.values() for line in m.render()]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
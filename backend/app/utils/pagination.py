@@ -1,10 +1,26 @@
-from typing import Awaitable, Generic, Optional, Protocol, TypeVar
+import asyncio
+import base64
+import binascii
+import enum
+import json
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Generic,
+    Optional,
+    Protocol,
+    Sequence,
+    TypeVar,
+    cast,
+)
 
 from asyncpg import Pool
+from fastapi import HTTPException
 from pydantic.generics import GenericModel
 
 from app.api import Request
-from app.utils.db import MaybeAcquire
+from app.utils.db import untrack_connection_usage
 
 T = TypeVar("T")
 
@@ -14,6 +30,13 @@ class TotalCoro(Protocol):
         ...
 
 
+class EstimatedTotalCoro(Protocol):
+    """Returns the planner's estimate of the total if `estimate`."""
+
+    def __call__(self, conn: Optional[Pool], estimate: bool = False) -> Awaitable[int]:
+        ...
+
+
 class ResultsCoro(Protocol, Generic[T]):
     def __call__(
         self,
@@ -24,8 +47,95 @@ class ResultsCoro(Protocol, Generic[T]):
         ...
 
 
+class SeekResultsCoro(Protocol, Generic[T]):
+    """Returns the `limit` rows after the sort key `after`, or the ones before
+    it if `backwards`. Rows are in the same order either way."""
+
+    def __call__(
+        self,
+        offset: int,
+        limit: int,
+        conn: Optional[Pool] = None,
+        after: Optional[Sequence[Any]] = None,
+        backwards: bool = False,
+    ) -> Awaitable[list[T]]:
+        ...
+
+
+class WindowResultsCoro(Protocol, Generic[T]):
+    """Returns the results and the total, counted in the same statement with
+    `COUNT(*) OVER ()`. The total is None for a page past the last one."""
+
+    def __call__(
+        self,
+        offset: int,
+        limit: int,
+        conn: Optional[Pool] = None,
+    ) -> Awaitable[tuple[list[T], Optional[int]]]:
+        ...
+
+
+class CountStrategy(enum.Enum):
+    # Counted on every request
+    EXACT = "exact"
+    # Counted, then reused until it expires or something is written
+    CACHED = "cached"
+    # The planner's row estimate, which can be off by a bit
+    ESTIMATE = "estimate"
+    # Not counted, `next` tells whether there are more results
+    NONE = "none"
+
+
+class PaginationQueries(enum.Enum):
+    # The total, then the results, on the connection of the request
+    SEQUENTIAL = "sequential"
+    # The total on a connection of its own, at the same time as the results
+    PARALLEL = "parallel"
+    # A single statement that counts with `COUNT(*) OVER ()`, for pages by
+    # number. Pages by cursor only see the rows after the cursor, so they
+    # run sequentially.
+    WINDOW = "window"
+
+
+class CursorKey(Generic[T]):
+    """The sort key of a row, ending with a unique tie-breaker, and the types
+    to parse its values back into when they are read from a cursor."""
+
+    def __init__(
+        self,
+        get: Callable[[T], Sequence[Any]],
+        types: Sequence[Callable[[Any], Any]],
+    ) -> None:
+        self.get = get
+        self.types = types
+
+
+def encode_cursor(key: Sequence[Any], backwards: bool = False) -> str:
+    data = json.dumps([backwards, list(key)], default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(
+    cursor: str, types: Sequence[Callable[[Any], Any]]
+) -> tuple[list[Any], bool]:
+    """Returns the sort key and direction of a cursor, or raises ValueError if
+    it isn't one."""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        backwards, key = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+
+    if not isinstance(key, list) or len(key) != len(types):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    try:
+        return [type_(value) for type_, value in zip(types, key)], bool(backwards)
+    except (AttributeError, TypeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor {cursor!r}") from exc
+
+
 class Page(GenericModel, Generic[T]):
-    total: int
+    total: Optional[int]
     next: Optional[str]
     previous: Optional[str]
     results: list[T]
@@ -39,7 +149,25 @@ class Pagination(Generic[T]):
         results_coro: ResultsCoro[T],
         page: int,
         page_size: int,
+        cursor: Optional[str] = None,
+        cursor_key: Optional[CursorKey[T]] = None,
+        count: CountStrategy = CountStrategy.EXACT,
+        queries: PaginationQueries = PaginationQueries.SEQUENTIAL,
+        window_coro: Optional[WindowResultsCoro[T]] = None,
     ) -> None:
+        """Pages are fetched by number, or by cursor if `cursor` is given and
+        the results support it through `cursor_key`. An empty cursor is the
+        first page.
+
+        Cursors seek to the rows after the last row of the previous page, so
+        deep pages are as fast as the first. `results_coro` must then be a
+        `SeekResultsCoro`.
+
+        `count` decides how the total is found. With `CountStrategy.ESTIMATE`
+        `total_coro` must be an `EstimatedTotalCoro`. `queries` decides how the
+        total and results queries run when the total has to be counted, where
+        `PaginationQueries.WINDOW` needs `window_coro`.
+        """
         self._request = request
         self._url = request.url
 
@@ -47,6 +175,11 @@ class Pagination(Generic[T]):
         self._results_coro = results_coro
         self._page = page
         self._page_size = page_size
+        self._cursor = cursor if cursor_key is not None else None
+        self._cursor_key = cursor_key
+        self._count = count
+        self._queries = queries
+        self._window_coro = window_coro
 
     def _get_url(self, page: int) -> str:
         query_params = dict(self._request.query_params)
@@ -55,6 +188,79 @@ class Pagination(Generic[T]):
         replaced = self._url.replace_query_params(**query_params)
         return str(replaced)
 
+    def _get_count_key(self) -> str:
+        """Requests for other pages of the same results share the count."""
+        query_params = {
+            k: v
+            for k, v in self._request.query_params.items()
+            if k not in ("page", "page_size", "cursor")
+        }
+        return f"{self._url.path}?{sorted(query_params.items())}"
+
+    async def _count_total(self, conn: Optional[Pool]) -> int:
+        if self._count is CountStrategy.ESTIMATE:
+            total_coro = cast(EstimatedTotalCoro, self._total_coro)
+            return await total_coro(conn=conn, estimate=True)
+        return await self._total_coro(conn=conn)
+
+    async def _count_total_on_own_connection(self) -> int:
+        # Runs in a task of its own, so the second connection it takes on
+        # purpose isn't counted against the request
+        untrack_connection_usage()
+        return await self._count_total(conn=None)
+
+    async def _fetch(
+        self,
+        get_results: Callable[[Optional[Pool]], Awaitable[list[T]]],
+        conn: Optional[Pool],
+        get_window_results: Optional[
+            Callable[[Optional[Pool]], Awaitable[tuple[list[T], Optional[int]]]]
+        ] = None,
+    ) -> tuple[Optional[int], list[T]]:
+        """Returns the total and the results."""
+        if self._count is CountStrategy.NONE:
+            return None, await get_results(conn)
+
+        count_cache = self._request.app.db.count_cache
+        if self._count is CountStrategy.CACHED:
+            cached = count_cache.get(self._get_count_key())
+            if cached is not None:
+                return cached, await get_results(conn)
+
+        queries = self._queries
+        if (
+            queries is PaginationQueries.WINDOW
+            and get_window_results is not None
+            and self._count is not CountStrategy.ESTIMATE
+        ):
+            results, window_total = await get_window_results(conn)
+            # Past the last page, there was no row to count on
+            total = (
+                window_total
+                if window_total is not None
+                else await self._count_total(conn)
+            )
+        elif queries is PaginationQueries.PARALLEL:
+            total, results = await asyncio.gather(
+                self._count_total_on_own_connection(), get_results(conn)
+            )
+        else:
+            total = await self._count_total(conn)
+            results = await get_results(conn)
+
+        if self._count is CountStrategy.CACHED:
+            count_cache.set(self._get_count_key(), total)
+        return total, results
+
+    def _get_cursor_url(self, row: T, backwards: bool) -> str:
+        assert self._cursor_key is not None
+        query_params = dict(self._request.query_params)
+        query_params.pop("page", None)
+        query_params["cursor"] = encode_cursor(self._cursor_key.get(row), backwards)
+
+        replaced = self._url.replace_query_params(**query_params)
+        return str(replaced)
+
     async def paginate(self, conn: Optional[Pool] = None) -> Page[T]:
         page = self._page
         page_size = self._page_size
@@ -62,13 +268,71 @@ class Pagination(Generic[T]):
         offset = page * page_size
         limit = page_size
 
-        async with MaybeAcquire(conn, self._request.app.db.pool) as conn:
-            total = await self._total_coro(conn=conn)
-            results = await self._results_coro(offset, limit, conn=conn)
+        # Defaults to the connection of the request rather than acquiring
+        # another one
+        if conn is None:
+            conn = self._request.connection
+
+        if self._cursor is not None:
+            return await self._paginate_by_cursor(self._cursor, conn)
+
+        window_coro = self._window_coro
+        # One extra row tells whether there is a next page, even without a
+        # total to compare with
+        total, results = await self._fetch(
+            lambda c: self._results_coro(offset, limit + 1, conn=c),
+            conn,
+            (lambda c: window_coro(offset, limit + 1, conn=c)) if window_coro else None,
+        )
+        has_next = len(results) > limit
 
         return Page[T](
             total=total,
-            next=self._get_url(page + 1) if total > offset + limit else None,
+            next=self._get_url(page + 1) if has_next else None,
             previous=self._get_url(page - 1) if page > 0 else None,
+            results=results[:limit],
+        )
+
+    async def _paginate_by_cursor(self, cursor: str, conn: Optional[Pool]) -> Page[T]:
+        assert self._cursor_key is not None
+        page_size = self._page_size
+
+        after: Optional[list[Any]] = None
+        backwards = False
+        if cursor:
+            try:
+                after, backwards = decode_cursor(cursor, self._cursor_key.types)
+            except ValueError as exc:
+                raise HTTPException(status_code=400, detail="Ugyldig cursor") from exc
+
+        results_coro = cast(SeekResultsCoro[T], self._results_coro)
+        # One extra row tells whether there is another page in that direction
+        total, results = await self._fetch(
+            lambda c: results_coro(
+                0, page_size + 1, conn=c, after=after, backwards=backwards
+            ),
+            conn,
+        )
+
+        has_more = len(results) > page_size
+        if backwards:
+            results = results[-page_size:]
+            has_next, has_previous = True, has_more
+        else:
+            results = results[:page_size]
+            has_next, has_previous = has_more, after is not None
+
+        return Page[T](
+            total=total,
+            next=(
+                self._get_cursor_url(results[-1], backwards=False)
+                if has_next and results
+                else None
+            ),
+            previous=(
+                self._get_cursor_url(results[0], backwards=True)
+                if has_previous and results
+                else None
+            ),
             results=results,
         )
@@ -0,0 +1,119 @@
+"""
+Compares buffered and streaming parsing of a large OW `user.all` response.
+
+    python -m tests.benchmarks.ow_users [--users 200000] [--fixture response.json]
+
+Without --fixture a response with the given number of users is generated in a
+temporary file. A recorded response can be used instead by passing its path.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Coroutine
+
+from app.http import STREAM_CHUNK_SIZE, split_full_name
+from app.types import OWSyncUser
+from app.utils.json_stream import iter_json_array
+
+
+def create_fixture(path: Path, users: int) -> None:
+    rng = random.Random(0)
+
+    def word() -> str:
+        return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 10)))
+
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('{"result": {"data": {"json": {"items": [')
+        for i in range(users):
+            if i:
+                file.write(",")
+            item = {
+                "id": f"{rng.getrandbits(64):016x}",
+                "name": f"{word().capitalize()} {word().capitalize()}",
+                "email": f"{word()}@{word()}.no",
+                "biography": word() * 5,
+                "phone": None,
+            }
+            file.write(json.dumps(item))
+        file.write('], "nextCursor": null}}}}')
+
+
+def to_user(data: dict[str, Any]) -> OWSyncUser:
+    first_name, last_name = split_full_name(data.get("name", ""))
+    return OWSyncUser(
+        id=data["id"],
+        email=data["email"],
+        first_name=first_name,
+        last_name=last_name,
+    )
+
+
+async def read_chunks(path: Path) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := file.read(STREAM_CHUNK_SIZE):
+            yield chunk
+            await asyncio.sleep(0)
+
+
+async def buffered(path: Path) -> int:
+    """What `response.json()` does: read the whole body, then parse it."""
+    body = b"".join([chunk async for chunk in read_chunks(path)])
+    data = json.loads(body)
+    users = [to_user(item) for item in data["result"]["data"]["json"]["items"]]
+    return len(users)
+
+
+async def streaming(path: Path) -> int:
+    count = 0
+    items = iter_json_array(read_chunks(path), ["result", "data", "json", "items"])
+    async for item in items:
+        to_user(item)
+        count += 1
+    return count
+
+
+def measure(
+    name: str,
+    func: Callable[[Path], Coroutine[Any, Any, int]],
+    path: Path,
+) -> None:
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = asyncio.run(func(path))
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name:>10}: {count} users in {elapsed:.2f}s, "
+        f"peak memory {peak / 1024 / 1024:.1f} MiB"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200000)
+    parser.add_argument("--fixture", type=Path, default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = args.fixture
+        if path is None:
+            path = Path(directory) / "user_all.json"
+            create_fixture(path, args.users)
+
+        size = path.stat().st_size / 1024 / 1024
+        print(f"Fixture: {path} ({size:.1f} MiB)")
+        measure("buffered", buffered, path)
+        measure("streaming", streaming, path)
+
+
+if __name__ == "__main__":
+    main()
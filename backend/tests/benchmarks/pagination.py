@@ -0,0 +1,187 @@
+"""
+Compares how paginated lists run their count and results queries on a seeded
+database.
+
+    python -m tests.benchmarks.pagination --database <name> [--users 5000] [--punishments 200000] [--requests 200]
+
+The database is seeded with a group, its users and their punishments, which
+are removed again first on later runs. Use a database of its own, as other
+rows on the leaderboard or in the punishment log are timed too.
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from functools import partial
+from typing import Any, Optional
+
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient
+
+from app.api import FastAPI, Request
+from app.api.init_api import init_api
+from app.models.user import LogPunishmentOut, MinifiedLeaderboardUser
+from app.types import GroupId
+from app.utils.pagination import CountStrategy, Page, Pagination, PaginationQueries
+
+GROUP_ID = GroupId("cccccccc-cccc-cccc-cccc-cccccccccccc")
+PAGE_SIZE = 30
+
+
+async def seed(app: FastAPI, users: int, punishments: int) -> None:
+    async with app.db.pool.acquire() as conn:
+        await conn.execute("DELETE FROM groups WHERE group_id = $1", GROUP_ID)
+        await conn.execute("DELETE FROM users WHERE ow_user_id LIKE 'benchmark-%'")
+
+        await conn.execute(
+            """INSERT INTO groups (group_id, ow_group_id, name, name_short, rules, image)
+               VALUES ($1, 'benchmark', 'Benchmark', 'Benchmark', '', '')""",
+            GROUP_ID,
+        )
+        await conn.execute(
+            """INSERT INTO users (ow_user_id, first_name, last_name, email)
+               SELECT 'benchmark-' || i, 'User ' || i, 'Benchmark',
+                      'benchmark-' || i || '@benchmark.no'
+               FROM generate_series(1, $1) AS i""",
+            users,
+        )
+        await conn.execute(
+            """INSERT INTO group_members (group_id, user_id)
+               SELECT $1, user_id FROM users WHERE ow_user_id LIKE 'benchmark-%'""",
+            GROUP_ID,
+        )
+        await conn.execute(
+            """INSERT INTO punishment_types (group_id, name, value, emoji)
+               VALUES ($1, 'Beer', 33, '🍺'), ($1, 'Wine', 100, '🍷')""",
+            GROUP_ID,
+        )
+        # Spread over users, types and the last three years
+        await conn.execute(
+            """INSERT INTO group_punishments
+                   (group_id, user_id, punishment_type_id, reason, amount, created_at, paid)
+               SELECT $1, u.user_id, pt.punishment_type_id, 'Benchmark',
+                      1 + i % 3, now() - (i % 1000) * interval '1 day', i % 4 = 0
+               FROM generate_series(1, $2) AS i
+               JOIN (
+                   SELECT user_id, row_number() OVER () - 1 AS n
+                   FROM users WHERE ow_user_id LIKE 'benchmark-%'
+               ) u ON u.n = i % $3
+               JOIN (
+                   SELECT punishment_type_id, row_number() OVER () - 1 AS n
+                   FROM punishment_types WHERE group_id = $1
+               ) pt ON pt.n = i % 2""",
+            GROUP_ID,
+            punishments,
+            users,
+        )
+
+    await app.db.leaderboard.rebuild()
+    async with app.db.pool.acquire() as conn:
+        await conn.execute("ANALYZE")
+
+
+def add_routes(app: FastAPI) -> None:
+    @app.get("/benchmark/leaderboard")
+    async def leaderboard(
+        request: Request, page: int, queries: str
+    ) -> Page[MinifiedLeaderboardUser]:
+        args = (True, None, False, "total")
+        pagination = Pagination[MinifiedLeaderboardUser](
+            request=request,
+            total_coro=partial(app.db.users.get_leaderboard_count, False),
+            results_coro=partial(app.db.users.get_minified_leaderboard, *args),
+            page=page,
+            page_size=PAGE_SIZE,
+            count=CountStrategy.EXACT,
+            queries=PaginationQueries(queries),
+            window_coro=partial(app.db.users.get_minified_leaderboard_with_total, *args),
+        )
+        return await pagination.paginate()
+
+    @app.get("/benchmark/log")
+    async def log(request: Request, page: int, queries: str) -> Page[LogPunishmentOut]:
+        pagination = Pagination[LogPunishmentOut](
+            request=request,
+            total_coro=partial(app.db.punishments.get_all_count, group_id=GROUP_ID),
+            results_coro=partial(app.db.punishments.get_all, group_id=GROUP_ID),
+            page=page,
+            page_size=PAGE_SIZE,
+            count=CountStrategy.EXACT,
+            queries=PaginationQueries(queries),
+            window_coro=partial(app.db.punishments.get_all_with_total, group_id=GROUP_ID),
+        )
+        return await pagination.paginate()
+
+
+async def measure(
+    client: AsyncClient,
+    path: str,
+    queries: PaginationQueries,
+    requests: int,
+    pages: int,
+) -> Optional[int]:
+    total = None
+    timings = []
+    # The first request warms up connections and statement caches
+    for i in range(requests + 1):
+        params = {"page": i * 7 % pages, "queries": queries.value}
+        start = time.perf_counter()
+        res = await client.get(path, params=params)
+        elapsed = time.perf_counter() - start
+        res.raise_for_status()
+        total = res.json()["total"]
+        if i:
+            timings.append(elapsed * 1000)
+
+    timings.sort()
+    print(
+        f"{path:>22} {queries.value:>10}: "
+        f"mean {statistics.mean(timings):.1f}ms, "
+        f"p50 {timings[len(timings) // 2]:.1f}ms, "
+        f"p95 {timings[int(len(timings) * 0.95)]:.1f}ms"
+    )
+    return total
+
+
+async def run(args: argparse.Namespace) -> None:
+    app = init_api(database=args.database)
+    add_routes(app)
+
+    async with LifespanManager(app):
+        start = time.perf_counter()
+        await seed(app, args.users, args.punishments)
+        print(
+            f"Seeded {args.users} users and {args.punishments} punishments "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+        async with AsyncClient(app=app, base_url="http://benchmark") as client:
+            for path, rows in (
+                ("/benchmark/leaderboard", args.users),
+                ("/benchmark/log", args.punishments),
+            ):
+                pages = max(rows // PAGE_SIZE, 1)
+                totals: set[Any] = set()
+                for queries in PaginationQueries:
+                    totals.add(
+                        await measure(client, path, queries, args.requests, pages)
+                    )
+                assert len(totals) == 1, f"The totals differ: {totals}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--punishments", type=int, default=200000)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
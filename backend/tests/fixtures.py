@@ -5,6 +5,7 @@ import os
 import re
 from typing import Any, AsyncGenerator
 
+import pytest
 import pytest_asyncio
 from aioresponses import aioresponses
 from asgi_lifespan import LifespanManager
@@ -58,6 +59,13 @@ PUNISHMENT_1_ID = "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeaaab1"
 PUNISHMENT_2_ID = "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeaaab2"
 
 
+@pytest.fixture(scope="class")
+def database() -> str:
+    """A database shared by the tests of a class. create-databases.sh creates
+    one for each `TestWithDB` class."""
+    return f"db{counter() + 1}"
+
+
 @pytest_asyncio.fixture(scope="class")
 async def client() -> AsyncGenerator[AsyncClient, None]:
     # Need to use a LifespanManager in order for the startup and shutdown event to be
@@ -0,0 +1,294 @@
+from typing import Any
+
+import pytest
+from aioresponses import CallbackResult, aioresponses
+from asgi_lifespan import LifespanManager
+
+from app.api.init_api import init_api
+from app.config import settings
+from app.http import BASE_OW5, create_trpc_input, parse_ow_group_members
+from app.scripts.bulk_sync import BulkSync
+from app.types import OWSyncGroup, PermissionPrivilege
+from tests.fixtures import database
+
+
+def trpc_response(value: Any) -> dict[str, Any]:
+    return {"result": {"data": {"json": value}}}
+
+
+def create_ow_user(i: int) -> dict[str, Any]:
+    return {"id": f"bulk-user-{i}", "name": f"Bulk User{i}", "email": f"bulk{i}@email.com"}
+
+
+def create_ow_group(slug: str) -> dict[str, Any]:
+    return {
+        "slug": slug,
+        "name": slug.capitalize(),
+        "abbreviation": slug.capitalize(),
+        "type": "COMMITTEE",
+        "imageUrl": None,
+    }
+
+
+def create_ow_member(i: int, roles: list[str], end: Any = None) -> list[Any]:
+    user = {
+        **create_ow_user(i),
+        "groupMemberships": [
+            {"end": end, "roles": [{"type": role} for role in roles]},
+        ],
+    }
+    return [user["id"], user]
+
+
+OW_USERS = [create_ow_user(i) for i in range(25)]
+OW_GROUPS = [
+    create_ow_group("bulkkom"),
+    create_ow_group("otherbulkkom"),
+    {**create_ow_group("bulkinterest"), "type": "INTEREST_GROUP"},
+]
+OW_MEMBERS = {
+    "bulkkom": [create_ow_member(i, ["LEADER"] if i == 0 else []) for i in range(10)],
+    "otherbulkkom": [create_ow_member(i, []) for i in range(10, 15)],
+}
+
+
+class TestWithDB_BulkSync:
+    @pytest.mark.asyncio
+    async def test_bulk_sync(self, database: str) -> None:
+        app = init_api(database=database)
+        members_by_slug = dict(OW_MEMBERS)
+
+        def get_members(slug: str) -> Any:
+            return lambda *args, **kwargs: CallbackResult(
+                payload=trpc_response(members_by_slug[slug])
+            )
+
+        with aioresponses() as m:
+            m.get(
+                f"{BASE_OW5}/user.all?input={create_trpc_input({'take': settings.ow_users_page_size})}",
+                payload=trpc_response({"items": OW_USERS, "nextCursor": None}),
+                repeat=True,
+            )
+            m.get(
+                f"{BASE_OW5}/group.all",
+                payload=trpc_response(OW_GROUPS),
+                repeat=True,
+            )
+            for slug in OW_MEMBERS:
+                m.get(
+                    f"{BASE_OW5}/group.getMembers?input={create_trpc_input(slug)}",
+                    callback=get_members(slug),
+                    repeat=True,
+                )
+
+            async with LifespanManager(app):
+                bulk_sync = BulkSync(app, "token", chunk_size=10)
+                timings = await bulk_sync.run()
+                assert set(timings) == {
+                    "users",
+                    "fetch_groups",
+                    "sync_groups",
+                }
+                assert bulk_sync.get_stats() == {
+                    "users": 25,
+                    "groups_synced": 2,
+                    "groups_unchanged": 0,
+                    "groups_failed": 0,
+                }
+
+                async with app.db.pool.acquire() as conn:
+                    # The database may hold bulk users of other tests
+                    users = await conn.fetchval(
+                        "SELECT COUNT(*) FROM users WHERE ow_user_id = ANY($1)",
+                        [u["id"] for u in OW_USERS],
+                    )
+                    assert users == 25
+
+                    rows = await conn.fetch(
+                        """SELECT g.ow_group_id, COUNT(*) AS members
+                           FROM group_members gm
+                           JOIN groups g ON g.group_id = gm.group_id
+                           WHERE g.ow_group_id LIKE '%bulk%'
+                           GROUP BY g.ow_group_id"""
+                    )
+                    assert {r["ow_group_id"]: r["members"] for r in rows} == {
+                        "bulkkom": 10,
+                        "otherbulkkom": 5,
+                    }
+
+                    owners = await conn.fetchval(
+                        """SELECT COUNT(*) FROM group_member_permissions p
+                           JOIN groups g ON g.group_id = p.group_id
+                           WHERE g.ow_group_id = 'bulkkom'
+                           AND p.privilege = 'group.owner'"""
+                    )
+                    assert owners == 1
+
+                # Nothing changed in OW, so the second run writes no groups
+                bulk_sync = BulkSync(app, "token", chunk_size=10)
+                await bulk_sync.run()
+                assert bulk_sync.groups_unchanged == 2
+
+                members_by_slug["bulkkom"] = [
+                    *OW_MEMBERS["bulkkom"][:-1],
+                    create_ow_member(9, [], end="2020-01-01T00:00:00"),
+                ]
+                bulk_sync = BulkSync(app, "token", chunk_size=10)
+                await bulk_sync.run()
+                assert bulk_sync.groups_synced == 1
+
+                bulk_sync = BulkSync(app, "token", chunk_size=10, force=True)
+                await bulk_sync.run()
+                assert bulk_sync.groups_synced == 2
+
+                async with app.db.pool.acquire() as conn:
+                    active = await conn.fetchval(
+                        """SELECT gm.active FROM group_members gm
+                           JOIN groups g ON g.group_id = gm.group_id
+                           JOIN users u ON u.user_id = gm.user_id
+                           WHERE g.ow_group_id = 'bulkkom'
+                           AND u.ow_user_id = 'bulk-user-9'"""
+                    )
+                    assert active is False
+
+
+class TestWithDB_SyncGroups:
+    @pytest.mark.asyncio
+    async def test_failing_group_does_not_roll_back_others(self, database: str) -> None:
+        app = init_api(database=database)
+
+        def parse_group(slug: str, name: str) -> OWSyncGroup:
+            return OWSyncGroup(**{**create_ow_group(slug), "name": name})
+
+        members = parse_ow_group_members(
+            [create_ow_member(i, ["LEADER"] if i == 0 else []) for i in range(3)]
+        )
+        groups = [
+            (parse_group("txkom", "Txkom"), members),
+            # Postgres rejects NUL characters in text
+            (parse_group("brokenkom", "Broken\x00kom"), members),
+            (parse_group("othertxkom", "Othertxkom"), members[1:]),
+        ]
+
+        async with LifespanManager(app):
+            with pytest.raises(Exception):
+                await app.ow_sync.sync_groups(groups)
+
+            async with app.db.pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """SELECT g.ow_group_id, COUNT(*) AS members
+                       FROM group_members gm
+                       JOIN groups g ON g.group_id = gm.group_id
+                       WHERE g.ow_group_id LIKE '%txkom'
+                       GROUP BY g.ow_group_id"""
+                )
+                assert {r["ow_group_id"]: r["members"] for r in rows} == {
+                    "txkom": 3,
+                    "othertxkom": 2,
+                }
+
+            # Only the groups that were written are remembered as unchanged
+            assert await app.ow_sync.sync_groups(groups[:1] + groups[2:]) == []
+            assert app.ow_sync.group_freshness.get_stats()["unchanged"] == 2
+
+    @pytest.mark.asyncio
+    async def test_reconcile_members(self, database: str) -> None:
+        app = init_api(database=database)
+        group = OWSyncGroup(**create_ow_group("reconcilekom"))
+        members = parse_ow_group_members(
+            [
+                create_ow_member(100, ["LEADER"]),
+                create_ow_member(101, ["PUNISHER"]),
+                create_ow_member(102, []),
+                create_ow_member(103, [], end="2020-01-01T00:00:00"),
+            ]
+        )
+
+        async with LifespanManager(app):
+            async with app.db.pool.acquire() as conn:
+                await conn.execute(
+                    "DELETE FROM groups WHERE ow_group_id = 'reconcilekom'"
+                )
+            await app.ow_sync.sync_groups([(group, members[:3])], force=True)
+
+            async with app.db.pool.acquire() as conn:
+                group_id = await conn.fetchval(
+                    "SELECT group_id FROM groups WHERE ow_group_id = 'reconcilekom'"
+                )
+                user_ids = {
+                    r["ow_user_id"]: r["user_id"]
+                    for r in await conn.fetch(
+                        "SELECT ow_user_id, user_id FROM users WHERE ow_user_id = ANY($1)",
+                        [m.id for m in members[:3]],
+                    )
+                }
+                # Given by hand, so it is kept even if OW doesn't know about it
+                await app.db.permissions.insert_permissions(
+                    group_id,
+                    user_ids["bulk-user-102"],
+                    [PermissionPrivilege("group.admin")],
+                    created_by=user_ids["bulk-user-100"],
+                    conn=conn,
+                )
+
+            leader, punisher, _, _ = members
+            changed = [
+                leader.copy(update={"first_name": "Renamed", "roles": []}),
+                punisher.copy(update={"roles": ["PUNISHER", "LEADER"]}),
+                members[3],
+            ]
+            res = await app.ow_sync.handle_group_update(group_id, changed)
+
+            async with app.db.pool.acquire() as conn:
+                user_ids.update(
+                    {
+                        r["ow_user_id"]: r["user_id"]
+                        for r in await conn.fetch(
+                            "SELECT ow_user_id, user_id FROM users WHERE ow_user_id = 'bulk-user-103'"
+                        )
+                    }
+                )
+
+                rows = await conn.fetch(
+                    """SELECT u.ow_user_id, u.first_name, gm.active, gm.inactive_at
+                       FROM group_members gm
+                       JOIN users u ON u.user_id = gm.user_id
+                       WHERE gm.group_id = $1""",
+                    group_id,
+                )
+                by_id = {r["ow_user_id"]: r for r in rows}
+                assert by_id["bulk-user-100"]["first_name"] == "Renamed"
+                assert by_id["bulk-user-100"]["active"] is True
+                assert by_id["bulk-user-102"]["active"] is False
+                assert by_id["bulk-user-102"]["inactive_at"] is not None
+                assert by_id["bulk-user-103"]["active"] is False
+                assert by_id["bulk-user-103"]["inactive_at"].year == 2020
+
+                permissions = await conn.fetch(
+                    """SELECT user_id, privilege FROM group_member_permissions
+                       WHERE group_id = $1""",
+                    group_id,
+                )
+                assert {(r["user_id"], r["privilege"]) for r in permissions} == {
+                    (user_ids["bulk-user-101"], "group.moderator"),
+                    (user_ids["bulk-user-101"], "group.owner"),
+                    (user_ids["bulk-user-102"], "group.admin"),
+                }
+
+            assert user_ids["bulk-user-100"] in res["users_upserted"]
+            assert user_ids["bulk-user-101"] not in res["users_upserted"]
+            assert res["members_added"] == [user_ids["bulk-user-103"]]
+            assert res["members_deactivated"] == [user_ids["bulk-user-102"]]
+            assert res["members_reactivated"] == []
+            assert res["privileges_added"] == [
+                (user_ids["bulk-user-101"], "group.owner")
+            ]
+            assert res["privileges_removed"] == [
+                (user_ids["bulk-user-100"], "group.owner")
+            ]
+
+            # OW lists the member again
+            res = await app.ow_sync.handle_group_update(group_id, members[:3])
+            assert res["members_reactivated"] == [user_ids["bulk-user-102"]]
+            # Already inactive
+            assert res["members_deactivated"] == []
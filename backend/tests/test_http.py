@@ -0,0 +1,365 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from typing import Any, AsyncIterator
+
+import pytest
+import pytest_asyncio
+from aiohttp import ClientPayloadError, test_utils, web
+
+import app.http
+from app.exceptions import NotAuthorizedException, OWUnavailableException
+from app.http import HTTPClient
+from app.sync import OWSync
+from app.types import OWUserId, UserId
+from app.utils.circuit_breaker import CircuitBreaker, CircuitState
+
+OW_USERS = [
+    {"id": f"user-{i:04}", "name": f"Paged User{i}", "email": f"paged{i}@email.com"}
+    for i in range(95)
+]
+
+OW_GROUP_MEMBERS = {
+    f"kom{i}": [
+        [
+            user["id"],
+            {**user, "groupMemberships": [{"end": None, "roles": []}]},
+        ]
+        for user in OW_USERS[i * 3 : i * 3 + 3]
+    ]
+    for i in range(7)
+}
+
+
+class OWStub:
+    """Serves `user.all` with cursor pagination and some latency, and batched
+    `group.getMembers` calls."""
+
+    def __init__(self, latency: float = 0.01) -> None:
+        self.latency = latency
+        self.status = 200
+        self.requests: list[dict[str, Any]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def user_all(self, request: web.Request) -> web.Response:
+        if request.headers.get("Authorization") != "Bearer token":
+            return web.json_response({}, status=401)
+
+        params = json.loads(request.query["input"])["json"]
+        self.requests.append(params)
+        if self.status != 200:
+            return web.json_response({}, status=self.status)
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+
+        start = 0
+        if "cursor" in params:
+            ids = [u["id"] for u in OW_USERS]
+            start = ids.index(params["cursor"])
+
+        items = OW_USERS[start : start + params["take"]]
+        end = start + params["take"]
+        next_cursor = OW_USERS[end]["id"] if end < len(OW_USERS) else None
+
+        body = {"items": items, "nextCursor": next_cursor}
+        return web.json_response({"result": {"data": {"json": body}}})
+
+    async def batch(self, request: web.Request) -> web.Response:
+        procedures = request.match_info["procedures"].split(",")
+        inputs = json.loads(request.query["input"])
+        assert request.query["batch"] == "1"
+        self.requests.append(inputs)
+
+        results: list[Any] = []
+        for i, procedure in enumerate(procedures):
+            assert procedure == "group.getMembers"
+            slug = inputs[str(i)]["json"]
+            if slug not in OW_GROUP_MEMBERS:
+                error = {"message": "Not found", "data": {"httpStatus": 404}}
+                results.append({"error": {"json": error}})
+            else:
+                results.append({"result": {"data": {"json": OW_GROUP_MEMBERS[slug]}}})
+        return web.json_response(results, status=207)
+
+
+@pytest_asyncio.fixture
+async def ow_stub(monkeypatch: Any) -> AsyncIterator[OWStub]:
+    stub = OWStub()
+    application = web.Application()
+    application.router.add_get("/user.all", stub.user_all)
+    application.router.add_get("/{procedures}", stub.batch)
+
+    server = test_utils.TestServer(application)
+    await server.start_server()
+    monkeypatch.setattr(app.http, "BASE_OW5", str(server.make_url("")).rstrip("/"))
+
+    yield stub
+    await server.close()
+
+
+@pytest_asyncio.fixture
+async def http() -> AsyncIterator[HTTPClient]:
+    client = HTTPClient()
+    await client.async_init()
+    yield client
+    await client.close()
+
+
+class TestOWUserPagination:
+    @pytest.mark.asyncio
+    async def test_all_pages_in_order(self, ow_stub: OWStub, http: HTTPClient) -> None:
+        users = [u async for u in http.iter_all_ow_users("token", page_size=10)]
+
+        assert [u.id for u in users] == [u["id"] for u in OW_USERS]
+        assert users[1].first_name == "Paged"
+        assert users[1].last_name == "User1"
+        assert len(ow_stub.requests) == 10
+        assert "cursor" not in ow_stub.requests[0]
+
+    @pytest.mark.asyncio
+    async def test_prefetch_is_bounded(self, ow_stub: OWStub, http: HTTPClient) -> None:
+        ow_stub.latency = 0
+        users = http.iter_all_ow_users("token", page_size=10, prefetch_pages=2)
+
+        # Stop consuming after the first page and let the fetcher run ahead
+        first = await users.__anext__()
+        assert first.id == "user-0000"
+        await asyncio.sleep(0.1)
+
+        # One page being consumed, two waiting and one blocked on the queue
+        assert len(ow_stub.requests) == 4
+        assert ow_stub.max_in_flight == 1
+        await users.aclose()
+
+    @pytest.mark.asyncio
+    async def test_overlaps_fetching_with_consuming(
+        self, ow_stub: OWStub, http: HTTPClient
+    ) -> None:
+        ow_stub.latency = 0.05
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        async for user in http.iter_all_ow_users("token", page_size=10):
+            if user.id.endswith("0"):
+                # Simulates writing a page to the database
+                await asyncio.sleep(0.05)
+        elapsed = loop.time() - start
+
+        # Sequentially this would take 10 * (0.05 + 0.05) seconds
+        assert elapsed < 0.8
+
+    @pytest.mark.asyncio
+    async def test_not_authorized(self, ow_stub: OWStub, http: HTTPClient) -> None:
+        with pytest.raises(NotAuthorizedException):
+            [u async for u in http.iter_all_ow_users("wrong", page_size=10)]
+
+        assert await http.get_all_ow_users("wrong") is None
+
+    @pytest.mark.asyncio
+    async def test_single_streamed_request(
+        self, ow_stub: OWStub, http: HTTPClient
+    ) -> None:
+        users = [u async for u in http.iter_all_ow_users("token", page_size=0)]
+
+        assert len(users) == len(OW_USERS)
+        assert ow_stub.requests == [{"take": 10000000}]
+
+
+class TestOWGroupMembersBatch:
+    @pytest.mark.asyncio
+    async def test_members_of_several_groups(
+        self, ow_stub: OWStub, http: HTTPClient
+    ) -> None:
+        http.batch_size = 3
+        slugs = [*OW_GROUP_MEMBERS, "missing"]
+
+        members = await http.get_ow_groups_users(slugs, "token")
+
+        assert set(members) == set(slugs)
+        assert members["missing"] == []
+        assert [u.id for u in members["kom2"]] == ["user-0006", "user-0007", "user-0008"]
+        assert all(u.has_active_membership for u in members["kom6"])
+        # 8 groups in batches of at most 3
+        assert [len(r) for r in ow_stub.requests] == [3, 3, 2]
+
+
+class TestHTTPClientPool:
+    @pytest.mark.asyncio
+    async def test_connections_are_reused(
+        self, ow_stub: OWStub, http: HTTPClient
+    ) -> None:
+        await http.get_ow_users_page("token", 10)
+        await http.get_ow_users_page("token", 10)
+
+        stats = http.pool_stats.get_stats()
+        assert stats["created"] == 1
+        assert stats["reused"] == 1
+        assert stats["in_use"] == 0
+        assert stats["waiting"] == 0
+
+    @pytest.mark.asyncio
+    async def test_waiting_for_a_connection_is_measured(self, ow_stub: OWStub) -> None:
+        ow_stub.latency = 0.05
+        http = HTTPClient(limit=1)
+        await http.async_init()
+
+        requests = asyncio.gather(
+            http.get_ow_users_page("token", 10),
+            http.get_ow_users_page("token", 10),
+        )
+        await asyncio.sleep(0.02)
+        stats = http.pool_stats.get_stats()
+        assert (stats["in_use"], stats["waiting"]) == (1, 1)
+        await requests
+        await http.close()
+
+        stats = http.pool_stats.get_stats()
+        assert (stats["in_use"], stats["waiting"]) == (0, 0)
+        assert stats["queued"] == 1
+        assert stats["max_wait_time_ms"] >= 40
+        assert ow_stub.max_in_flight == 1
+
+    @pytest.mark.asyncio
+    async def test_slow_responses_time_out(self, ow_stub: OWStub) -> None:
+        ow_stub.latency = 1
+        http = HTTPClient(read_timeout=0.05)
+        await http.async_init()
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await http.get_ow_users_page("token", 10)
+        assert loop.time() - start < 0.5
+
+        await http.close()
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCircuitBreaker:
+    def test_opens_after_consecutive_failures(self) -> None:
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        assert breaker.allow_request()
+
+        breaker.record_failure()
+        assert breaker.is_open
+        assert not breaker.allow_request()
+
+    def test_half_open_probe(self) -> None:
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        assert not breaker.allow_request()
+
+        clock.now += 10
+        assert not breaker.is_open
+        # Only a single probe is let through
+        assert breaker.allow_request()
+        assert not breaker.allow_request()
+        assert breaker.state == CircuitState.HALF_OPEN
+
+        # A failing probe opens the circuit for another reset_timeout
+        breaker.record_failure()
+        assert not breaker.allow_request()
+        clock.now += 10
+        assert breaker.allow_request()
+
+        breaker.record_success()
+        assert not breaker.is_open
+        assert breaker.allow_request()
+        assert breaker.get_stats() == {"open": 0, "times_opened": 2, "rejected": 3}
+
+    def test_cancelled_probe_is_released(self) -> None:
+        clock = FakeClock()
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+        breaker.record_failure()
+        clock.now += 10
+
+        assert breaker.allow_request()
+        breaker.release()
+        assert breaker.allow_request()
+
+
+class TestOWCircuitBreaker:
+    @pytest.mark.asyncio
+    async def test_rejects_requests_while_open(self, ow_stub: OWStub) -> None:
+        ow_stub.status = 503
+        http = HTTPClient(failure_threshold=2, reset_timeout=0.1)
+        await http.async_init()
+
+        for _ in range(2):
+            with pytest.raises(OWUnavailableException):
+                await http.get_ow_users_page("token", 10)
+        assert http.circuit_breaker.is_open
+
+        with pytest.raises(OWUnavailableException):
+            await http.get_ow_users_page("token", 10)
+        assert len(ow_stub.requests) == 2
+
+        # The probe after reset_timeout closes the circuit again
+        ow_stub.status = 200
+        await asyncio.sleep(0.1)
+        await http.get_ow_users_page("token", 10)
+        assert len(ow_stub.requests) == 3
+        assert not http.circuit_breaker.is_open
+
+        # Errors of the caller don't count as failures
+        for _ in range(2):
+            with pytest.raises(NotAuthorizedException):
+                await http.get_ow_users_page("wrong", 10)
+        assert not http.circuit_breaker.is_open
+
+        await http.close()
+
+    @pytest.mark.asyncio
+    async def test_errors_reading_the_body_count_once(self, ow_stub: OWStub) -> None:
+        http = HTTPClient(failure_threshold=2, reset_timeout=60)
+        await http.async_init()
+        http.circuit_breaker.record_failure()
+
+        url = f"{app.http.BASE_OW5}/user.all?input={json.dumps({'json': {'take': 1}})}"
+        with pytest.raises(ClientPayloadError):
+            async with http._get(url, "token"):
+                raise ClientPayloadError("Response payload is not completed")
+        # Not counted as a success first, which would have reset the failures
+        assert http.circuit_breaker.is_open
+
+        await http.close()
+
+    @pytest.mark.asyncio
+    async def test_sync_is_skipped_while_open(self) -> None:
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+
+        async def get_ow_groups_by_user_id(*args: Any) -> Any:
+            raise AssertionError("OW should not be called")
+
+        app: Any = SimpleNamespace(
+            http=SimpleNamespace(
+                circuit_breaker=breaker,
+                get_ow_groups_by_user_id=get_ow_groups_by_user_id,
+            ),
+        )
+        ow_sync = OWSync(app)
+
+        synced = await ow_sync.sync_for_user(
+            OWUserId("ow-user-1"),
+            UserId("aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaa1"),
+            "token",
+        )
+        assert synced is False
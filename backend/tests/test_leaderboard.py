@@ -0,0 +1,429 @@
+from functools import partial
+from typing import Any, Optional
+
+import pytest
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient
+
+from app.api import FastAPI, Request
+from app.api.init_api import init_api
+from app.models.punishment import PunishmentCreate
+from app.models.punishment_type import PunishmentTypeCreate
+from app.models.user import MinifiedLeaderboardUser
+from app.types import GroupId, PunishmentTypeId, UserId
+from app.utils.pagination import (
+    CountStrategy,
+    CursorKey,
+    Page,
+    Pagination,
+    PaginationQueries,
+)
+from tests.fixtures import database
+
+GROUP_ID = GroupId("bbbbbbbb-bbbb-bbbb-bbbb-bbbbbbbbbbbb")
+USER_ID = UserId("bbbbbbbb-bbbb-bbbb-bbbb-000000000001")
+OTHER_USER_ID = UserId("bbbbbbbb-bbbb-bbbb-bbbb-000000000002")
+BEER_ID = PunishmentTypeId("bbbbbbbb-bbbb-bbbb-bbbb-100000000001")
+WINE_ID = PunishmentTypeId("bbbbbbbb-bbbb-bbbb-bbbb-100000000002")
+TIED_USER_IDS = [UserId(f"bbbbbbbb-bbbb-bbbb-bbbb-20000000000{i}") for i in range(7)]
+
+
+async def insert_group(app: Any) -> None:
+    async with app.db.pool.acquire() as conn:
+        await conn.execute("DELETE FROM groups WHERE group_id = $1", GROUP_ID)
+        await conn.execute(
+            "DELETE FROM users WHERE user_id = ANY($1)",
+            [USER_ID, OTHER_USER_ID, *TIED_USER_IDS],
+        )
+        await conn.execute(
+            """INSERT INTO users (user_id, ow_user_id, first_name, last_name, email)
+               VALUES ($1, 'leaderboard-1', 'Leader', 'Board', 'leader@board.com'),
+                      ($2, 'leaderboard-2', 'Other', 'Board', 'other@board.com')""",
+            USER_ID,
+            OTHER_USER_ID,
+        )
+        await conn.execute(
+            """INSERT INTO groups (group_id, ow_group_id, name, name_short, rules, image)
+               VALUES ($1, 'leaderboardkom', 'Leaderboardkom', 'Lbkom', '', '')""",
+            GROUP_ID,
+        )
+        await conn.execute(
+            "INSERT INTO group_members (group_id, user_id) VALUES ($1, $2)",
+            GROUP_ID,
+            USER_ID,
+        )
+        await conn.execute(
+            """INSERT INTO punishment_types
+               (punishment_type_id, group_id, name, value, emoji, created_at)
+               VALUES ($1, $3, 'Beer', 33, '🍺', '2020-01-01'),
+                      ($2, $3, 'Wine', 100, '🍷', '2020-01-02')""",
+            BEER_ID,
+            WINE_ID,
+            GROUP_ID,
+        )
+
+
+async def get_totals(app: Any, user_id: UserId, year: int = 0) -> dict[str, Any]:
+    async with app.db.pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT total_value, paid_value, unpaid_value, emojis,
+                   amount_punishments, amount_unique_punishments
+               FROM leaderboard_totals WHERE user_id = $1 AND year = $2""",
+            user_id,
+            year,
+        )
+    return dict(row) if row is not None else {}
+
+
+def add_leaderboard_route(app: FastAPI) -> None:
+    @app.get("/test/leaderboard")
+    async def leaderboard(
+        request: Request,
+        page: int = 0,
+        cursor: Optional[str] = None,
+        count: str = "exact",
+        queries: str = "sequential",
+    ) -> Page[MinifiedLeaderboardUser]:
+        pagination = Pagination[MinifiedLeaderboardUser](
+            request=request,
+            total_coro=partial(app.db.users.get_leaderboard_count, False),
+            results_coro=partial(
+                app.db.users.get_minified_leaderboard, False, None, False, "total"
+            ),
+            page=page,
+            page_size=2,
+            cursor=cursor,
+            cursor_key=CursorKey(
+                get=lambda u: (u.total_value, u.first_name, u.user_id),
+                types=(int, str, UserId),
+            ),
+            count=CountStrategy(count),
+            queries=PaginationQueries(queries),
+            window_coro=partial(
+                app.db.users.get_minified_leaderboard_with_total,
+                False,
+                None,
+                False,
+                "total",
+            ),
+        )
+        return await pagination.paginate()
+
+
+async def insert_tied_users(app: Any) -> None:
+    async with app.db.pool.acquire() as conn:
+        for i, user_id in enumerate(TIED_USER_IDS):
+            await conn.execute(
+                """INSERT INTO users (user_id, ow_user_id, first_name, last_name)
+                   VALUES ($1, $2, 'Tied', '')""",
+                user_id,
+                f"leaderboard-tied-{i}",
+            )
+    # Same value and first name, only the user id tells them apart
+    for user_id in TIED_USER_IDS:
+        await app.db.punishments.insert_multiple(
+            GROUP_ID, user_id, USER_ID, [create_punishment(BEER_ID, 1)]
+        )
+
+
+def create_punishment(punishment_type_id: PunishmentTypeId, amount: int) -> Any:
+    return PunishmentCreate(
+        punishment_type_id=punishment_type_id,
+        reason="",
+        reason_hidden=False,
+        amount=amount,
+    )
+
+
+class TestWithDB_Leaderboard:
+    @pytest.mark.asyncio
+    async def test_aggregates_follow_punishment_writes(self, database: str) -> None:
+        app = init_api(database=database)
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            punishments = app.db.punishments
+
+            # Emojis are listed by punishment, not by punishment type
+            res = await punishments.insert_multiple(
+                GROUP_ID, USER_ID, USER_ID, [create_punishment(WINE_ID, 1)]
+            )
+            (wine,) = res["ids"]
+            res = await punishments.insert_multiple(
+                GROUP_ID, USER_ID, USER_ID, [create_punishment(BEER_ID, 2)]
+            )
+            (beers,) = res["ids"]
+            await punishments.insert_multiple(
+                GROUP_ID, OTHER_USER_ID, USER_ID, [create_punishment(BEER_ID, 1)]
+            )
+
+            totals = await get_totals(app, USER_ID)
+            assert totals == {
+                "total_value": 166,
+                "paid_value": 0,
+                "unpaid_value": 166,
+                "emojis": "🍷🍺🍺",
+                "amount_punishments": 3,
+                "amount_unique_punishments": 2,
+            }
+
+            leaderboard = await app.db.users.get_minified_leaderboard(
+                this_year=True,
+                year=None,
+                active_only=False,
+                sort_by="total",
+                offset=0,
+                limit=1000,
+            )
+            by_id = {u.user_id: u for u in leaderboard}
+            assert by_id[USER_ID].total_value_this_year == 166
+            assert by_id[OTHER_USER_ID].total_value == 33
+            # Only members of OW groups are active
+            leaderboard = await app.db.users.get_minified_leaderboard(
+                this_year=False,
+                year=None,
+                active_only=True,
+                sort_by="total",
+                offset=0,
+                limit=1000,
+            )
+            assert OTHER_USER_ID not in {u.user_id for u in leaderboard}
+
+            await punishments.mark_multiple_as_paid(GROUP_ID, [beers], USER_ID)
+            # Already paid, so nothing changes
+            await punishments.mark_multiple_as_paid(GROUP_ID, [beers], USER_ID)
+            totals = await get_totals(app, USER_ID)
+            assert (totals["paid_value"], totals["unpaid_value"]) == (66, 100)
+
+            await punishments.mark_multiple_as_unpaid(GROUP_ID, [beers, wine])
+            assert (await get_totals(app, USER_ID))["paid_value"] == 0
+
+            await punishments.mark_all_punishments_as_paid_for_user(
+                GROUP_ID, USER_ID, USER_ID
+            )
+            assert (await get_totals(app, USER_ID))["unpaid_value"] == 0
+
+            await punishments.delete(wine)
+            totals = await get_totals(app, USER_ID)
+            assert (totals["total_value"], totals["emojis"]) == (66, "🍺🍺")
+
+            await app.db.punishment_types.update(
+                GROUP_ID,
+                BEER_ID,
+                PunishmentTypeCreate(name="Beer", value=40, emoji="🍻"),
+            )
+            totals = await get_totals(app, USER_ID)
+            assert (totals["total_value"], totals["emojis"]) == (80, "🍻🍻")
+            assert (await get_totals(app, OTHER_USER_ID))["total_value"] == 40
+
+            await punishments.delete(beers)
+            assert await get_totals(app, USER_ID) == {}
+
+            inconsistent = await app.db.leaderboard.check()
+            assert USER_ID not in inconsistent
+            assert OTHER_USER_ID not in inconsistent
+
+            await app.db.groups.delete(GROUP_ID)
+            assert await get_totals(app, OTHER_USER_ID) == {}
+
+    @pytest.mark.asyncio
+    async def test_rebuild_repairs_drift(self, database: str) -> None:
+        app = init_api(database=database)
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            await app.db.punishments.insert_multiple(
+                GROUP_ID, USER_ID, USER_ID, [create_punishment(BEER_ID, 1)]
+            )
+
+            async with app.db.pool.acquire() as conn:
+                # Written around the aggregates
+                await conn.execute(
+                    """INSERT INTO group_punishments
+                       (group_id, user_id, punishment_type_id, reason, amount, created_at)
+                       VALUES ($1, $2, $3, '', 2, '2021-06-01')""",
+                    GROUP_ID,
+                    USER_ID,
+                    WINE_ID,
+                )
+
+            assert USER_ID in await app.db.leaderboard.check()
+
+            await app.db.leaderboard.rebuild([USER_ID])
+            assert USER_ID not in await app.db.leaderboard.check()
+
+            assert (await get_totals(app, USER_ID))["total_value"] == 233
+            assert await get_totals(app, USER_ID, year=2021) == {
+                "total_value": 200,
+                "paid_value": 0,
+                "unpaid_value": 200,
+                "emojis": "🍷🍷",
+                "amount_punishments": 2,
+                "amount_unique_punishments": 1,
+            }
+
+            leaderboard = await app.db.users.get_minified_leaderboard(
+                this_year=False,
+                year=2021,
+                active_only=True,
+                sort_by="total",
+                offset=0,
+                limit=1000,
+            )
+            user = next(u for u in leaderboard if u.user_id == USER_ID)
+            assert user.total_value_this_year == 200
+            assert user.emojis_this_year == "🍷🍷"
+
+    @pytest.mark.asyncio
+    async def test_cursor_pagination(self, database: str) -> None:
+        app = init_api(database=database)
+        add_leaderboard_route(app)
+
+        async def walk(
+            client: AsyncClient, url: Optional[str], direction: str
+        ) -> list[str]:
+            user_ids: list[str] = []
+            while url is not None:
+                page = (await client.get(url)).json()
+                page_ids = [u["user_id"] for u in page["results"]]
+                if direction == "previous":
+                    user_ids = page_ids + user_ids
+                else:
+                    user_ids += page_ids
+                url = page[direction]
+            return user_ids
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            await insert_tied_users(app)
+
+            async with AsyncClient(app=app, base_url="http://test") as client:
+                by_page = await walk(client, "/test/leaderboard", "next")
+                by_cursor = await walk(client, "/test/leaderboard?cursor=", "next")
+                assert by_cursor == by_page
+                assert len(set(by_cursor)) == len(by_cursor)
+                assert [u for u in by_cursor if u in map(str, TIED_USER_IDS)] == sorted(
+                    map(str, TIED_USER_IDS)
+                )
+
+                last_page = (
+                    await client.get(
+                        "/test/leaderboard",
+                        params={"page": (len(by_page) - 1) // 2},
+                    )
+                ).json()
+                # Back from the second to last cursor page
+                cursor_page = (await client.get("/test/leaderboard?cursor=")).json()
+                while True:
+                    next_page = (await client.get(cursor_page["next"])).json()
+                    if next_page["next"] is None:
+                        break
+                    cursor_page = next_page
+                assert [u["user_id"] for u in next_page["results"]] == [
+                    u["user_id"] for u in last_page["results"]
+                ]
+
+                backwards = await walk(client, cursor_page["previous"], "previous")
+                assert backwards + [u["user_id"] for u in cursor_page["results"]] == (
+                    by_cursor[: len(backwards) + 2]
+                )
+                assert len(backwards) >= 4
+
+                res = await client.get("/test/leaderboard?cursor=garbage")
+                assert res.status_code == 400
+
+            log = await app.db.punishments.get_all(0, 100, group_id=GROUP_ID)
+            key = (log[2].created_at, log[2].punishment_id)
+            after = await app.db.punishments.get_all(
+                0, 2, group_id=GROUP_ID, after=key
+            )
+            assert after == log[3:5]
+            before = await app.db.punishments.get_all(
+                0, 2, group_id=GROUP_ID, after=key, backwards=True
+            )
+            assert before == log[:2]
+
+    @pytest.mark.asyncio
+    async def test_count_strategies(self, database: str) -> None:
+        app = init_api(database=database)
+        add_leaderboard_route(app)
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            await insert_tied_users(app)
+
+            async with AsyncClient(app=app, base_url="http://test") as client:
+
+                async def get_page(count: str, **params: Any) -> Any:
+                    res = await client.get(
+                        "/test/leaderboard", params={"count": count, **params}
+                    )
+                    return res.json()
+
+                exact = await get_page("exact")
+                assert exact["total"] == await app.db.users.get_leaderboard_count(
+                    False
+                )
+
+                assert (await get_page("cached"))["total"] == exact["total"]
+                await app.db.punishments.insert_multiple(
+                    GROUP_ID, OTHER_USER_ID, USER_ID, [create_punishment(BEER_ID, 1)]
+                )
+                # Other pages share the count
+                page = await get_page("cached", page=1)
+                assert page["total"] == exact["total"]
+                app.db.note_write(None)
+                page = await get_page("cached", page=1)
+                assert page["total"] == exact["total"] + 1
+
+                page = await get_page("estimate")
+                assert isinstance(page["total"], int)
+
+                # Without a total, the extra row tells whether there are more
+                total = exact["total"] + 1
+                last_page = (total - 1) // 2
+                page = await get_page("none", page=last_page)
+                assert page["total"] is None
+                assert page["next"] is None
+                assert page["results"]
+                page = await get_page("none", page=last_page - 1)
+                assert page["next"] is not None
+                assert len(page["results"]) == 2
+
+    @pytest.mark.asyncio
+    async def test_pagination_queries(self, database: str) -> None:
+        app = init_api(database=database)
+        add_leaderboard_route(app)
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            await insert_tied_users(app)
+
+            async with AsyncClient(app=app, base_url="http://test") as client:
+
+                async def get_page(queries: str, page: int) -> Any:
+                    res = await client.get(
+                        "/test/leaderboard",
+                        params={"count": "exact", "queries": queries, "page": page},
+                    )
+                    assert res.status_code == 200
+                    return res.json()
+
+                total = await app.db.users.get_leaderboard_count(False)
+                # The last page, and one past it where there are no rows to
+                # count the total on
+                for page in (0, (total - 1) // 2, total):
+                    expected = await get_page("sequential", page)
+                    assert expected["total"] == total
+                    for queries in ("parallel", "window"):
+                        res = await get_page(queries, page)
+                        assert res["total"] == expected["total"]
+                        assert res["results"] == expected["results"]
+                        assert (res["next"] is None) == (expected["next"] is None)
+
+                # Estimates aren't counted in the results query
+                res = await client.get(
+                    "/test/leaderboard",
+                    params={"count": "estimate", "queries": "window"},
+                )
+                assert res.status_code == 200
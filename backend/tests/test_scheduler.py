@@ -0,0 +1,332 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+import pytest
+
+from app.scheduler import JobQueue, SyncExecutor, SyncScheduler
+from app.sync import GroupSyncFreshness, OWSync, get_group_digest
+from app.types import GroupId, OWSyncGroup, OWSyncGroupMember, OWUserId, UserId
+from app.utils.circuit_breaker import CircuitBreaker
+
+USER_ID = UserId("aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaa1")
+GROUP_ID = GroupId("bbbbbbbb-aaaa-aaaa-aaaa-aaaaaaaaaaa1")
+OW_USER_ID = OWUserId("ow-user-1")
+
+GROUP = OWSyncGroup(
+    slug="dotkom",
+    name="Drifts- og Utviklingskomiteen",
+    type="COMMITTEE",
+    abbreviation="Dotkom",
+    imageUrl=None,
+)
+
+MEMBERS = [
+    OWSyncGroupMember(
+        id=f"ow-user-{i}",
+        first_name="Test",
+        last_name=f"User {i}",
+        email=f"user{i}@example.com",
+        roles=["LEADER", "PUNISHER"] if i == 1 else [],
+        has_active_membership=True,
+    )
+    for i in range(1, 4)
+]
+
+
+class FakeOWSync:
+    def __init__(self) -> None:
+        self.user_syncs = 0
+        self.release = asyncio.Event()
+
+    async def sync_for_user(self, *args: Any, **kwargs: Any) -> bool:
+        self.user_syncs += 1
+        await self.release.wait()
+        return True
+
+
+class TestJobQueue:
+    @pytest.mark.asyncio
+    async def test_deduplicates_waiting_jobs(self) -> None:
+        calls = []
+
+        async def job() -> None:
+            calls.append(1)
+
+        queue = JobQueue("test", workers=1)
+        futures = [queue.schedule("key", job) for _ in range(10)]
+        queue.start()
+
+        await asyncio.gather(*futures)
+        await queue.close()
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_rate_limits_per_key(self) -> None:
+        calls = []
+
+        async def job() -> None:
+            calls.append(1)
+
+        queue = JobQueue("test", workers=1, min_interval=0.2)
+        queue.start()
+
+        await queue.schedule("key", job)
+        # Held back by min_interval, so the future is done right away
+        future = queue.schedule("key", job)
+        assert future.done()
+        assert len(calls) == 1
+
+        await asyncio.sleep(0.3)
+        assert len(calls) == 2
+        await queue.close()
+
+    @pytest.mark.asyncio
+    async def test_failing_job_does_not_raise(self) -> None:
+        async def job() -> Optional[bool]:
+            raise ValueError
+
+        queue = JobQueue("test", workers=1)
+        queue.start()
+
+        await queue.schedule("key", job)
+        assert queue.last_succeeded.get("key") is None
+
+        async def ok_job() -> Optional[bool]:
+            return None
+
+        await queue.schedule("key", ok_job)
+        assert queue.last_succeeded.get("key") is not None
+        await queue.close()
+
+
+class TestSyncScheduler:
+    @pytest.mark.asyncio
+    async def test_only_waits_for_unknown_memberships(self) -> None:
+        ow_sync = FakeOWSync()
+        scheduler = SyncScheduler(ow_sync, user_min_interval=0)  # type: ignore
+        scheduler.start()
+
+        request = asyncio.create_task(
+            scheduler.request_user_sync(OW_USER_ID, USER_ID, "token")
+        )
+        await asyncio.sleep(0.05)
+        assert not request.done()
+
+        ow_sync.release.set()
+        await request
+        assert scheduler.is_user_synced(OW_USER_ID)
+
+        # Memberships are known now, so the next sync runs in the background
+        ow_sync.release.clear()
+        await asyncio.wait_for(
+            scheduler.request_user_sync(OW_USER_ID, USER_ID, "token"),
+            timeout=1,
+        )
+        assert ow_sync.user_syncs == 2
+
+        await scheduler.close()
+
+    @pytest.mark.asyncio
+    async def test_rate_limits_user_syncs(self) -> None:
+        ow_sync = FakeOWSync()
+        ow_sync.release.set()
+        scheduler = SyncScheduler(ow_sync, user_min_interval=60)  # type: ignore
+        scheduler.start()
+
+        for _ in range(3):
+            await scheduler.request_user_sync(OW_USER_ID, USER_ID, "token")
+        await asyncio.sleep(0.05)
+        assert ow_sync.user_syncs == 1
+
+        await scheduler.close()
+
+
+class FakePool:
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.in_use = 0
+        self.released = asyncio.Condition()
+
+    def get_max_size(self) -> int:
+        return self.max_size
+
+    def get_size(self) -> int:
+        return self.max_size
+
+    def get_idle_size(self) -> int:
+        return self.max_size - self.in_use
+
+    async def acquire(self) -> object:
+        assert self.in_use < self.max_size
+        self.in_use += 1
+        return object()
+
+    async def release(self, conn: object) -> None:
+        self.in_use -= 1
+        async with self.released:
+            self.released.notify_all()
+
+    async def wait_until(self, predicate: Callable[[], bool]) -> None:
+        async with self.released:
+            await self.released.wait_for(predicate)
+
+
+class TestSyncExecutor:
+    @pytest.mark.asyncio
+    async def test_limits_concurrency(self) -> None:
+        pool = FakePool(max_size=10)
+        executor = SyncExecutor(
+            lambda: pool,
+            max_concurrency=2,
+            reserved_connections=0,
+        )
+        max_running = 0
+
+        async def sync() -> None:
+            nonlocal max_running
+            async with executor.acquire():
+                max_running = max(max_running, executor.running)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(sync() for _ in range(10)))
+        assert max_running == 2
+        assert pool.in_use == 0
+        stats = executor.get_stats()
+        assert stats["completed"] == 10
+        # Two got a connection before the others were started
+        assert stats["max_waiting"] == 8
+        assert stats["waiting"] == 0
+
+    @pytest.mark.asyncio
+    async def test_leaves_reserved_connections_to_requests(self) -> None:
+        pool = FakePool(max_size=4)
+        executor = SyncExecutor(
+            lambda: pool,
+            max_concurrency=4,
+            reserved_connections=2,
+        )
+
+        # A request holds one connection, so a single one is left to syncs
+        await pool.acquire()
+        first = executor.acquire()
+        await first.__aenter__()
+        second_context = executor.acquire()
+        second = asyncio.create_task(second_context.__aenter__())
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        assert executor.get_stats()["waiting"] == 1
+
+        # The sync can continue once the request is done
+        await pool.release(object())
+        await asyncio.wait_for(second, timeout=1)
+        assert executor.running == 2
+        assert pool.in_use == 2
+
+        await first.__aexit__(None, None, None)
+        await second_context.__aexit__(None, None, None)
+        assert pool.in_use == 0
+
+    @pytest.mark.asyncio
+    async def test_never_reserves_the_whole_pool(self) -> None:
+        pool = FakePool(max_size=2)
+        executor = SyncExecutor(
+            lambda: pool,
+            max_concurrency=4,
+            reserved_connections=5,
+        )
+
+        async with executor.acquire():
+            assert pool.in_use == 1
+
+
+class TestGroupSyncFreshness:
+    @pytest.mark.asyncio
+    async def test_window(self) -> None:
+        freshness = GroupSyncFreshness(app=None, window=0.1, persist=False)  # type: ignore
+        await freshness.mark_synced("dotkom", GROUP_ID)
+
+        assert await freshness.get_fresh(["dotkom", "arrkom"]) == {"dotkom"}
+        await asyncio.sleep(0.15)
+        assert await freshness.get_fresh(["dotkom", "arrkom"]) == set()
+
+    @pytest.mark.asyncio
+    async def test_skips_fresh_groups_the_user_is_in(self) -> None:
+        other_group = GROUP.copy(update={"slug": "arrkom"})
+
+        async def get_ow_groups_by_user_id(*args: Any) -> list[OWSyncGroup]:
+            return [GROUP, other_group]
+
+        async def get_groups(*args: Any, **kwargs: Any) -> list[Any]:
+            return [SimpleNamespace(group_id=GROUP_ID, ow_group_id="dotkom")]
+
+        app: Any = SimpleNamespace(
+            http=SimpleNamespace(
+                circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60),
+                get_ow_groups_by_user_id=get_ow_groups_by_user_id,
+            ),
+            db=SimpleNamespace(
+                pool=FakePool(max_size=10),
+                users=SimpleNamespace(get_groups=get_groups),
+                note_write=lambda session: None,
+            ),
+        )
+        ow_sync = OWSync(app)
+
+        synced: list[str] = []
+
+        async def sync_groups_for_user(
+            ow_user_id: OWUserId, groups_data: list[OWSyncGroup], access_token: str
+        ) -> None:
+            synced.extend(g.slug for g in groups_data)
+
+        ow_sync.sync_groups_for_user = sync_groups_for_user  # type: ignore
+        await ow_sync.group_freshness.mark_synced("dotkom", GROUP_ID)
+        await ow_sync.group_freshness.mark_synced("arrkom", GROUP_ID)
+
+        assert await ow_sync.sync_for_user(OW_USER_ID, USER_ID, "token")
+        # The user is not in arrkom yet, so it has to be synced regardless
+        assert synced == ["arrkom"]
+        assert ow_sync.group_freshness.get_stats() == {
+            "skipped": 1,
+            "performed": 2,
+            "unchanged": 0,
+        }
+
+    @pytest.mark.asyncio
+    async def test_unchanged_payload_skips_database(self) -> None:
+        members = list(MEMBERS)
+
+        async def get_ow_groups_users(
+            group_ids: list[str], access_token: str
+        ) -> dict[str, list[OWSyncGroupMember]]:
+            return {"dotkom": members}
+
+        # Any database access fails since the fake app has no pool
+        app: Any = SimpleNamespace(
+            http=SimpleNamespace(get_ow_groups_users=get_ow_groups_users),
+            db=SimpleNamespace(),
+        )
+        ow_sync = OWSync(app)
+        await ow_sync.group_freshness.mark_synced(
+            "dotkom", GROUP_ID, digest=get_group_digest(GROUP, MEMBERS)
+        )
+
+        # Order of members and roles does not matter
+        members = [
+            m.copy(update={"roles": list(reversed(m.roles))}) for m in MEMBERS[::-1]
+        ]
+        await ow_sync.sync_groups_for_user(OW_USER_ID, [GROUP], "token")
+        assert ow_sync.group_freshness.get_stats()["unchanged"] == 1
+
+        with pytest.raises(AttributeError):
+            await ow_sync.sync_groups_for_user(OW_USER_ID, [GROUP], "token", force=True)
+
+        members = [MEMBERS[0].copy(update={"has_active_membership": False})]
+        with pytest.raises(AttributeError):
+            await ow_sync.sync_groups_for_user(OW_USER_ID, [GROUP], "token")
+
+        members = list(MEMBERS)
+        ow_sync.group_freshness.forget("dotkom")
+        with pytest.raises(AttributeError):
+            await ow_sync.sync_groups_for_user(OW_USER_ID, [GROUP], "token")
@@ -0,0 +1,276 @@
+import asyncio
+import base64
+import json
+import time
+import uuid
+from typing import Any
+
+import pytest
+from aioresponses import CallbackResult, aioresponses
+from asgi_lifespan import LifespanManager
+from httpx import AsyncClient
+
+from app.api.init_api import init_api
+from app.config import settings
+from app.http import BASE_OW5
+from app.state import InMemoryTokenCacheBackend, State, get_access_token_expiry
+from app.sync import OWSync
+from app.types import OWUserId, UserId
+from app.utils.cache import LRUCache
+from tests.fixtures import database
+
+USER_ID = UserId("aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaa1")
+
+OW_PROFILE_RESPONSE = {
+    "result": {
+        "data": {
+            "json": {
+                "id": "ow-user-1",
+                "name": "Brage Test",
+                "email": "email1@email.com",
+            }
+        }
+    }
+}
+
+
+def create_jwt(exp: float) -> str:
+    def encode(value: dict[str, object]) -> str:
+        raw = base64.urlsafe_b64encode(json.dumps(value).encode())
+        return raw.decode().rstrip("=")
+
+    return f"{encode({'alg': 'none'})}.{encode({'exp': exp})}.signature"
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self) -> None:
+        cache: LRUCache[str, int] = LRUCache(max_size=2, default_ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+
+        cache.set("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats.evictions == 1
+
+    def test_entries_expire(self) -> None:
+        clock = FakeClock()
+        cache: LRUCache[str, int] = LRUCache(max_size=10, default_ttl=60, clock=clock)
+        cache.set("a", 1)
+        cache.set("b", 2, expires_at=clock.now + 10)
+
+        clock.now += 30
+        assert cache.get("a") == 1
+        assert cache.get("b") is None
+
+        clock.now += 60
+        assert cache.get("a") is None
+        assert cache.stats.expirations == 2
+        assert len(cache) == 0
+
+    def test_expired_entries_make_room_first(self) -> None:
+        clock = FakeClock()
+        cache: LRUCache[str, int] = LRUCache(max_size=2, default_ttl=60, clock=clock)
+        cache.set("a", 1, expires_at=clock.now + 10)
+        cache.set("b", 2)
+
+        clock.now += 30
+        assert "a" not in cache
+        cache.set("c", 3)
+
+        assert cache.get("b") == 2
+        assert cache.stats.expirations == 1
+        assert cache.stats.evictions == 0
+
+    def test_memory_ceiling(self) -> None:
+        cache: LRUCache[str, str] = LRUCache(
+            max_size=100,
+            default_ttl=60,
+            max_memory=30,
+            sizeof=lambda k, v: 10,
+        )
+        for i in range(5):
+            cache.set(str(i), str(i))
+
+        assert len(cache) == 3
+        assert cache.memory == 30
+        assert cache.get("0") is None
+        assert cache.get("4") == "4"
+
+    def test_stats(self) -> None:
+        cache: LRUCache[str, int] = LRUCache(max_size=10, default_ttl=60)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        # Membership checks aren't lookups
+        assert "a" in cache
+        assert "b" not in cache
+
+        assert cache.stats.as_dict() == {
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+
+class TestState:
+    def test_get_access_token_expiry(self) -> None:
+        assert get_access_token_expiry(create_jwt(1234)) == 1234
+        assert get_access_token_expiry("not-a-jwt") is None
+        assert get_access_token_expiry("a.b.c") is None
+
+    @pytest.mark.asyncio
+    async def test_replaces_previous_token_for_user(self) -> None:
+        state = State()
+        await state.add_access_token("token1", OWUserId("1"), USER_ID)
+        await state.add_access_token("token2", OWUserId("1"), USER_ID)
+
+        assert await state.get_ow_user_id_by_access_token("token1") is None
+        assert await state.get_ow_user_id_by_access_token("token2") == "1"
+        assert state.get_access_token_by_ow_user_id(OWUserId("1")) == "token2"
+
+    @pytest.mark.asyncio
+    async def test_expired_token_is_not_trusted(self) -> None:
+        state = State()
+        await state.add_access_token(create_jwt(time.time() - 1), OWUserId("1"), USER_ID)
+        assert state.get_access_token_by_ow_user_id(OWUserId("1")) is None
+
+        token = create_jwt(time.time() + 60)
+        await state.add_access_token(token, OWUserId("1"), USER_ID)
+        assert await state.get_ow_user_id_by_access_token(token) == "1"
+
+    @pytest.mark.asyncio
+    async def test_bounded(self) -> None:
+        state = State(max_size=10)
+        for i in range(100):
+            await state.add_access_token(f"token{i}", OWUserId(str(i)), USER_ID)
+
+        assert state.get_stats()["size"] == 10
+        assert await state.get_ow_user_id_by_access_token("token0") is None
+        assert state.get_access_token_by_ow_user_id(OWUserId("0")) is None
+        assert await state.get_ow_user_id_by_access_token("token99") == "99"
+
+    @pytest.mark.asyncio
+    async def test_invalidate_ow_user_id(self) -> None:
+        state = State()
+        await state.add_access_token("token", OWUserId("1"), USER_ID)
+        assert await state.get_user_ids_by_access_token("token") == (USER_ID, "1")
+
+        await state.invalidate_ow_user_id(OWUserId("1"))
+        assert await state.get_user_ids_by_access_token("token") is None
+
+    @pytest.mark.asyncio
+    async def test_shared_backend_fills_local_cache(self) -> None:
+        backend = InMemoryTokenCacheBackend(max_size=10, default_ttl=60)
+        await State(backend=backend).add_access_token("token", OWUserId("1"), USER_ID)
+
+        state = State(backend=backend)
+        assert await state.get_user_ids_by_access_token("token") == (USER_ID, "1")
+        assert await state.get_user_ids_by_access_token("token") == (USER_ID, "1")
+        assert state.get_stats()["shared_hits"] == 1
+
+
+class FakeApp:
+    def __init__(self, state: State) -> None:
+        self.app_state = state
+        # Accessing the database or OW would raise an AttributeError
+        self.db = object()
+        self.http = object()
+
+
+class TestSyncForAccessToken:
+    @pytest.mark.asyncio
+    async def test_warm_token_does_not_touch_database(self) -> None:
+        state = State()
+        user_id = UserId(str(uuid.uuid4()))
+        await state.add_access_token("token", OWUserId("1"), user_id)
+
+        ow_sync = OWSync(FakeApp(state))  # type: ignore
+        res: Any = await ow_sync.sync_for_access_token("token")
+        assert res == (user_id, "1")
+
+
+class TestWithDB_SharedTokenCache:
+    @pytest.mark.asyncio
+    async def test_one_ow_lookup_per_token_across_instances(
+        self, monkeypatch: Any, database: str
+    ) -> None:
+        monkeypatch.setattr(settings, "access_token_cache_backend", "postgres")
+
+        # Several app instances sharing one database act like separate workers
+        apps = [init_api(database=database) for _ in range(3)]
+
+        access_token = str(uuid.uuid4())
+
+        with aioresponses() as m:
+            m.get(f"{BASE_OW5}/user.getMe", payload=OW_PROFILE_RESPONSE, repeat=True)
+
+            user_ids = set()
+            for app in apps:
+                async with LifespanManager(app):
+                    async with AsyncClient(app=app, base_url="http://test") as client:
+                        response = await client.get(
+                            f"/users/leaderboard/punishments/{USER_ID}",
+                            headers={"Authorization": f"Bearer {access_token}"},
+                        )
+                        assert response.status_code == 200
+
+                    user_ids.add(
+                        await app.app_state.get_user_ids_by_access_token(access_token)
+                    )
+
+            ow_calls = [
+                call
+                for (_, url), calls in m.requests.items()
+                if str(url).endswith("user.getMe")
+                for call in calls
+            ]
+            assert len(ow_calls) == 1
+            assert len(user_ids) == 1
+
+
+class TestWithDB_CoalescedAccessTokens:
+    @pytest.mark.asyncio
+    async def test_concurrent_requests_share_one_ow_lookup(self, database: str) -> None:
+        app = init_api(database=database)
+
+        async def delayed_profile(*args: Any, **kwargs: Any) -> Any:
+            await asyncio.sleep(0.05)
+            return CallbackResult(payload=OW_PROFILE_RESPONSE)
+
+        with aioresponses() as m:
+            m.get(f"{BASE_OW5}/user.getMe", callback=delayed_profile, repeat=True)
+
+            async with LifespanManager(app):
+                async with AsyncClient(app=app, base_url="http://test") as client:
+                    responses = await asyncio.gather(
+                        *(
+                            client.get(
+                                f"/users/leaderboard/punishments/{USER_ID}",
+                                headers={"Authorization": "Bearer new-token"},
+                            )
+                            for _ in range(50)
+                        )
+                    )
+
+            assert all(r.status_code == 200 for r in responses)
+
+            ow_calls = [
+                call
+                for (_, url), calls in m.requests.items()
+                if str(url).endswith("user.getMe")
+                for call in calls
+            ]
+            assert len(ow_calls) == 1
@@ -0,0 +1,127 @@
+import datetime
+from typing import Any, cast
+
+import pytest
+from asgi_lifespan import LifespanManager
+
+from app.api.init_api import init_api
+from app.models.punishment import PunishmentCreate
+from app.types import GroupId, PunishmentId, PunishmentTypeId, UserId
+from tests.fixtures import database
+
+GROUP_ID = GroupId("dddddddd-dddd-dddd-dddd-dddddddddddd")
+USER_ID = UserId("dddddddd-dddd-dddd-dddd-000000000001")
+BEER_ID = PunishmentTypeId("dddddddd-dddd-dddd-dddd-100000000001")
+WINE_ID = PunishmentTypeId("dddddddd-dddd-dddd-dddd-100000000002")
+
+
+async def insert_group(app: Any) -> None:
+    async with app.db.pool.acquire() as conn:
+        await conn.execute("DELETE FROM groups WHERE group_id = $1", GROUP_ID)
+        await conn.execute("DELETE FROM users WHERE user_id = $1", USER_ID)
+        await conn.execute(
+            """INSERT INTO users (user_id, ow_user_id, first_name, last_name, email)
+               VALUES ($1, 'streaks-1', 'Streak', 'Er', 'streak@er.com')""",
+            USER_ID,
+        )
+        await conn.execute(
+            """INSERT INTO groups (group_id, ow_group_id, name, name_short, rules, image)
+               VALUES ($1, 'streakkom', 'Streakkom', 'Stkom', '', '')""",
+            GROUP_ID,
+        )
+        await conn.execute(
+            """INSERT INTO punishment_types (punishment_type_id, group_id, name, value, emoji)
+               VALUES ($1, $3, 'Beer', 33, '🍺'), ($2, $3, 'Wine', 100, '🍷')""",
+            BEER_ID,
+            WINE_ID,
+            GROUP_ID,
+        )
+
+
+async def insert_weeks_ago(
+    app: Any, weeks: int, punishment_type_id: PunishmentTypeId = BEER_ID
+) -> PunishmentId:
+    """Inserts a punishment around the streaks, at noon on Monday a number of
+    weeks ago."""
+    today = datetime.datetime.utcnow().date()
+    monday = today - datetime.timedelta(days=today.weekday(), weeks=weeks)
+    created_at = datetime.datetime.combine(monday, datetime.time(12))
+    async with app.db.pool.acquire() as conn:
+        punishment_id = await conn.fetchval(
+            """INSERT INTO group_punishments
+               (group_id, user_id, punishment_type_id, reason, amount, created_at)
+               VALUES ($1, $2, $3, '', 1, $4)
+               RETURNING punishment_id""",
+            GROUP_ID,
+            USER_ID,
+            punishment_type_id,
+            created_at,
+        )
+    return cast(PunishmentId, punishment_id)
+
+
+async def get_streak_length(app: Any) -> int:
+    streakers = await app.db.punishments.get_top_streakers()
+    for streaker in streakers:
+        if streaker.user_id == USER_ID:
+            return int(streaker.streak_length)
+    return 0
+
+
+class TestWithDB_Streaks:
+    @pytest.mark.asyncio
+    async def test_streaks_follow_punishment_writes(self, database: str) -> None:
+        app = init_api(database=database)
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            ids = [await insert_weeks_ago(app, weeks) for weeks in (1, 2, 3)]
+            # Only a rebuild sees punishments written around the streaks
+            assert (USER_ID, GROUP_ID) in await app.db.streaks.check()
+            await app.db.streaks.rebuild()
+            assert await app.db.streaks.check() == []
+            assert await get_streak_length(app) == 3
+
+            res = await app.db.punishments.insert_multiple(
+                GROUP_ID,
+                USER_ID,
+                USER_ID,
+                [
+                    PunishmentCreate(
+                        punishment_type_id=WINE_ID,
+                        reason="",
+                        reason_hidden=False,
+                        amount=1,
+                    )
+                ],
+            )
+            assert await get_streak_length(app) == 4
+
+            await app.db.punishments.delete(res["ids"][0])
+            assert await get_streak_length(app) == 3
+            # Breaks the streak, which is then too short to be listed
+            await app.db.punishments.delete(ids[1])
+            assert await get_streak_length(app) == 0
+            assert await app.db.streaks.check() == []
+
+    @pytest.mark.asyncio
+    async def test_streaks_end_and_follow_type_deletes(self, database: str) -> None:
+        app = init_api(database=database)
+
+        async with LifespanManager(app):
+            await insert_group(app)
+            for weeks in (2, 3, 4):
+                await insert_weeks_ago(app, weeks)
+            await app.db.streaks.rebuild()
+            # The newest punished week was before last week
+            assert await get_streak_length(app) == 0
+
+            for weeks in (0, 1):
+                await insert_weeks_ago(app, weeks, WINE_ID)
+            await app.db.streaks.rebuild()
+            assert await get_streak_length(app) == 5
+
+            await app.db.leaderboard.rebuild([USER_ID])
+            await app.db.punishment_types.delete(GROUP_ID, WINE_ID)
+            assert await app.db.streaks.check() == []
+            assert await get_streak_length(app) == 0
@@ -1,8 +1,58 @@
+import asyncio
 import datetime
+import json
+import os
+from typing import Any, AsyncIterator, Optional
 
 import pytest
+from asgi_lifespan import LifespanManager
+from asyncpg.exceptions import ReadOnlySQLTransactionError
+from httpx import AsyncClient
 
+from app.api import Request
+from app.api.init_api import init_api
+from app.api.metrics import (
+    HTTP_REQUEST_SECONDS,
+    HTTP_REQUESTS,
+    HTTP_REQUESTS_IN_FLIGHT,
+    HTTP_RESPONSE_SIZE_BYTES,
+)
+from app.config import settings
+from app.db.core import Database
+from app.exceptions import MultipleConnectionsAcquired
 from app.utils.date import parse_naive_datetime, utc_to_oslo
+from app.utils.db import (
+    DB_MULTIPLE_CONNECTION_REQUESTS,
+    MaybeAcquire,
+    PoolStats,
+    get_query_name,
+    read_only,
+    track_connection_usage,
+    use_session,
+)
+from app.utils.json_stream import iter_json_array
+from app.utils.metrics import Counter, Gauge, Histogram, Registry
+from app.utils.pagination import Page, Pagination
+from app.types import GroupId
+from tests.fixtures import database
+
+TRPC_ITEMS_PATH = ["result", "data", "json", "items"]
+
+# A second Postgres instance standing in for a read replica
+REPLICA_HOST = os.environ.get("POSTGRES_REPLICA_TEST_HOST", "db_replica")
+REPLICA_PORT = os.environ.get("POSTGRES_REPLICA_TEST_PORT", "5432")
+REPLICA_GROUP_ID = GroupId("aaaaaaaa-aaaa-aaaa-aaaa-aaaaaaaaaaaa")
+
+
+async def iter_chunks(data: bytes, size: int) -> AsyncIterator[bytes]:
+    for i in range(0, len(data), size):
+        yield data[i : i + size]
+
+
+async def parse_items(data: bytes, size: int) -> list[Any]:
+    return [
+        item async for item in iter_json_array(iter_chunks(data, size), TRPC_ITEMS_PATH)
+    ]
 
 
 class TestUtils:
@@ -34,3 +84,382 @@ class TestUtils:
     ) -> None:
         parsed = parse_naive_datetime(dtinput)
         assert parsed == expected
+
+
+class TestJsonStream:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("size", (1, 2, 7, 64, 100000))
+    async def test_items_split_across_chunks(self, size: int) -> None:
+        items = [
+            {"id": "1", "name": "Ærlig Øystein Åsen", "email": "a@b.no"},
+            {"id": "2", "name": 'Quote " and \\', "nested": {"items": [1, 2]}},
+            12345,
+            None,
+            [1, {"a": "]"}],
+        ]
+        body = {
+            "result": {
+                "meta": {"items": ["not", "these"]},
+                "data": {"json": {"nextCursor": None, "items": items, "x": 1}},
+            }
+        }
+        data = json.dumps(body, ensure_ascii=False, indent=2).encode()
+
+        assert await parse_items(data, size) == items
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "body",
+        (
+            {"result": {"data": {"json": None}}},
+            {"result": {"data": {"json": {"items": None}}}},
+            {"result": {"data": {"json": {"items": []}}}},
+            {"error": {"message": "Not found"}},
+        ),
+    )
+    async def test_missing_items(self, body: dict[str, Any]) -> None:
+        assert await parse_items(json.dumps(body).encode(), 3) == []
+
+    @pytest.mark.asyncio
+    async def test_truncated_body_raises(self) -> None:
+        data = b'{"result": {"data": {"json": {"items": [{"id": 1}, {"id":'
+        with pytest.raises(json.JSONDecodeError):
+            await parse_items(data, 8)
+
+
+class TestPoolStats:
+    def test_histogram_is_cumulative(self) -> None:
+        stats = PoolStats()
+        for seconds in (0.0005, 0.001, 0.003, 0.2, 5):
+            stats.observe(seconds)
+
+        res = stats.get_stats()
+        assert res["acquired"] == 5
+        assert res["max_acquire_time_ms"] == 5000
+        assert res["acquire_le_1ms"] == 2
+        assert res["acquire_le_5ms"] == 3
+        assert res["acquire_le_100ms"] == 3
+        assert res["acquire_le_250ms"] == 4
+        assert res["acquire_le_1000ms"] == 4
+        assert res["acquire_le_inf"] == 5
+
+
+class NamedPool:
+    """Hands out its name as the connection."""
+
+    def __init__(self, name: str, replica: Optional["NamedPool"] = None) -> None:
+        self.name = name
+        self.replica = replica
+        self.sessions: list[Optional[str]] = []
+
+    def get_replica(self, session: Optional[str]) -> Optional["NamedPool"]:
+        self.sessions.append(session)
+        return None if session == "wrote" else self.replica
+
+    async def acquire(self) -> str:
+        return self.name
+
+    async def release(self, conn: str) -> None:
+        pass
+
+
+class TestMaybeAcquire:
+    @pytest.mark.asyncio
+    async def test_read_only_is_not_inherited(self) -> None:
+        pool = NamedPool("primary", NamedPool("replica"))
+
+        async def write() -> Any:
+            async with MaybeAcquire(None, pool) as conn:
+                return conn
+
+        @read_only
+        async def read() -> Any:
+            async with MaybeAcquire(None, pool) as conn:
+                return conn, await write(), await asyncio.create_task(write())
+
+        assert await read() == ("replica", "primary", "primary")
+
+        with use_session("wrote"):
+            assert await read() == ("primary", "primary", "primary")
+        assert pool.sessions == [None, "wrote"]
+
+
+class TestMetrics:
+    def test_render(self) -> None:
+        registry = Registry()
+        requests = Counter(
+            "requests_total", "Requests", ["route"], registry=registry
+        )
+        in_flight = Gauge("in_flight", "In flight", registry=registry)
+        latency = Histogram(
+            "latency_seconds", "Latency", ["route"], buckets=(0.1, 1), registry=registry
+        )
+
+        requests.inc("/a")
+        requests.inc("/a")
+        requests.inc('/"b"')
+        in_flight.set_function(lambda: 3)
+        latency.observe(0.05, "/a")
+        latency.observe(0.5, "/a")
+        latency.observe(5, "/a")
+
+        assert registry.render().splitlines() == [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{route="/a"} 2',
+            'requests_total{route="/\\"b\\""} 1',
+            "# HELP in_flight In flight",
+            "# TYPE in_flight gauge",
+            "in_flight 3",
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{route="/a",le="0.1"} 1',
+            'latency_seconds_bucket{route="/a",le="1"} 2',
+            'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+            'latency_seconds_sum{route="/a"} 5.55',
+            'latency_seconds_count{route="/a"} 3',
+        ]
+
+    def test_label_count_is_checked(self) -> None:
+        counter = Counter("checked_total", "Checked", ["a"], registry=Registry())
+        with pytest.raises(ValueError):
+            counter.inc()
+
+    def test_query_name_is_stable(self) -> None:
+        name = get_query_name("SELECT *\n  FROM groups WHERE group_id = $1")
+        assert name.startswith("select_groups_")
+        assert name == get_query_name("SELECT * FROM groups  WHERE group_id = $1")
+        assert name != get_query_name("SELECT * FROM groups WHERE name = $1")
+
+
+class TestHTTPMetrics:
+    @pytest.mark.asyncio
+    async def test_requests_are_recorded_by_route(self) -> None:
+        app = init_api()
+        in_flight = []
+
+        @app.get("/test/metrics/{item_id}")
+        async def item(item_id: str) -> dict[str, str]:
+            in_flight.append(HTTP_REQUESTS_IN_FLIGHT.get())
+            return {"item_id": item_id}
+
+        route = "/test/metrics/{item_id}"
+        before = HTTP_REQUESTS.get("GET", route, "200")
+
+        async with AsyncClient(app=app, base_url="http://test") as client:
+            for i in range(3):
+                res = await client.get(f"/test/metrics/{i}")
+                assert res.status_code == 200
+            res = await client.get("/test/missing/route")
+            assert res.status_code == 404
+
+        assert HTTP_REQUESTS.get("GET", route, "200") == before + 3
+        assert HTTP_REQUESTS.get("GET", "unmatched", "404") >= 1
+        assert HTTP_REQUEST_SECONDS.get_count("GET", route) >= 3
+        assert HTTP_RESPONSE_SIZE_BYTES.get_sum("GET", route) >= 3 * len(
+            '{"item_id":"0"}'
+        )
+        assert in_flight[0] >= 1
+        assert HTTP_REQUESTS_IN_FLIGHT.get() == 0
+
+
+class TestWithDB_Pool:
+    @pytest.mark.asyncio
+    async def test_pool_stats(self, database: str) -> None:
+        app = init_api(database=database)
+
+        async with LifespanManager(app):
+            before = app.db.get_pool_stats()
+            async with app.db.pool.acquire():
+                stats = app.db.get_pool_stats()
+                assert stats["acquired"] == before["acquired"] + 1
+                assert stats["idle"] == before["idle"] - 1
+                assert stats["waiting"] == 0
+
+            assert stats["max_size"] == settings.postgres_pool_max_size
+            assert stats["acquire_le_inf"] == stats["acquired"]
+
+    @pytest.mark.asyncio
+    async def test_metrics(self, database: str) -> None:
+        app = init_api(database=database)
+
+        @app.get("/test/two-connections")
+        async def two_connections() -> None:
+            async with app.db.pool.acquire() as conn:
+                await app.db.groups.search("metrics", conn=conn)
+                await app.db.groups.search("metrics")
+
+        async with LifespanManager(app):
+            with track_connection_usage() as usage:
+                await app.db.groups.search("metrics")
+            assert usage.acquired == 1
+
+            async with AsyncClient(app=app, base_url="http://test") as client:
+                res = await client.get("/test/two-connections")
+                assert res.status_code == 200
+                assert DB_MULTIPLE_CONNECTION_REQUESTS.get("/test/two-connections") == 1
+
+                res = await client.get("/metrics")
+                assert res.status_code == 200
+                assert "db_pool_acquire_seconds_bucket" in res.text
+                assert 'db_pool_connections{pool="primary",state="idle"}' in res.text
+                assert 'db_multiple_connection_requests_total{route="/test/two-connections"} 1' in res.text
+                assert 'db_query_seconds_count{query="select_groups_' in res.text
+
+    @pytest.mark.asyncio
+    async def test_request_connection(
+        self, monkeypatch: Any, database: str
+    ) -> None:
+        monkeypatch.setattr(settings, "postgres_strict_request_connections", True)
+        app = init_api(database=database)
+
+        @app.get("/test/request-connection")
+        async def request_connection(request: Request) -> bool:
+            async with request.connection as conn:
+                await app.db.groups.search("strict", conn=conn)
+            async with request.connection as other_conn:
+                return conn is other_conn
+
+        @app.get("/test/request-pagination")
+        async def request_pagination(request: Request) -> Page[int]:
+            async def total(conn: Any = None) -> int:
+                async with MaybeAcquire(conn, app.db.pool) as conn:
+                    return int(await conn.fetchval("SELECT 3"))
+
+            async def results(
+                offset: int, limit: int, conn: Any = None
+            ) -> list[int]:
+                async with MaybeAcquire(conn, app.db.pool) as conn:
+                    rows = await conn.fetch(
+                        "SELECT generate_series(1, 3) OFFSET $1 LIMIT $2",
+                        offset,
+                        limit,
+                    )
+                return [r[0] for r in rows]
+
+            pagination = Pagination[int](
+                request=request,
+                total_coro=total,
+                results_coro=results,
+                page=0,
+                page_size=2,
+            )
+            return await pagination.paginate()
+
+        @app.get("/test/strict-two-connections")
+        async def two_connections(request: Request) -> None:
+            async with request.connection as conn:
+                await app.db.groups.search("strict", conn=conn)
+                await app.db.groups.search("strict")
+
+        async with LifespanManager(app):
+            idle = app.db.pool.get_idle_size()
+            headers = {"Authorization": "Bearer token"}
+
+            async with AsyncClient(app=app, base_url="http://test") as client:
+                res = await client.get("/test/request-connection")
+                assert res.json() is True
+
+                res = await client.get("/test/request-pagination")
+                assert res.json()["results"] == [1, 2]
+
+                res = await client.get(
+                    "/groups/search", params={"query": "strict"}, headers=headers
+                )
+                assert res.status_code == 200
+
+                with pytest.raises(MultipleConnectionsAcquired):
+                    await client.get("/test/strict-two-connections")
+
+            # Every connection went back to the pool
+            assert app.db.pool.get_idle_size() == idle
+
+
+async def insert_replica_group(db: Database, name: str) -> None:
+    async with db.pool.acquire() as conn:
+        await conn.execute("DELETE FROM groups WHERE group_id = $1", REPLICA_GROUP_ID)
+        await conn.execute(
+            """INSERT INTO groups (group_id, name, name_short, rules, image)
+               VALUES ($1, $2, $2, '', '')""",
+            REPLICA_GROUP_ID,
+            name,
+        )
+
+
+class TestWithDB_Replica:
+    @pytest.mark.asyncio
+    async def test_read_only_queries_use_the_replica(self, database: str) -> None:
+        app = init_api(
+            database=database, replica_host=REPLICA_HOST, replica_port=REPLICA_PORT
+        )
+
+        # The instances don't replicate, so the rows tell them apart
+        replica = Database()
+        await replica.async_init(
+            database=database, host=REPLICA_HOST, port=REPLICA_PORT
+        )
+        await insert_replica_group(replica, "Replicakom")
+        await replica.close()
+
+        @app.get("/test/replica")
+        async def read_group(request: Request) -> str:
+            group = await app.db.groups.get(REPLICA_GROUP_ID, conn=request.connection)
+            return group.name
+
+        @app.get("/test/replica/pool")
+        async def read_group_from_pool() -> str:
+            group = await app.db.groups.get(REPLICA_GROUP_ID)
+            return group.name
+
+        @app.get("/test/replica/after-primary")
+        async def read_group_after_primary(request: Request) -> list[str]:
+            # Not read-only, so it uses the primary
+            groups = await app.db.groups.search("Primarykom", conn=request.connection)
+            group = await app.db.groups.get(REPLICA_GROUP_ID, conn=request.connection)
+            return [groups[0].name, group.name]
+
+        @app.post("/test/replica")
+        async def write_group(request: Request) -> None:
+            async with request.connection as conn:
+                await conn.execute(
+                    "UPDATE groups SET name = 'Writtenkom' WHERE group_id = $1",
+                    REPLICA_GROUP_ID,
+                )
+
+        async with LifespanManager(app):
+            await insert_replica_group(app.db, "Primarykom")
+            assert (await app.db.groups.get(REPLICA_GROUP_ID)).name == "Replicakom"
+
+            session = {"Authorization": "Bearer session"}
+            other_session = {"Authorization": "Bearer other-session"}
+            async with AsyncClient(app=app, base_url="http://test") as client:
+                res = await client.get("/test/replica", headers=session)
+                assert res.json() == "Replicakom"
+
+                # Reads after the primary was used see what it sees
+                res = await client.get("/test/replica/after-primary")
+                assert res.json() == ["Primarykom", "Primarykom"]
+
+                # Read your writes, for this session only
+                await client.post("/test/replica", headers=session)
+                res = await client.get("/test/replica", headers=session)
+                assert res.json() == "Writtenkom"
+                res = await client.get("/test/replica", headers=other_session)
+                assert res.json() == "Replicakom"
+                # Also without the connection of the request
+                res = await client.get("/test/replica/pool", headers=session)
+                assert res.json() == "Writtenkom"
+                res = await client.get("/test/replica/pool", headers=other_session)
+                assert res.json() == "Replicakom"
+
+            stats = app.db.get_replica_pool_stats()
+            assert stats["acquired"] >= 3
+            assert stats["idle"] == stats["size"]
+
+            replica_pool = app.db.replica_pool
+            assert replica_pool is not None
+            async with replica_pool.acquire() as conn:
+                with pytest.raises(ReadOnlySQLTransactionError):
+                    await conn.execute(
+                        "DELETE FROM groups WHERE group_id = $1", REPLICA_GROUP_ID
+                    )